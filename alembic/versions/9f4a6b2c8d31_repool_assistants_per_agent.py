@@ -0,0 +1,32 @@
+"""repool assistants per agent
+
+Revision ID: 9f4a6b2c8d31
+Revises: 5c8d1e3f9a27
+Create Date: 2026-10-18 09:41:05.318226
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '9f4a6b2c8d31'
+down_revision: Union[str, None] = '5c8d1e3f9a27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Pooled assistants were keyed without the agent ID and may be shared between agents. The pool is emptied, the assistants
+    # are recreated per agent on next use and the old ones are deleted by the cleanup worker (see `services.cleanup_service`).
+    op.execute("""
+        INSERT INTO cleanup_tasks (resource_type, resource_id, attempts, next_attempt_at, created, last_modified)
+        SELECT 'assistant', oai_assistant_id, 0, now(), now(), now() FROM agent_assistants
+        ON CONFLICT (resource_type, resource_id) DO NOTHING
+    """)
+    op.execute('DELETE FROM agent_assistants')
+
+
+def downgrade() -> None:
+    # The pool is rebuilt on demand, there is nothing to restore.
+    pass
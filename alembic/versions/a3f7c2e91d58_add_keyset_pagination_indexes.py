@@ -0,0 +1,33 @@
+"""add keyset pagination indexes
+
+Revision ID: a3f7c2e91d58
+Revises: 8e1c5b7d2f40
+Create Date: 2026-10-17 23:48:52.104377
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3f7c2e91d58'
+down_revision: Union[str, None] = '8e1c5b7d2f40'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Built concurrently so the tables stay writable while the indexes are created
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_created_id', 'users', ['created', 'id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_chat_sessions_userID_created_id', 'chat_sessions', ['userID', 'created', 'id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_documents_created_id', 'documents', ['created', 'id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_agents_module_id_created_id', 'agents', ['module_id', 'created', 'id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_agents_module_id_created_id', table_name='agents', postgresql_concurrently=True)
+        op.drop_index('ix_documents_created_id', table_name='documents', postgresql_concurrently=True)
+        op.drop_index('ix_chat_sessions_userID_created_id', table_name='chat_sessions', postgresql_concurrently=True)
+        op.drop_index('ix_users_created_id', table_name='users', postgresql_concurrently=True)
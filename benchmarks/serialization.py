@@ -0,0 +1,120 @@
+"""
+Compares building and encoding large user and chat session lists before and after the precompiled serializers.
+
+The old code built every dict by hand with `strftime` and encoded it with the standard library `json`, the new one converts
+column-only rows with `compile_serializer` and encodes them with `FastJSONProvider` (orjson, if installed).
+Reports the time spent building the dicts and encoding the response body.
+
+Usage:
+    python benchmarks/serialization.py --users 20000 --sessions 50000 --repeat 5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from util_functions.functions import compile_serializer, format_timestamp, str_or_none
+from util_functions.json_functions import FastJSONProvider, orjson
+
+# Column-only rows, as returned by the list queries of `services.sql_service`
+UserRow = namedtuple('UserRow', 'id username email created last_modified')
+SessionRow = namedtuple('SessionRow', 'id user_id user_email agent_id thread_id module_id created last_modified')
+
+serialize_user = compile_serializer({
+    "Id": ("id", str),
+    "Username": "username",
+    "Email": "email",
+    "Created": ("created", format_timestamp),
+    "LastModified": ("last_modified", format_timestamp),
+})
+serialize_session = compile_serializer({
+    "Id": ("id", str),
+    "UserId": ("user_id", str),
+    "UserEmail": "user_email",
+    "AgentId": ("agent_id", str_or_none),
+    "ThreadId": "thread_id",
+    "ModuleId": ("module_id", str_or_none),
+    "Created": ("created", format_timestamp),
+    "LastModified": ("last_modified", format_timestamp),
+})
+
+
+def make_rows(users: int, sessions: int):
+  start = datetime(2024, 1, 1)
+  user_rows = [UserRow(uuid.uuid4(), f'user{i}', f'user{i}@example.com', start + timedelta(minutes=i), start + timedelta(minutes=i, seconds=30))
+               for i in range(users)]
+  session_rows = [SessionRow(uuid.uuid4(), user_rows[i % users].id, user_rows[i % users].email, uuid.uuid4(), f'thread_{i:024d}', uuid.uuid4(),
+                             start + timedelta(seconds=i), start + timedelta(seconds=i, milliseconds=250))
+                  for i in range(sessions)]
+  return user_rows, session_rows
+
+
+def old_user(user):
+  return {
+    'Id': str(user.id),
+    'Username': user.username,
+    'Email': user.email,
+    'Created': user.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+    'LastModified': user.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+  }
+
+
+def old_session(session):
+  return {
+    'Id': str(session.id),
+    'UserId': str(session.user_id),
+    'UserEmail': session.user_email,
+    'AgentId': str(session.agent_id) if session.agent_id else None,
+    'ThreadId': session.thread_id,
+    'ModuleId': str(session.module_id) if session.module_id else None,
+    'Created': session.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+    'LastModified': session.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+  }
+
+
+def measure(rows, serialize, encode, repeat: int):
+  build = dump = 0.0
+  for _ in range(repeat):
+    start = time.perf_counter()
+    data = [serialize(row) for row in rows]
+    built = time.perf_counter()
+    body = encode(data)
+    build += built - start
+    dump += time.perf_counter() - built
+  return {'build': build / repeat, 'encode': dump / repeat, 'bytes': len(body)}
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--users', type=int, default=20000, help='Number of users in the list.')
+  parser.add_argument('--sessions', type=int, default=50000, help='Number of chat sessions in the list.')
+  parser.add_argument('--repeat', type=int, default=5)
+  args = parser.parse_args()
+
+  app = Flask(__name__)
+  provider = FastJSONProvider(app)
+  old_encode = lambda data: json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+  new_encode = lambda data: provider.response(data).get_data()
+
+  user_rows, session_rows = make_rows(args.users, args.sessions)
+  results = {
+    f'users ({args.users}), old': measure(user_rows, old_user, old_encode, args.repeat),
+    f'users ({args.users}), new': measure(user_rows, serialize_user, new_encode, args.repeat),
+    f'sessions ({args.sessions}), old': measure(session_rows, old_session, old_encode, args.repeat),
+    f'sessions ({args.sessions}), new': measure(session_rows, serialize_session, new_encode, args.repeat),
+  }
+  print(f'JSON encoder: {"orjson" if orjson else "json (orjson not installed)"}, average of {args.repeat} runs')
+  print(f'{"":28} {"build":>10} {"encode":>10} {"total":>10} {"bytes":>10}')
+  for name, result in results.items():
+    print(f'{name:28} {result["build"]:>9.3f}s {result["encode"]:>9.3f}s {result["build"] + result["encode"]:>9.3f}s {result["bytes"]:>10}')
+
+
+if __name__ == '__main__':
+  main()
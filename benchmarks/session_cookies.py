@@ -0,0 +1,140 @@
+"""
+Compares the per-request overhead of reading the session cookies before and after memoizing them in `g`, with the chat and
+agent sessions stored server-side (see `services.session_store`).
+
+A typical chat request reads the user session in `check_session_validation`, `roles_required`, `get_user_info` and
+`check_module_permission`, and the agent and chat sessions a couple of times each. The old helpers verified the signature and
+deserialized every cookie on every read. Now each cookie is resolved once per request (`load_session_cookie`), the chat and
+agent cookies hold handles resolved from the in-process front cache or, on a miss, the `session_states` table.
+
+Reported separately:
+  - handle lookups served by the front cache (which still checks that the session exists), and with the front cache
+    disabled (the session is loaded from `session_states`),
+  - the one-time migration of a legacy signed chat or agent cookie, which stores the session under a new handle.
+
+Needs the database of `POSTGRES_CONNECTION_STRING`, the sessions stored by the benchmark are deleted afterwards.
+
+Usage:
+    python benchmarks/session_cookies.py --requests 2000 --migrations 200 --user-reads 5 --other-reads 2
+"""
+import argparse
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from config import agent_session_serializer, chat_session_serializer, user_session_serializer
+from services.session_store import SessionStore, agent_sessions, chat_sessions
+from services.sql_service import delete_session_states
+from util_functions.functions import get_agent_session, get_chat_session, get_user_info
+
+USER = {'Username': 'user', 'Email': 'user@example.com', 'Id': '8c5b6c2e-6f3f-4f8e-9d7a-3f1b2c4d5e6f',
+        'Roles': [{'Id': '1', 'Name': 'Admin'}, {'Id': '2', 'Name': 'User'}],
+        'Modules': [{'Id': str(i), 'Name': f'Module {i}'} for i in range(10)],
+        'Created': '2024-05-01T12:30:45.123', 'LastModified': '2024-05-01T12:30:45.123'}
+AGENT = {'agent_id': 'a', 'oai_agent_id': 'asst_' + 'x' * 24, 'file_ids': ['file_' + 'x' * 24] * 5, 'vector_store_id': 'vs_' + 'x' * 24}
+CHAT = {'agent_ids': ['a', 'b'], 'thread_id': 'thread_' + 'x' * 24, 'file_ids': [], 'chat_id': 'c', 'vector_store_id': None}
+
+
+def old_request(cookies, user_reads, other_reads):
+  for _ in range(user_reads):
+    user_session_serializer.loads(cookies['user_session'])
+  for _ in range(other_reads):
+    agent_session_serializer.loads(cookies['agent_session'])
+    chat_session_serializer.loads(cookies['chat_session'])
+
+
+def new_request(cookies, user_reads, other_reads):
+  for _ in range(user_reads):
+    get_user_info()
+  for _ in range(other_reads):
+    get_agent_session()
+    get_chat_session()
+
+
+def measure(app, cookies, handler, requests, user_reads, other_reads):
+  header = '; '.join(f'{name}={value}' for name, value in cookies.items())
+  elapsed = 0.0
+  for _ in range(requests):
+    with app.test_request_context('/', headers={'Cookie': header}):
+      start = time.perf_counter()
+      handler(cookies, user_reads, other_reads)
+      elapsed += time.perf_counter() - start
+  return elapsed / requests
+
+
+@contextmanager
+def recording_handles(handles: list, *stores):
+  """
+  Appends the handles stored through `stores` while in scope to `handles`, so the sessions created by legacy cookie migrations can be deleted.
+  """
+  def recording(dumps):
+    def record(data):
+      handle = dumps(data)
+      handles.append(handle)
+      return handle
+    return record
+
+  for store in stores:
+    store.dumps = recording(store.dumps)
+  try:
+    yield
+  finally:
+    for store in stores:
+      del store.dumps # back to `SessionStore.dumps`
+
+
+@contextmanager
+def without_front_cache(*stores):
+  caches = {store: store.cache for store in stores}
+  for store in stores:
+    store.cache = None
+  try:
+    yield
+  finally:
+    for store, cache in caches.items():
+      store.cache = cache
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--requests', type=int, default=2000)
+  parser.add_argument('--migrations', type=int, default=200, help='Requests with legacy chat and agent cookies, each stores both sessions.')
+  parser.add_argument('--user-reads', type=int, default=5, help='Reads of the user session per request.')
+  parser.add_argument('--other-reads', type=int, default=2, help='Reads of the agent and chat sessions per request.')
+  args = parser.parse_args()
+
+  app = Flask(__name__)
+  legacy = {
+    'user_session': user_session_serializer.dumps(USER),
+    'agent_session': agent_session_serializer.dumps(AGENT),
+    'chat_session': chat_session_serializer.dumps(CHAT),
+  }
+  handles = {'user_session': legacy['user_session'], 'agent_session': agent_sessions.dumps(AGENT), 'chat_session': chat_sessions.dumps(CHAT)}
+  if SessionStore.is_legacy(handles['agent_session']) or SessionStore.is_legacy(handles['chat_session']):
+    sys.exit('The sessions could not be stored, check POSTGRES_CONNECTION_STRING.')
+  migrated = []
+  try:
+    old = measure(app, legacy, old_request, args.requests, args.user_reads, args.other_reads)
+    cached = measure(app, handles, new_request, args.requests, args.user_reads, args.other_reads)
+    with without_front_cache(agent_sessions, chat_sessions):
+      uncached = measure(app, handles, new_request, args.requests, args.user_reads, args.other_reads)
+    with recording_handles(migrated, agent_sessions, chat_sessions):
+      migration = measure(app, legacy, new_request, args.migrations, args.user_reads, args.other_reads)
+  finally:
+    agent_sessions.discard(handles['agent_session'])
+    chat_sessions.discard(handles['chat_session'])
+    delete_session_states([handle for handle in migrated if not SessionStore.is_legacy(handle)])
+
+  print(f'{args.requests} requests, {args.user_reads} user session and {args.other_reads} agent/chat session reads each')
+  print(f'{"decode on every read":32} {old * 1e6:>8.1f} us/request')
+  print(f'{"handles, front cache":32} {cached * 1e6:>8.1f} us/request ({old / cached:.1f}x)')
+  print(f'{"handles, session_states lookup":32} {uncached * 1e6:>8.1f} us/request ({old / uncached:.1f}x)')
+  print(f'{"legacy cookie migration (once)":32} {migration * 1e6:>8.1f} us/request, {args.migrations} requests')
+
+
+if __name__ == '__main__':
+  main()
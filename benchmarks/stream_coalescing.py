@@ -0,0 +1,77 @@
+"""
+Compares the streaming loop of `chat_ta` before and after delta coalescing on a simulated OpenAI delta stream.
+
+The old loop slept 50 ms after every text delta, the new one coalesces deltas with `DeltaCoalescer` and never sleeps.
+Reports the time to first and last token, the number of chunks written to the client and the throughput.
+
+Usage:
+    python benchmarks/stream_coalescing.py --deltas 400 --arrival 0.005 --flush-bytes 64 --flush-interval 0.05
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util_functions.stream_functions import DeltaCoalescer
+
+
+def upstream(deltas: int, arrival: float):
+  # OpenAI text deltas are mostly a single token of a few characters.
+  for i in range(deltas):
+    time.sleep(arrival)
+    yield f'tok{i % 10} '
+
+
+def sleeping_stream(deltas, arrival):
+  for text in upstream(deltas, arrival):
+    yield text
+    time.sleep(0.05)
+
+
+def coalesced_stream(deltas, arrival, flush_bytes, flush_interval):
+  coalescer = DeltaCoalescer(flush_bytes=flush_bytes, flush_interval=flush_interval)
+  for text in upstream(deltas, arrival):
+    chunk = coalescer.push(text)
+    if chunk:
+      yield chunk
+  chunk = coalescer.flush()
+  if chunk:
+    yield chunk
+
+
+def measure(stream):
+  start = time.perf_counter()
+  first = None
+  chunks = 0
+  chars = 0
+  for chunk in stream:
+    if first is None:
+      first = time.perf_counter() - start
+    chunks += 1
+    chars += len(chunk)
+  total = time.perf_counter() - start
+  return {'first': first, 'last': total, 'chunks': chunks, 'throughput': chars / total}
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--deltas', type=int, default=400, help='Number of text deltas in the simulated response.')
+  parser.add_argument('--arrival', type=float, default=0.005, help='Seconds between upstream deltas.')
+  parser.add_argument('--flush-bytes', type=int, default=64)
+  parser.add_argument('--flush-interval', type=float, default=0.05)
+  args = parser.parse_args()
+
+  results = {
+    'sleep(0.05) per delta': measure(sleeping_stream(args.deltas, args.arrival)),
+    f'coalesced ({args.flush_bytes} B / {args.flush_interval} s)': measure(coalesced_stream(args.deltas, args.arrival, args.flush_bytes, args.flush_interval)),
+  }
+  print(f'{args.deltas} deltas, {args.arrival * 1000:.1f} ms upstream arrival')
+  print(f'{"":32} {"first token":>12} {"last token":>12} {"chunks":>8} {"chars/s":>10}')
+  for name, result in results.items():
+    print(f'{name:32} {result["first"]:>11.3f}s {result["last"]:>11.3f}s {result["chunks"]:>8} {result["throughput"]:>10.0f}')
+
+
+if __name__ == '__main__':
+  main()
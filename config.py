@@ -4,7 +4,7 @@ try:
     from itsdangerous import URLSafeSerializer
     from flask_limiter import Limiter
     from flask_limiter.util import get_remote_address
-    from openai import OpenAI
+    from openai import AsyncOpenAI, OpenAI
     from dotenv import load_dotenv
     from supabase import create_client, Client
 except ModuleNotFoundError as e:
@@ -39,6 +39,69 @@ agent_session_serializer = URLSafeSerializer(SECRET_KEY)
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 # Initialize OAI client
 OPENAI_CLIENT = OpenAI(api_key=OPENAI_API_KEY)
+# Async OAI client used by the ASGI chat path
+ASYNC_OPENAI_CLIENT = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Seconds after which a cached OpenAI file ID is checked against OpenAI again before being reused
+OPENAI_FILE_REVALIDATE_AFTER = int(os.environ.get('OPENAI_FILE_REVALIDATE_AFTER', 86400))
+# Maximum number of documents downloaded from storage and uploaded to OpenAI at the same time
+OPENAI_UPLOAD_CONCURRENCY = int(os.environ.get('OPENAI_UPLOAD_CONCURRENCY', 4))
+# Seconds a pre-provisioned pointer agent is kept around waiting for `point_to_agent`
+AGENT_PREFETCH_TTL = int(os.environ.get('AGENT_PREFETCH_TTL', 1800))
+# Number of agent definitions cached in process and the seconds each is cached for
+AGENT_CACHE_SIZE = int(os.environ.get('AGENT_CACHE_SIZE', 256))
+AGENT_CACHE_TTL = int(os.environ.get('AGENT_CACHE_TTL', 300))
+# Streamed text is sent to the client in chunks of at least this many bytes or after this many seconds, whichever comes first
+STREAM_FLUSH_BYTES = int(os.environ.get('STREAM_FLUSH_BYTES', 64))
+STREAM_FLUSH_INTERVAL = float(os.environ.get('STREAM_FLUSH_INTERVAL', 0.05))
+# Token usage rows are buffered and inserted in batches once this many are buffered or after this many seconds
+USAGE_FLUSH_SIZE = int(os.environ.get('USAGE_FLUSH_SIZE', 50))
+USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL', 10))
+# Deleting OpenAI resources queued in the cleanup outbox: parallel deletions, tasks claimed per batch, seconds between polls,
+# seconds a claimed task is hidden from other workers, base of the exponential retry delay in seconds and attempts before giving up
+CLEANUP_CONCURRENCY = int(os.environ.get('CLEANUP_CONCURRENCY', 4))
+CLEANUP_BATCH_SIZE = int(os.environ.get('CLEANUP_BATCH_SIZE', 50))
+CLEANUP_POLL_INTERVAL = float(os.environ.get('CLEANUP_POLL_INTERVAL', 15))
+CLEANUP_LEASE = int(os.environ.get('CLEANUP_LEASE', 300))
+CLEANUP_RETRY_BASE = int(os.environ.get('CLEANUP_RETRY_BASE', 30))
+CLEANUP_MAX_ATTEMPTS = int(os.environ.get('CLEANUP_MAX_ATTEMPTS', 8))
+# Default and maximum page size of paginated list endpoints (see util_functions.functions.get_page_args)
+PAGE_SIZE_DEFAULT = int(os.environ.get('PAGE_SIZE_DEFAULT', 50))
+PAGE_SIZE_MAX = int(os.environ.get('PAGE_SIZE_MAX', 100))
+# Fail instead of logging when a database function exceeds its query budget (see database.database.query_budget), set in tests
+QUERY_BUDGET_STRICT = os.environ.get('QUERY_BUDGET_STRICT', 'false').lower() == 'true'
+# Chat sessions are deleted this many days after their last modification (OpenAI keeps thread messages for 60 days),
+# in batches of this many sessions with a pause of this many seconds between batches
+RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', 60))
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', 500))
+RETENTION_PAUSE = float(os.environ.get('RETENTION_PAUSE', 0.5))
+# Seconds a scheduled job may start early, a job that started within its interval minus this on any worker is skipped (see database.database.run_exclusive)
+JOB_INTERVAL_GRACE = int(os.environ.get('JOB_INTERVAL_GRACE', 60))
+# Orphan sweeper: hours between sweeps, hours after which an unreferenced OpenAI resource is stale (chat cookies live for 7 days),
+# stale resources queued for deletion per sweep, pages of 100 listed per resource type and whether stale resources are only reported
+SWEEP_INTERVAL = float(os.environ.get('SWEEP_INTERVAL', 6))
+SWEEP_MIN_AGE = float(os.environ.get('SWEEP_MIN_AGE', 168))
+SWEEP_DELETE_BUDGET = int(os.environ.get('SWEEP_DELETE_BUDGET', 200))
+SWEEP_MAX_PAGES = int(os.environ.get('SWEEP_MAX_PAGES', 50))
+SWEEP_DRY_RUN = os.environ.get('SWEEP_DRY_RUN', 'true').lower() == 'true'
+# Password hashing: bcrypt cost factor (hashes with another cost are replaced on login), threads hashing and verifying passwords,
+# requests allowed to wait for a thread before new ones are rejected with 503, and seconds a request waits for its result
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', 2))
+BCRYPT_QUEUE_LIMIT = int(os.environ.get('BCRYPT_QUEUE_LIMIT', 16))
+BCRYPT_TIMEOUT = float(os.environ.get('BCRYPT_TIMEOUT', 10))
+# Server-side chat and agent sessions (see services.session_store): seconds a stored session lives (the cookie max_age),
+# sessions cached in process and the seconds each is cached for, and whether signed cookies holding the whole session are still accepted
+SESSION_STORE_TTL = int(os.environ.get('SESSION_STORE_TTL', 604800))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 1024))
+SESSION_CACHE_TTL = int(os.environ.get('SESSION_CACHE_TTL', 300))
+SESSION_LEGACY_COOKIES = os.environ.get('SESSION_LEGACY_COOKIES', 'true').lower() == 'true'
+# USD per 1M input and output tokens, used to fill the cost columns of token usage (stored in micro-USD)
+OPENAI_TOKEN_PRICES = {
+  'gpt-4o-mini': (0.15, 0.6),
+  'gpt-4o': (2.5, 10.0),
+  'gpt-4-turbo': (10.0, 30.0),
+  'gpt-3.5-turbo': (0.5, 1.5),
+}
 
 # Initialize flask limiter
 limiter = Limiter(key_func=get_remote_address)
@@ -60,3 +123,5 @@ SUPABASE_SERVICE_ROLE_KEY=os.environ['SUPABASE_SERVICE_ROLE_KEY'] # DANGEROUS
 
 # Initialize Supabase client
 SB_CLIENT: Client = create_client(SUPABASE_STORAGE_URL, SUPABASE_SERVICE_ROLE_KEY) # SHOULD BE REPLACED WITH SPABASE_S3 OR SUPABASE_API_KEY AFTER RESOLVING SUPABASE AUTH/POLICIES
+# Maximum number of files removed from a storage bucket in one request
+STORAGE_DELETE_BATCH = int(os.environ.get('STORAGE_DELETE_BATCH', 1000))
@@ -1,15 +1,19 @@
 from datetime import datetime, timedelta, timezone
 import logging
-from sqlalchemy import create_engine
+import time
+from sqlalchemy import create_engine, delete, event, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import NullPool 
-from config import POSTGRES_CONNECTION_STRING, SB_CLIENT
+from config import JOB_INTERVAL_GRACE, POSTGRES_CONNECTION_STRING, QUERY_BUDGET_STRICT, RETENTION_BATCH_SIZE, RETENTION_DAYS, RETENTION_PAUSE, SB_CLIENT, SWEEP_INTERVAL
 from database.base import Base
-from database.models import ChatSession, User, Role, Document
-from util_functions.functions import hash_password
+from database.models import ChatSession, CleanupTask, JobRun, SessionState, User, Role, Document, agent_chat_table
+from util_functions.functions import current_time_prague, hash_password
 import uuid
 from contextlib import contextmanager
+from functools import wraps
+import threading
 import os
 import hashlib
 from werkzeug.utils import secure_filename
@@ -58,6 +62,64 @@ def session_scope():
     session.close()
       
 
+class QueryBudgetExceeded(AssertionError):
+  """
+  Raised by `query_budget` in strict mode when a function issues more SQL statements than its budget.
+  """
+
+_query_counters = threading.local()
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+  for counter in getattr(_query_counters, 'active', ()):
+    counter['count'] += 1
+
+@contextmanager
+def count_queries():
+  """
+  Counts the SQL statements executed by the current thread within the scope.
+
+  Yields:
+      dict: The counter, `count` holds the number of statements executed so far.
+
+  Usage:
+      with count_queries() as counter:
+          get_all_users()
+      assert counter['count'] <= 3
+  """
+  counter = {'count': 0}
+  active = getattr(_query_counters, 'active', None)
+  if active is None:
+    active = _query_counters.active = []
+  active.append(counter)
+  try:
+    yield counter
+  finally:
+    active.remove(counter)
+
+def query_budget(limit: int):
+  """
+  Decorates a database function with the number of SQL statements it may issue, catching N+1 queries introduced by lazy loading.
+  Exceeding the budget is logged, or raises `QueryBudgetExceeded` if `QUERY_BUDGET_STRICT` is set (in tests and development).
+
+  Parameters:
+      limit (int): The maximum number of statements per call.
+  """
+  def decorator(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+      with count_queries() as counter:
+        result = func(*args, **kwargs)
+      if counter['count'] > limit:
+        message = f'{func.__name__} issued {counter["count"]} queries, its budget is {limit}.'
+        if QUERY_BUDGET_STRICT:
+          raise QueryBudgetExceeded(message)
+        logging.warning(message)
+      return result
+    return wrapper
+  return decorator
+      
+
 def seed_data():
   """
   Seeds the database with essential roles and a default admin user to ensure the application
@@ -147,20 +209,192 @@ def upload_documents():
   except Exception as e:
       print(f"An error occurred during document upload: {e}")
       
-def delete_old_chat_sessions():
+def delete_old_chat_sessions(batch_size: int=RETENTION_BATCH_SIZE, pause: float=RETENTION_PAUSE):
   """
-  Removes old chat sessions from the database after 60 days post their last modified date. This needs to happen mostly because OpenAI only keeps thread messages for
+  Removes old chat sessions from the database after `RETENTION_DAYS` (60) days post their last modified date. This needs to happen mostly because OpenAI only keeps thread messages for
   60 days. 
+  
+  Sessions are deleted oldest first in batches of `batch_size`, each in its own short transaction followed by a `pause`, so the table is
+  never locked for long. The OpenAI threads of deleted sessions are queued for deletion in the same transaction (see `services.cleanup_service`).
+  Progress is reported to the `job_runs` table after each batch.
+
+  Returns:
+      dict: The number of deleted sessions (`Deleted`), processed batches (`Batches`) and threads queued for deletion (`ThreadsQueued`).
+  """
+  cutoff_date = datetime.now(timezone.utc) - timedelta(days=RETENTION_DAYS)
+  progress = {'Cutoff': cutoff_date.isoformat(), 'Deleted': 0, 'Batches': 0, 'ThreadsQueued': 0}
+  while True:
+    try:
+      with session_scope() as session:
+        batch = session.query(ChatSession.id, ChatSession.threadID).filter(ChatSession.last_modified < cutoff_date) \
+                       .order_by(ChatSession.last_modified).limit(batch_size).with_for_update(skip_locked=True).all()
+        if not batch:
+          break
+        ids = [row.id for row in batch]
+        # agent_chat has no ON DELETE CASCADE, transcripts and chat messages are removed by theirs
+        session.execute(delete(agent_chat_table).where(agent_chat_table.c.chat_session_id.in_(ids)))
+        session.query(ChatSession).filter(ChatSession.id.in_(ids)).delete(synchronize_session=False)
+        thread_ids = {row.threadID for row in batch if row.threadID}
+        if thread_ids:
+          now = current_time_prague()
+          # Threads still used by other chat sessions are skipped when the cleanup queue is drained
+          result = session.execute(pg_insert(CleanupTask).values([{
+            'resource_type': 'thread',
+            'resource_id': thread_id,
+            'attempts': 0,
+            'next_attempt_at': now,
+            'created': now,
+            'last_modified': now
+          } for thread_id in thread_ids]).on_conflict_do_nothing(index_elements=['resource_type', 'resource_id']))
+          progress['ThreadsQueued'] += result.rowcount
+    except SQLAlchemyError as e:
+      logging.error(f'Encountered an SQLAlchemy error while attempting to delete old ChatSessions! {e}')
+      raise
+    except Exception as e:
+      logging.error(f'Failed to delete old ChatSessions! {e}')
+      raise
+    progress['Deleted'] += len(ids)
+    progress['Batches'] += 1
+    logging.info(f'Deleted {progress["Deleted"]} old ChatSessions in {progress["Batches"]} batches')
+    report_job_progress('delete_old_chat_sessions', progress)
+    if len(ids) < batch_size:
+      break
+    time.sleep(pause)
+  return progress
+
+def delete_expired_sessions(batch_size: int=RETENTION_BATCH_SIZE):
   """
+  Removes expired chat and agent sessions from the `session_states` table (see `services.session_store`), in batches of `batch_size`.
+  Expired sessions are never served, this only keeps the table small.
+
+  Returns:
+      dict: The number of deleted sessions (`Deleted`).
+  """
+  progress = {'Deleted': 0}
+  while True:
+    try:
+      with session_scope() as session:
+        expired = session.query(SessionState.handle).filter(SessionState.expires < current_time_prague()).limit(batch_size)
+        deleted = session.query(SessionState).filter(SessionState.handle.in_(expired.scalar_subquery())).delete(synchronize_session=False)
+    except Exception as e:
+      logging.error(f'Failed to delete expired sessions! {e}')
+      raise
+    progress['Deleted'] += deleted
+    if deleted < batch_size:
+      break
+  logging.info(f'Deleted {progress["Deleted"]} expired sessions')
+  return progress
+
+def sweep_orphaned_resources():
+  """
+  Runs the orphan sweeper of leaked OpenAI resources (see `services.sweeper_service.sweep_orphaned_resources`).
+
+  Returns:
+      dict: The summary of the sweep.
+  """
+  # Imported here, the sweeper's services import this module
+  from services.sweeper_service import sweep_orphaned_resources as sweep
+  report = sweep()
+  if report is None:
+    raise RuntimeError('References to OpenAI resources could not be loaded.')
+  return {'DryRun': report['DryRun'], 'Scanned': report['Scanned'], 'Stale': len(report['Stale']),
+          'Queued': report['Queued'], 'Deferred': report['Deferred'], 'Errors': report['Errors']}
+
+def _job_lock_key(name: str):
+  return int.from_bytes(hashlib.sha256(name.encode('utf-8')).digest()[:8], 'big', signed=True)
+
+def _started_within(name: str, period: timedelta):
   try:
     with session_scope() as session:
-      cutoff_date = datetime.now(timezone.utc) - timedelta(days=60)
-      session.query(ChatSession).filter(ChatSession.last_modified < cutoff_date).delete(synchronize_session=False)
-      session.commit()
-  except SQLAlchemyError as e:
-    logging.error(f'Encountered an SQLAlchemy error while attempting to delete old ChatSessions! {e}')
+      last_started = session.query(JobRun.last_started).filter(JobRun.name == name).scalar()
   except Exception as e:
-    logging.error(f'Failed to delete old ChatSessions! {e}')
+    logging.error(f'Failed to read the last start of job {name}. {e}')
+    return False
+  # Stored without the timezone, as the Prague wall time of `current_time_prague` (see `run_exclusive`)
+  return last_started is not None and current_time_prague().replace(tzinfo=None) - last_started < period
+
+def _record_job_start(name: str, started: datetime):
+  values = {'last_started': started, 'last_duration': None, 'last_status': 'running', 'last_error': None, 'details': None}
+  try:
+    with session_scope() as session:
+      session.execute(pg_insert(JobRun).values(name=name, runs=1, created=started, last_modified=started, **values)
+                      .on_conflict_do_update(index_elements=['name'], set_={**values, 'runs': JobRun.runs + 1, 'last_modified': started}))
+  except Exception as e:
+    logging.error(f'Failed to record the start of job {name}. {e}')
+
+def _record_job_end(name: str, duration: float, status: str, error: str=None, details: dict=None):
+  values = {JobRun.last_duration: duration, JobRun.last_status: status, JobRun.last_error: error, JobRun.last_modified: current_time_prague().replace(tzinfo=None)}
+  if details is not None:
+    values[JobRun.details] = details
+  try:
+    with session_scope() as session:
+      session.query(JobRun).filter(JobRun.name == name).update(values, synchronize_session=False)
+  except Exception as e:
+    logging.error(f'Failed to record the end of job {name}. {e}')
+
+def report_job_progress(name: str, details: dict):
+  """
+  Stores the progress of a running job in its `job_runs` row, shown by `GET /utility/jobs`.
+
+  Parameters:
+      name (str): The name the job is scheduled under.
+      details (dict): JSON-serializable progress of the job.
+  """
+  try:
+    with session_scope() as session:
+      session.query(JobRun).filter(JobRun.name == name).update({JobRun.details: details, JobRun.last_modified: current_time_prague().replace(tzinfo=None)}, synchronize_session=False)
+  except Exception as e:
+    logging.error(f'Failed to report the progress of job {name}. {e}')
+
+def run_exclusive(name: str, job, interval: timedelta=None):
+  """
+  Runs a scheduled job unless another instance is running it already. Exclusivity is ensured by a Postgres advisory lock
+  keyed by the job's name, so any number of workers can run the scheduler while each job runs on one of them at a time.
+  Since every worker schedules every job, a run is also skipped if the job started less than `interval` (minus `JOB_INTERVAL_GRACE`
+  seconds) ago on any instance, so the job runs once per interval regardless of the number of workers.
+  The start, duration and outcome of the run are recorded in the `job_runs` table, along with the result of the job if it returns a dict.
+
+  Parameters:
+      name (str): The name of the job, unique across jobs.
+      job (Callable): The job to run.
+      interval (timedelta): The interval the job is scheduled at. Runs aren't checked against previous ones if omitted.
+
+  Returns:
+      bool: True if the job ran on this instance, False if it was skipped.
+  """
+  key = _job_lock_key(name)
+  with engine.connect() as connection:
+    acquired = connection.execute(text('SELECT pg_try_advisory_lock(:key)'), {'key': key}).scalar()
+    # The lock is held by the connection, not the transaction. Committing keeps the connection from idling in a transaction.
+    connection.commit()
+    if not acquired:
+      logging.info(f'Job {name} is running on another instance, skipping.')
+      return False
+    if interval is not None and _started_within(name, interval - timedelta(seconds=JOB_INTERVAL_GRACE)):
+      logging.info(f'Job {name} already ran within its interval, skipping.')
+      connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': key})
+      connection.commit()
+      return False
+    # `job_runs` times are stored as the naive Prague time, a tz-aware value would be stored converted to UTC
+    _record_job_start(name, current_time_prague().replace(tzinfo=None))
+    start = time.time()
+    status, error, details = 'success', None, None
+    try:
+      result = job()
+      details = result if isinstance(result, dict) else None
+    except Exception as e:
+      status, error = 'failed', str(e)
+      logging.error(f'Job {name} failed! {e}')
+    finally:
+      duration = time.time() - start
+      _record_job_end(name, duration, status, error, details)
+      connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': key})
+      connection.commit()
+      logging.info(f'Job {name} finished in {duration} seconds')
+    return True
     
+# Started by `worker.py`, never inside the web workers
 scheduler = BlockingScheduler()
-scheduler.add_job(delete_old_chat_sessions, 'interval', days=1)
\ No newline at end of file
+scheduler.add_job(run_exclusive, 'interval', days=1, args=['delete_old_chat_sessions', delete_old_chat_sessions, timedelta(days=1)], id='delete_old_chat_sessions')
+scheduler.add_job(run_exclusive, 'interval', hours=SWEEP_INTERVAL, args=['sweep_orphaned_resources', sweep_orphaned_resources, timedelta(hours=SWEEP_INTERVAL)], id='sweep_orphaned_resources')
+scheduler.add_job(run_exclusive, 'interval', hours=1, args=['delete_expired_sessions', delete_expired_sessions, timedelta(hours=1)], id='delete_expired_sessions')
@@ -1,8 +1,8 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Table, LargeBinary, Boolean, event, Text
+from sqlalchemy import BigInteger, Column, Float, Identity, Index, Integer, String, ForeignKey, DateTime, Table, LargeBinary, Boolean, event, Text
 from sqlalchemy.orm import relationship, backref
 from database.base import Base
 from datetime import datetime
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import UUID, JSONB
 
 from database.utils import set_created, set_last_modified
 from util_functions.functions import current_time_prague
@@ -29,6 +29,7 @@ class User(Base):
   last_modified = Column(DateTime,
                          default=current_time_prague(),
                          onupdate=current_time_prague())
+  __table_args__ = (Index('ix_users_created_id', 'created', 'id'),) # Keyset pagination (see `services.sql_service._keyset_page`)
 event.listen(User, 'before_insert', set_created)
 event.listen(User, 'before_update', set_last_modified)
 
@@ -72,11 +73,20 @@ event.listen(Module, 'before_update', set_last_modified)
 class TokenUsage(Base):
   __tablename__ = 'token_usage'
   id = Column(UUID(as_uuid=True), primary_key=True, index=True)
+  run_id = Column(String(64), nullable=True, index=True)
+  chat_session_id = Column(UUID(as_uuid=True), ForeignKey('chat_sessions.id', ondelete='SET NULL'), nullable=True, index=True)
+  agent_id = Column(UUID(as_uuid=True), ForeignKey('agents.id', ondelete='SET NULL'), nullable=True, index=True)
+  module_id = Column(UUID(as_uuid=True), ForeignKey('modules.id', ondelete='SET NULL'), nullable=True, index=True)
+  model = Column(String(64), nullable=True)
   input_tokens = Column(Integer)
   output_tokens = Column(Integer)
-  input_cost = Column(Integer)
-  output_cost = Column(Integer)
+  input_cost = Column(Integer) # Micro-USD
+  output_cost = Column(Integer) # Micro-USD
   date = Column(DateTime, default=current_time_prague())
+  created = Column(DateTime, default=current_time_prague())
+  last_modified = Column(DateTime,
+                         default=current_time_prague(),
+                         onupdate=current_time_prague())
 event.listen(TokenUsage, 'before_insert', set_created)
 event.listen(TokenUsage, 'before_update', set_last_modified)
 
@@ -122,14 +132,42 @@ class ChatSession(Base):
   analysis = Column(String, nullable=True, index=True)
   last_agent = Column(UUID(as_uuid=True), ForeignKey('agents.id', ondelete='SET NULL'), nullable=True)
   messages_len = Column(Integer, nullable=True, default=0)
+  mirrored = Column(Boolean, nullable=False, default=False, server_default='false') # Whether all thread messages are mirrored in `chat_messages`
+  messages = relationship('ChatMessage', back_populates='chat_session', cascade='all, delete-orphan', passive_deletes=True)
   created = Column(DateTime, default=current_time_prague())
   last_modified = Column(DateTime,
                          default=current_time_prague(),
-                         onupdate=current_time_prague())
+                         onupdate=current_time_prague(),
+                         index=True) # Retention (see `database.database.delete_old_chat_sessions`)
+  __table_args__ = (Index('ix_chat_sessions_userID_created_id', 'userID', 'created', 'id'),) # Keyset pagination (see `services.sql_service._keyset_page`)
 event.listen(ChatSession, 'before_insert', set_created)
 event.listen(ChatSession, 'before_update', set_last_modified)
 
 
+class ChatMessage(Base):
+  """
+  Local mirror of the messages of an OpenAI thread, so transcripts are read without calling OpenAI.
+  `seq` orders the messages of a thread and is used as the pagination cursor.
+  """
+  __tablename__ = 'chat_messages'
+  id = Column(UUID(as_uuid=True), primary_key=True, index=True)
+  seq = Column(BigInteger, Identity(), nullable=False, unique=True)
+  chat_session_id = Column(UUID(as_uuid=True), ForeignKey('chat_sessions.id', ondelete='CASCADE'), nullable=False)
+  chat_session = relationship('ChatSession', back_populates='messages')
+  message_id = Column(String(64), nullable=False, unique=True)
+  role = Column(String(16), nullable=False)
+  content = Column(JSONB, nullable=False)
+  attachments = Column(JSONB, nullable=True)
+  created_at = Column(Integer, nullable=True) # Unix timestamp reported by OpenAI
+  created = Column(DateTime, default=current_time_prague())
+  last_modified = Column(DateTime,
+                         default=current_time_prague(),
+                         onupdate=current_time_prague())
+  __table_args__ = (Index('ix_chat_messages_chat_session_id_seq', 'chat_session_id', 'seq'),)
+event.listen(ChatMessage, 'before_insert', set_created)
+event.listen(ChatMessage, 'before_update', set_last_modified)
+
+
 class Document(Base):
   __tablename__ = "documents"
   id = Column(UUID(as_uuid=True), primary_key=True, index=True)
@@ -139,7 +177,10 @@ class Document(Base):
   fileType = Column(Text)
   images = Column(Boolean, default=False)
   content_hash = Column(String(64), unique=True)
-  extracted_images = relationship('Extracted_Img', back_populates='Document', cascade='all, delete-orphan')
+  # Set instead of `content_hash` when another document already holds the hash (see `services.sql_service.set_document_content_hash`)
+  duplicate_of = Column(UUID(as_uuid=True), ForeignKey('documents.id', ondelete='SET NULL'), nullable=True)
+  original = relationship('Document', remote_side=[id], foreign_keys=[duplicate_of])
+  extracted_images = relationship('Extracted_Img', back_populates='file', cascade='all, delete-orphan')
   agents = relationship("Agent",
                         secondary='agent_file',
                         back_populates='documents')
@@ -148,10 +189,71 @@ class Document(Base):
   last_modified = Column(DateTime,
                          default=current_time_prague(),
                          onupdate=current_time_prague())
+  __table_args__ = (Index('ix_documents_created_id', 'created', 'id'),) # Keyset pagination (see `services.sql_service._keyset_page`)
 event.listen(Document, 'before_insert', set_created)
 event.listen(Document, 'before_update', set_last_modified)
 
 
+# Maps document content to the OpenAI file it was uploaded as, so each file is uploaded to OpenAI only once.
+class OpenAIFile(Base):
+  __tablename__ = 'openai_files'
+  content_hash = Column(String(64), primary_key=True, index=True)
+  file_id = Column(String(64), unique=True, nullable=False)
+  filename = Column(String, nullable=True)
+  last_validated = Column(DateTime, default=current_time_prague())
+  created = Column(DateTime, default=current_time_prague())
+  last_modified = Column(DateTime,
+                         default=current_time_prague(),
+                         onupdate=current_time_prague())
+event.listen(OpenAIFile, 'before_insert', set_created)
+event.listen(OpenAIFile, 'before_update', set_last_modified)
+
+
+# Outbox of OpenAI resources to be deleted, drained by `services.cleanup_service`.
+class CleanupTask(Base):
+  __tablename__ = 'cleanup_tasks'
+  resource_type = Column(String(16), primary_key=True) # 'assistant', 'file', 'vector_store' or 'thread'
+  resource_id = Column(String(64), primary_key=True)
+  attempts = Column(Integer, nullable=False, default=0)
+  next_attempt_at = Column(DateTime, nullable=False, index=True)
+  last_error = Column(String, nullable=True)
+  created = Column(DateTime, default=current_time_prague())
+  last_modified = Column(DateTime,
+                         default=current_time_prague(),
+                         onupdate=current_time_prague())
+event.listen(CleanupTask, 'before_insert', set_created)
+event.listen(CleanupTask, 'before_update', set_last_modified)
+
+
+# Chat and agent session state, the `chat_session` and `agent_session` cookies only hold the handle (see `services.session_store`).
+# Rows are never updated, every change of a session is stored under a new handle.
+class SessionState(Base):
+  __tablename__ = 'session_states'
+  handle = Column(String(32), primary_key=True)
+  kind = Column(String(16), nullable=False) # 'chat' or 'agent'
+  data = Column(JSONB, nullable=False)
+  expires = Column(DateTime, nullable=False, index=True)
+  created = Column(DateTime, nullable=False)
+
+
+# Last run of each scheduled job, written by the instance that held the job's advisory lock (see `database.database.run_exclusive`).
+class JobRun(Base):
+  __tablename__ = 'job_runs'
+  name = Column(String(64), primary_key=True)
+  last_started = Column(DateTime, nullable=False)
+  last_duration = Column(Float, nullable=True) # seconds
+  last_status = Column(String(16), nullable=False) # 'success' or 'failed'
+  last_error = Column(String, nullable=True)
+  runs = Column(Integer, nullable=False, default=0)
+  details = Column(JSONB, nullable=True) # Progress or result reported by the job
+  created = Column(DateTime, default=current_time_prague())
+  last_modified = Column(DateTime,
+                         default=current_time_prague(),
+                         onupdate=current_time_prague())
+event.listen(JobRun, 'before_insert', set_created)
+event.listen(JobRun, 'before_update', set_last_modified)
+
+
 class Extracted_Img(Base):
        __tablename__ = 'extracted_images'
        id = Column(UUID(as_uuid=True), primary_key=True, index=True)
@@ -185,12 +287,63 @@ class Agent(Base):
   chat_sessions = relationship('ChatSession',
                                secondary='agent_chat',
                                back_populates='agents')
+  assistants = relationship('AgentAssistant', back_populates='agent', cascade='all, delete-orphan')
+  vector_store = relationship('VectorStore', back_populates='agent', uselist=False, cascade='all, delete-orphan')
   created = Column(DateTime, default=current_time_prague())
   last_modified = Column(DateTime,
                          default=current_time_prague(),
                          onupdate=current_time_prague())
+  __table_args__ = (Index('ix_agents_module_id_created_id', 'module_id', 'created', 'id'),) # Keyset pagination (see `services.sql_service._keyset_page`)
 event.listen(Agent, 'before_insert', set_created)
 event.listen(Agent, 'before_update', set_last_modified)
+
+
+# Long-lived OpenAI assistants shared across chats, keyed by a hash of the agent's configuration.
+class AgentAssistant(Base):
+  __tablename__ = 'agent_assistants'
+  id = Column(UUID(as_uuid=True), primary_key=True, index=True)
+  agent_id = Column(UUID(as_uuid=True), ForeignKey('agents.id', ondelete='CASCADE'), nullable=False, index=True)
+  agent = relationship('Agent', back_populates='assistants')
+  config_hash = Column(String(64), unique=True, index=True, nullable=False)
+  oai_assistant_id = Column(String(64), unique=True, nullable=False)
+  vector_store_id = Column(String(64), nullable=True)
+  file_ids = Column(JSONB, nullable=True)
+  created = Column(DateTime, default=current_time_prague())
+  last_modified = Column(DateTime,
+                         default=current_time_prague(),
+                         onupdate=current_time_prague())
+event.listen(AgentAssistant, 'before_insert', set_created)
+event.listen(AgentAssistant, 'before_update', set_last_modified)
+
+
+# Long-lived OpenAI vector store holding an agent's documents. Kept in sync with the agent's document set file by file.
+class VectorStore(Base):
+  __tablename__ = 'vector_stores'
+  id = Column(UUID(as_uuid=True), primary_key=True, index=True)
+  agent_id = Column(UUID(as_uuid=True), ForeignKey('agents.id', ondelete='CASCADE'), nullable=False, unique=True, index=True)
+  agent = relationship('Agent', back_populates='vector_store')
+  vector_store_id = Column(String(64), unique=True, nullable=False)
+  files = relationship('VectorStoreFile', back_populates='vector_store', cascade='all, delete-orphan')
+  created = Column(DateTime, default=current_time_prague())
+  last_modified = Column(DateTime,
+                         default=current_time_prague(),
+                         onupdate=current_time_prague())
+event.listen(VectorStore, 'before_insert', set_created)
+event.listen(VectorStore, 'before_update', set_last_modified)
+
+
+class VectorStoreFile(Base):
+  __tablename__ = 'vector_store_files'
+  vector_store_id = Column(UUID(as_uuid=True), ForeignKey('vector_stores.id', ondelete='CASCADE'), primary_key=True)
+  vector_store = relationship('VectorStore', back_populates='files')
+  file_id = Column(String(64), primary_key=True)
+  document_id = Column(UUID(as_uuid=True), nullable=True)
+  created = Column(DateTime, default=current_time_prague())
+  last_modified = Column(DateTime,
+                         default=current_time_prague(),
+                         onupdate=current_time_prague())
+event.listen(VectorStoreFile, 'before_insert', set_created)
+event.listen(VectorStoreFile, 'before_update', set_last_modified)
   
 
 agent_file_table = Table(
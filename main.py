@@ -4,7 +4,10 @@ from flask import Flask
 from flask_cors import CORS
 import config
 from routes import routes
+from routes.async_routes import create_asgi_app
+from services.cleanup_service import start_cleanup_worker
 from services.session_service import check_session_validation
+from util_functions.json_functions import FastJSONProvider
 from database.database import engine, seed_buckets, seed_data, upload_documents
 from database.base import Base
 import database.models
@@ -15,6 +18,7 @@ import pytz
 load_dotenv()
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 CORS(app,
      supports_credentials=True,
      origins=config.ALLOWED_ORIGINS)
@@ -34,5 +38,11 @@ app.before_request(check_session_validation)
 
 routes.register_routes(app)
 
+# Drains the queue of OpenAI resources to be deleted (see services.cleanup_service)
+start_cleanup_worker()
+
+# ASGI entry point serving the chat streams on the event loop (uvicorn main:asgi_app)
+asgi_app = create_asgi_app(app)
+
 if __name__ == "__main__":
   app.run(host='0.0.0.0', port=81)
@@ -1,9 +1,10 @@
 import logging
 from flask import Blueprint, request, jsonify
 from config import OPENAI_CLIENT as client
-from services.sql_service import get_agent_data, get_director_agent_info, upload_agent_metadata, retrieve_all_agents, delete_agent, update_agent, upload_files_metadata
+from services.sql_service import get_agent_data, get_director_agent_info, upload_agent_metadata, retrieve_agents_page, retrieve_all_agents, delete_agent, update_agent, upload_files_metadata
 from services.storage_service import delete_files, upload_file
-from util_functions.functions import get_module_session
+from util_functions.agent_functions import sync_agent_vector_store
+from util_functions.functions import get_module_session, get_page_args
 from util_functions.storage_functions import parseImagesFromFile, upload_files_and_parse_images
 
 
@@ -87,13 +88,20 @@ def create_agent():
 @agent_bp.route('/agent/db/get_all', methods=['GET'])
 def get_all_agents():
   """
-  Retrieves all agents from the database. Requires an established assistant session.
+  Retrieves all agents from the database. Requires an established assistant session. Passing any of the parameters below
+  returns a single page of agents, newest first.
 
   URL:
   - GET /agent/db/get_all
 
+  Parameters:
+      limit (int): The maximum number of agents returned, at most `PAGE_SIZE_MAX`. Defaults to `PAGE_SIZE_DEFAULT`.
+      cursor (str): The `next_cursor` of the previous page.
+      created_after (str): Only agents created at or after this ISO date.
+      created_before (str): Only agents created before this ISO date.
+
   Returns:
-      JSON response (dict): A list of retrieved agents or an error message.
+      JSON response (dict): A list of retrieved agents or an error message. Pages also hold `next_cursor`, null on the last page.
 
   Status Codes:
       200 OK: All agents retrieved successfully.
@@ -107,6 +115,16 @@ def get_all_agents():
   if not module_session:
     print("No assistant selected.")
     return jsonify({'error': 'Invalid assistant session.'}), 401
+  try:
+    page_args = get_page_args()
+  except ValueError as e:
+    return jsonify({'error': str(e)}), 400
+  if page_args is not None:
+    page = retrieve_agents_page(module_session['Id'], **page_args)
+    if page is None:
+      return jsonify({'error': 'An error occurred while retrieving agents.'}), 400
+    return jsonify({"message": "Retrieved agents.", "agents": page['Items'], 'next_cursor': page['NextCursor']}), 200
+
   agents = retrieve_all_agents(module_session['Id'])
   if agents is None:
     return jsonify({'error': 'An error occurred while retrieving agents.'}), 400
@@ -181,6 +199,8 @@ def update_agent_route():
 
   Notes:
       - Calls `update_agent` to update agent details and `upload_files` for new file uploads.
+      - The agent's vector store is synced afterwards, only added or removed documents are sent to OpenAI.
+        Documents that could not be provided to OpenAI are listed in `file_errors`.
   """
   agent_id = request.form.get('agent_id')
   name = request.form.get('name')
@@ -235,14 +255,20 @@ def update_agent_route():
   if update is None:
     return jsonify({'error': 'An error occurred while updating the agent.'}), 400
   
+  sync_errors = []
+  agent_data = get_agent_data(agent_id)
+  if agent_data:
+    vs_id, sync_errors = sync_agent_vector_store(agent_data)
+  
   if uploaded_files:
      return jsonify({
       "message": "Agent updated successfully.",
       "agent": update,
-      "files": uploaded_files
+      "files": uploaded_files,
+      "file_errors": sync_errors
     }), 200
 
-  return jsonify({'message': 'Agent updated successfully.', 'agent': update}), 200
+  return jsonify({'message': 'Agent updated successfully.', 'agent': update, 'file_errors': sync_errors}), 200
 
 
 @agent_bp.route('/director_agent', methods=['GET'])
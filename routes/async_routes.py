@@ -0,0 +1,231 @@
+import asyncio
+import json
+import logging
+import time
+from http.cookies import SimpleCookie
+from asgiref.wsgi import WsgiToAsgi
+from openai._exceptions import APIError
+from werkzeug.http import dump_cookie
+from config import ALLOWED_ORIGINS, SESSION_STORE_TTL, user_session_serializer
+from services.async_openai_service import chat_ta_events_async
+from services.session_store import agent_sessions, chat_sessions
+from services.openai_service import AGENT_SWITCH_EVENT, DONE_EVENT, ERROR_EVENT, SSE_HEADERS, TEXT_EVENT, TOOL_EVENT
+from util_functions.agent_functions import refresh_agent_session
+from util_functions.functions import TimeoutException
+from util_functions.stream_functions import format_sse
+
+# path: requires a valid user session (mirrors the exemptions of `check_session_validation`)
+ASYNC_CHAT_ROUTES = {
+  '/openai/chat': False,
+  '/openai/chat/sse': True,
+}
+
+
+def create_asgi_app(wsgi_app):
+  """
+  Creates the ASGI entry point of the API. The chat streaming endpoints are served natively on the event loop through
+  `chat_ta_events_async`, so a stream waiting on OpenAI holds no worker thread. Every other request, including the CORS
+  preflight of the chat endpoints, is passed to the Flask application.
+
+  Parameters:
+      wsgi_app (Flask): The Flask application instance.
+
+  Returns:
+      Callable: The ASGI application.
+
+  Usage:
+      uvicorn main:asgi_app --host 0.0.0.0 --port 81
+  """
+  fallback = WsgiToAsgi(wsgi_app)
+
+  async def asgi_app(scope, receive, send):
+    if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] in ASYNC_CHAT_ROUTES:
+      await _chat(scope, receive, send, sse=scope['path'].endswith('/sse'), require_user=ASYNC_CHAT_ROUTES[scope['path']])
+      return
+    await fallback(scope, receive, send)
+
+  return asgi_app
+
+
+def _get_header(scope, name: bytes):
+  for key, value in scope['headers']:
+    if key == name:
+      return value.decode('latin-1')
+  return None
+
+
+def _load_cookie(cookies: SimpleCookie, name: str, serializer):
+  morsel = cookies.get(name)
+  if morsel is None or not morsel.value:
+    return None
+  try:
+    return serializer.loads(morsel.value)
+  except Exception:
+    return None
+
+
+def _response_headers(scope, content_type: str, extra: dict=None):
+  headers = [(b'content-type', content_type.encode('latin-1'))]
+  origin = _get_header(scope, b'origin')
+  if origin and origin in ALLOWED_ORIGINS:
+    headers.append((b'access-control-allow-origin', origin.encode('latin-1')))
+    headers.append((b'access-control-allow-credentials', b'true'))
+    headers.append((b'vary', b'Origin'))
+  for key, value in (extra or {}).items():
+    headers.append((key.lower().encode('latin-1'), value.encode('latin-1')))
+  return headers
+
+
+async def _send_json(scope, send, data: dict, status: int):
+  await send({'type': 'http.response.start', 'status': status, 'headers': _response_headers(scope, 'application/json')})
+  await send({'type': 'http.response.body', 'body': json.dumps(data).encode('utf-8')})
+
+
+async def _read_body(receive):
+  body = b''
+  while True:
+    message = await receive()
+    if message['type'] == 'http.disconnect':
+      return None
+    body += message.get('body', b'')
+    if not message.get('more_body', False):
+      return body
+
+
+async def _chat(scope, receive, send, sse: bool, require_user: bool):
+  """
+  Async counterpart of the `/openai/chat` and `/openai/chat/sse` Flask routes with the same cookies, payload and output.
+  """
+  start = time.time()
+  cookies = SimpleCookie()
+  cookies.load(_get_header(scope, b'cookie') or '')
+
+  if require_user:
+    if not cookies.get('user_session'):
+      await _send_json(scope, send, {'error': 'No session data.'}, 401)
+      return
+    if _load_cookie(cookies, 'user_session', user_session_serializer) is None:
+      await _send_json(scope, send, {'error': 'Invalid or expired session data.'}, 401)
+      return
+
+  body = await _read_body(receive)
+  if body is None:
+    return
+  try:
+    payload = json.loads(body or b'{}')
+  except ValueError:
+    await _send_json(scope, send, {'error': 'Invalid request payload.'}, 400)
+    return
+
+  user_input = payload.get('message') if isinstance(payload, dict) else None
+  if not user_input:
+    await _send_json(scope, send, {'error': 'Missing required fields.'}, 400)
+    return
+
+  # Chat and agent sessions are stored server-side, resolving their handles may query the database.
+  chat_session = await asyncio.to_thread(_load_cookie, cookies, 'chat_session', chat_sessions)
+  if chat_session is None or 'agent_ids' not in chat_session or 'thread_id' not in chat_session:
+    await _send_json(scope, send, {'error': 'Error resolving chat cookie.'}, 400)
+    return
+  agent_session = await asyncio.to_thread(_load_cookie, cookies, 'agent_session', agent_sessions)
+  if agent_session is None or 'oai_agent_id' not in agent_session:
+    await _send_json(scope, send, {'error': 'Failed to resolve agent cookie'}, 400)
+    return
+  # The agent may have been updated or deleted since the cookie was set, its old assistant is then queued for deletion
+  refreshed = await asyncio.to_thread(refresh_agent_session, agent_session)
+  if refreshed is None:
+    await _send_json(scope, send, {'error': 'Failed to resolve agent'}, 400)
+    return
+  extra_headers = {}
+  if refreshed is not agent_session:
+    agent_session = refreshed
+    agent_cookie = await asyncio.to_thread(agent_sessions.dumps, agent_session)
+    extra_headers['set-cookie'] = dump_cookie('agent_session', agent_cookie, httponly=True, secure=True, samesite='None', max_age=SESSION_STORE_TTL)
+
+  events = chat_ta_events_async(assistant_id=agent_session['oai_agent_id'], thread_id=chat_session['thread_id'],
+                                user_input=user_input, agent_session=agent_session,
+                                usage_context={'chat_session_id': chat_session.get('chat_id'), 'agent_id': agent_session.get('agent_id')})
+  if sse:
+    await send({'type': 'http.response.start', 'status': 200, 'headers': _response_headers(scope, 'text/event-stream', {**SSE_HEADERS, **extra_headers})})
+    frames = _sse_frames(events)
+  else:
+    await send({'type': 'http.response.start', 'status': 200, 'headers': _response_headers(scope, 'text/plain', extra_headers)})
+    frames = _plain_frames(events)
+
+  async def stream_frames():
+    async for frame in frames:
+      await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+  # The stream is cancelled as soon as the client disconnects, which in turn cancels the OpenAI run (see `RunGuard`).
+  streaming = asyncio.ensure_future(stream_frames())
+  disconnect = asyncio.ensure_future(_wait_for_disconnect(receive))
+  try:
+    await asyncio.wait({streaming, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+    if not streaming.done():
+      logging.info('Client disconnected from the chat stream.')
+      streaming.cancel()
+    try:
+      await streaming
+    except (asyncio.CancelledError, OSError):
+      pass
+  finally:
+    disconnect.cancel()
+    await frames.aclose()
+    end = time.time()
+    logging.info(f'Interaction took {end - start} seconds')
+
+
+async def _wait_for_disconnect(receive):
+  while True:
+    message = await receive()
+    if message['type'] == 'http.disconnect':
+      return
+
+
+async def _plain_frames(events):
+  """
+  Formats the events like `chat_ta` and the plain `/openai/chat` route.
+  """
+  try:
+    async for event_type, data in events:
+      if event_type == TEXT_EVENT:
+        yield data
+      elif event_type in (TOOL_EVENT, ERROR_EVENT, AGENT_SWITCH_EVENT):
+        yield json.dumps(data)
+  except TimeoutException as e:
+    logging.error(f'Error obtaining response. Operation timed out. {e}')
+    yield json.dumps({'error': 'Operation timed out.', 'status_code': 408})
+  except APIError as e:
+    logging.error(f'Error occurred while processing chat message: {e}')
+    yield json.dumps({'error': f'An error occurred while communicating with the agent. {e}', 'status_code': 400})
+  except Exception as e:
+    logging.error(f'Error occurred while processing chat message: {e}')
+    yield json.dumps({'error': f'An error occurred while communicating with the agent. {e}', 'status_code': 400})
+  finally:
+    await events.aclose()
+
+
+async def _sse_frames(events):
+  """
+  Formats the events like `chat_sse`.
+  """
+  event_id = 0
+  try:
+    async for event_type, data in events:
+      event_id += 1
+      yield format_sse(event_type, {'text': data} if event_type == TEXT_EVENT else data, event_id)
+  except TimeoutException as e:
+    logging.error(f'Error obtaining response. Operation timed out. {e}')
+    yield format_sse(ERROR_EVENT, {'error': 'Operation timed out.', 'status_code': 408}, event_id + 1)
+    yield format_sse(DONE_EVENT, {}, event_id + 2)
+  except APIError as e:
+    logging.error(f'Error occurred while processing chat message: {e}')
+    yield format_sse(ERROR_EVENT, {'error': f'An error occurred while communicating with the agent. {e}', 'status_code': 400}, event_id + 1)
+    yield format_sse(DONE_EVENT, {}, event_id + 2)
+  except Exception as e:
+    logging.error(f'Error occurred while processing chat message: {e}')
+    yield format_sse(ERROR_EVENT, {'error': f'An error occurred while communicating with the agent. {e}', 'status_code': 400}, event_id + 1)
+    yield format_sse(DONE_EVENT, {}, event_id + 2)
+  finally:
+    await events.aclose()
@@ -1,14 +1,15 @@
 import logging
 from flask import Blueprint, request, jsonify, send_file
 from flask.helpers import make_response
-from services.sql_service import get_all_files, delete_doc, get_file, upload_files, upload_files_metadata
+from services.sql_service import get_agent_data, get_all_files, get_files_page, delete_doc, get_document_agent_ids, get_file, upload_files, upload_files_metadata
 import io
 import uuid
 import os
 import fitz  # PyMuPDF
 from docx import Document
 from services.storage_service import delete_files, serve_file, upload_file
-from util_functions.functions import roles_required, get_module_session
+from util_functions.agent_functions import sync_agent_vector_store
+from util_functions.functions import roles_required, get_module_session, get_page_args
 import mammoth
 
 from util_functions.storage_functions import parseImagesFromFile
@@ -80,13 +81,19 @@ def upload_documents():
 @roles_required('admin', 'master', 'worker')
 def get_documents():
   """
-  Retrieves all documents metadata from the database.
+  Retrieves all documents metadata from the database. Passing any of the parameters below returns a single page of documents, newest first.
 
   URL:
   - GET /documents
 
+  Parameters:
+      limit (int): The maximum number of documents returned, at most `PAGE_SIZE_MAX`. Defaults to `PAGE_SIZE_DEFAULT`.
+      cursor (str): The `next_cursor` of the previous page.
+      created_after (str): Only documents uploaded at or after this ISO date.
+      created_before (str): Only documents uploaded before this ISO date.
+
   Returns:
-      JSON response (dict): A list of all documents or an error message.
+      JSON response (dict): A list of all documents or an error message. Pages also hold `next_cursor`, null on the last page.
 
   Status Codes:
       200 OK: Documents retrieved successfully.
@@ -100,6 +107,16 @@ def get_documents():
   if module_session is None or not module_session:
     return jsonify({'error': 'Invalid module session.'}), 401
   
+  try:
+    page_args = get_page_args()
+  except ValueError as e:
+    return jsonify({'error': str(e)}), 400
+  if page_args is not None:
+    page = get_files_page(str(module_session['Id']), **page_args)
+    if page is None:
+      return jsonify({'error': 'An error occurred while retrieving documents.'}), 400
+    return jsonify({"files": page['Items'], 'next_cursor': page['NextCursor']}), 200
+
   files = get_all_files(str(module_session['Id']))
   if files is None:
     return jsonify({'error':
@@ -161,7 +178,8 @@ def get_document():
 @roles_required('admin', 'master', 'worker')
 def destroy_document():
   """
-  Deletes a document from the database using the specified file ID. The file is also deleted from the Supabase storage.
+  Deletes a document from the database using the specified file ID. The file is also deleted from the Supabase storage
+  and removed from the vector stores of the agents that used it.
 
   URL:
   - DELETE /documents
@@ -186,10 +204,18 @@ def destroy_document():
     return jsonify({'error': 'Invalid module session.'}), 401
   
   module_id = str(module_session['Id'])
+  agent_ids = get_document_agent_ids(file_id)
   docId, file_key = delete_doc(file_id, module_id=module_id)
   if docId is None:
     return jsonify({'error':
                     'An error occurred while deleting the file.'}), 400
+  
+  for agent_id in agent_ids:
+    agent_data = get_agent_data(agent_id)
+    if agent_data:
+      vs_id, sync_errors = sync_agent_vector_store(agent_data)
+      if sync_errors:
+        logging.error(f'Failed to sync vector store of agent {agent_id}: {sync_errors}')
     
   sb_delete, status = delete_files(file_keys=[file_key])
   
@@ -3,11 +3,11 @@ from flask.blueprints import Blueprint
 from flask.json import jsonify
 from flask import request
 from openai._exceptions import NotFoundError
-from config import OPENAI_CLIENT as client, chat_session_serializer, agent_session_serializer
+from config import chat_session_serializer, agent_session_serializer
 
-from services.sql_service import delete_chat_session, retrieve_chat_sessions
-from util_functions.functions import get_module_session, get_user_info
-from util_functions.oai_functions import convert_attachments, convert_content
+from services.sql_service import delete_chat_session, retrieve_chat_sessions, retrieve_chat_sessions_page
+from util_functions.functions import get_int_arg, get_module_session, get_page_args, get_user_info, is_valid_uuid
+from util_functions.oai_functions import get_thread_messages
 
 
 history_bp = Blueprint('history', __name__)
@@ -15,19 +15,40 @@ history_bp = Blueprint('history', __name__)
 @history_bp.route('/history/user', methods=['GET'])
 def get_user_history():
     """
-    Retrieves the user history of the currently selected module and logged in user.
+    Retrieves the user history of the currently selected module and logged in user. Passing any of the parameters below
+    returns a single page of chat sessions, newest first.
     
     URL:
     - GET /history/user
     
+    Parameters:
+        limit (int): The maximum number of chat sessions returned, at most `PAGE_SIZE_MAX`. Defaults to `PAGE_SIZE_DEFAULT`.
+        cursor (str): The `next_cursor` of the previous page.
+        module_id (str): Only chat sessions held in this module.
+        created_after (str): Only chat sessions started at or after this ISO date.
+        created_before (str): Only chat sessions started before this ISO date.
+    
     Returns:
-        JSON response: A flask response object containing a status message and a list of ChatSession objects.
+        JSON response: A flask response object containing a status message and a list of ChatSession objects. Pages also hold
+        `next_cursor`, null on the last page.
     
     Status Codes:
         200 OK: Retrieved user history.
         400 Bad Request: An error occurred while retrieving the history.
     """
     user_session = get_user_info()
+    try:
+        page_args = get_page_args('module_id')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if page_args is not None:
+        if page_args['module_id'] and not is_valid_uuid(page_args['module_id']):
+            return jsonify({'error': 'Invalid module_id format.'}), 400
+        page = retrieve_chat_sessions_page(user_id=user_session['Id'], **page_args)
+        if page is None:
+            return jsonify({'error': 'Failed to retrieve chat sessions.'}), 400
+        return jsonify({'message': 'Retrieved user chat sessions.', 'data': page['Items'], 'next_cursor': page['NextCursor']}), 200
+
     chat_sessions = retrieve_chat_sessions(user_id=user_session['Id'])
     
     if chat_sessions is None:
@@ -41,26 +62,37 @@ def get_user_history():
 @history_bp.route('/history/dialog', methods=['GET'])
 def get_chat_dialog():
     """
-    Retrieves the dialog of an OpenAI thread and returns its contents.
+    Retrieves the dialog of an OpenAI thread and returns its contents. The messages are read from the local mirror,
+    threads created before the mirror existed are backfilled from OpenAI on their first read.
     
     URL:
     - GET /history/dialog
     
     Parameters:
         thread_id (str): The ID of the thread the desired messages belong to.
+        limit (int): The maximum number of messages returned, at most 100. Defaults to 50.
+        before (int): The `next_cursor` of the previous page, to page back through the dialog. Omit for the latest messages.
+        Malformed or out of range values of `limit` and `before` are rejected with 400.
     
     Returns:
-        JSON response: A flask response object containing a status message and a list of message objects.
+        JSON response: A flask response object containing a status message, a list of message objects in chronological order
+        and `next_cursor`, the cursor of the previous (older) page or null if there are no older messages.
     
     Status Codes:
         200 OK: Messages retrieved.
         400 Bad Request: An error occurred while retrieving the messages.
+        404 Not Found: The dialog could not be found.
     """
     thread_id = request.args.get('thread_id')
     if not thread_id:
         return jsonify({'error': 'Missing required fields.'}), 400
     try:
-        thread_messages = client.beta.threads.messages.list(thread_id=thread_id)
+        limit = get_int_arg('limit', 50, minimum=1, maximum=100)
+        before = get_int_arg('before', minimum=0)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        page = get_thread_messages(thread_id=thread_id, limit=limit, before=before)
     except NotFoundError as e:
         logging.error(f'{e}')
         return jsonify({'error': 'Could not find dialog.'}), 404
@@ -68,23 +100,10 @@ def get_chat_dialog():
         logging.error(f'{e}')
         return jsonify({'error': 'Failed to retrieve dialog.'}), 400
     
-    if thread_messages:
-        messages_list = []
-        for msg in thread_messages:
-            message_dict = {
-                'Id': msg.id,
-                'Created': msg.created_at,
-                'Role': msg.role,
-                'Content': convert_content(msg.content),
-                'Attachments': convert_attachments(msg.attachments)
-            }
-            messages_list.append(message_dict)
-          
-        messages_list.reverse()
-        
-        return jsonify({'message': 'Retrieved thread messages', 'messages': messages_list}), 200
-    else:
-        return jsonify({'error': 'Failed to obtain thread messages.'}), 400
+    if page is None:
+        return jsonify({'error': 'Could not find dialog.'}), 404
+    
+    return jsonify({'message': 'Retrieved thread messages', 'messages': page['Messages'], 'next_cursor': page['NextCursor']}), 200
     
 @history_bp.route('/history/dialog', methods=['DELETE'])
 def delete_chat_history():
@@ -3,7 +3,7 @@ import requests
 from services.openai_service import safely_end_chat_session
 from services.storage_service import delete_files
 from util_functions.functions import check_module_permission, check_user_modules, decrypt_token, encrypt_token, get_agent_session, get_chat_session, get_module_session, roles_required, get_user_info, check_user_projects, check_admin
-from services.sql_service import create_new_module, delete_module, get_all_files, get_all_modules, get_module_by_id, update_module, upload_agent_metadata
+from services.sql_service import create_new_module, delete_module, get_all_modules, get_module_by_id, update_module, upload_agent_metadata
 from config import FERNET_KEY, module_session_serializer
 
 module_bp = Blueprint('module', __name__)
@@ -192,14 +192,11 @@ def delete_module_route():
       Requires the `Admin` role for deleting assistants.
   """
   module_id = request.json.get('module_id')
-  files = get_all_files(module_id=module_id)
-  delete = delete_module(module_id)
+  delete, file_keys = delete_module(module_id)
   if not delete:
       return jsonify({'message': 'Could not delete module.'}), 400
-  if files:
-      file_keys = []
-      for file in files:
-          file_keys.append(file['URL'])
+  # Only files of documents no other module relates to are removed, after the database transaction is committed.
+  if file_keys:
       deleted, status = delete_files(file_keys)
       if status == False and not deleted:
           return jsonify({'message': 'Module deleted from the database but all related files failed to be removed.'}), 400
@@ -1,17 +1,20 @@
 import json
 import logging
 import time
+from contextlib import closing
 from flask import Blueprint, jsonify, request, g, current_app, after_this_request
 from flask.helpers import make_response, stream_with_context
 from flask.wrappers import Response
 from openai._exceptions import APIError
-from config import OPENAI_CLIENT as client, chat_session_serializer, agent_session_serializer
+from config import OPENAI_CLIENT as client, SESSION_STORE_TTL
+from services.session_store import agent_sessions, chat_sessions
 from services.sql_service import get_analytic_agent, get_module_by_id, get_summarizer_agent, update_chat_session
 from util_functions.functions import CustomResponse, TimeoutException, get_agent_session, get_chat_session, get_module_session
-from services.openai_service import batch_delete_agents, batch_delete_files, chat_ta, chat_util_agent, create_agent, delete_agent, initialize_agent_chat, safely_end_chat_session
+from services.openai_service import SSE_HEADERS, batch_delete_agents, batch_delete_files, chat_sse, chat_ta, chat_ta_events, chat_util_agent, create_agent, delete_agent, initialize_agent_chat, safely_end_chat_session
 from openai import NotFoundError
 
-from util_functions.oai_functions import check_switch_agent, convert_attachments, convert_content, convert_content 
+from util_functions.agent_functions import refresh_agent_session
+from util_functions.oai_functions import check_switch_agent, get_thread_messages
 
 openai_bp = Blueprint("openai", __name__)
 
@@ -45,11 +48,7 @@ def initialize():
   if not new_oai_agent_id or new_oai_agent_id is None:
     return jsonify({'error': 'Agent not found'}), 404
   
-  chat_serializer = chat_session_serializer
-  agent_serializer = agent_session_serializer
-  session_data = chat_serializer.dumps({'agent_id': new_oai_agent_id, 'thread_id': thread.id, 'file_ids': file_ids})
-  if isinstance(session_data, bytes):
-    session_data = session_data.decode('utf-8')
+  session_data = chat_sessions.dumps({'agent_id': new_oai_agent_id, 'thread_id': thread.id, 'file_ids': file_ids})
     
   response = make_response(jsonify({'message': 'Created new agent and set its cookie.', 'thread_id': thread.id, 'agent_id': new_oai_agent_id}), 200)
   response.set_cookie('chat_session',
@@ -57,7 +56,7 @@ def initialize():
                       httponly=True,
                       secure=True,
                       samesite='none',
-                      max_age=604800)
+                      max_age=SESSION_STORE_TTL)
 
   return response
 
@@ -85,6 +84,35 @@ def initialize_chat():
       404 Not Found: Agent with the specified ID not found.
       400 Bad Request: Failed to initialize agent or there was an error fetching its response.
   """
+  return _initialize_chat(sse=False)
+
+
+@openai_bp.route('/openai/init_chat/sse', methods=['POST'])
+def initialize_chat_sse():
+  """
+  Server-Sent Events variant of `/openai/init_chat`. Takes the same parameters and sets the same cookies, but streams the
+  response as `text/event-stream` with numbered events instead of mixing text and JSON in plain text.
+  
+  URL:
+  - POST /openai/init_chat/sse
+  
+  Events:
+    text: A chunk of the response, `{"text": "..."}`.
+    tool: The status of a tool call, e.g. `{"action": "file_search", "status": "completed"}`.
+    agent_switch: The cookie data of the agent switched to, to be sent to `/utility/chat_cookies`.
+    usage: The tokens used by a completed run.
+    error: An error, the stream continues after errors with `status_code` 1040.
+    done: The end of the stream.
+    
+  Status Codes:
+      200 OK: Agent initialized, events are streamed.
+      404 Not Found: Agent with the specified ID not found.
+      400 Bad Request: Failed to initialize agent.
+  """
+  return _initialize_chat(sse=True)
+
+
+def _initialize_chat(sse: bool):
   start = time.time()
   agent_id = request.json.get('agent_id')
   thread_id = request.json.get('thread_id')
@@ -107,7 +135,7 @@ def initialize_chat():
   else:
     logging.info(f'Using existing thread: {thread_id}')
     
-  init = initialize_agent_chat(agent_id=agent_id, thread_id=thread_id, user_input=user_input)
+  init = initialize_agent_chat(agent_id=agent_id, thread_id=thread_id, user_input=user_input, sse=sse)
   end = time.time()
   logging.info(f'Complete chat initialization took {end - start} seconds')
   return init
@@ -170,6 +198,26 @@ def openai_chat():
       200 OK: Chat response received successfully.
       400 Bad Request: Invalid request payload or an error occurred.
   """
+  return _chat(sse=False)
+
+
+@openai_bp.route('/openai/chat/sse', methods=['POST'])
+def openai_chat_sse():
+  """
+  Server-Sent Events variant of `/openai/chat`. Takes the same parameters, but streams the response as `text/event-stream`
+  with numbered events (`text`, `tool`, `agent_switch`, `usage`, `error` and `done`, see `/openai/init_chat/sse`).
+
+  URL:
+  - POST /openai/chat/sse
+
+  Status Codes:
+      200 OK: Events are streamed.
+      400 Bad Request: Invalid request payload or the chat and agent cookies could not be resolved.
+  """
+  return _chat(sse=True)
+
+
+def _chat(sse: bool):
   start = time.time()
   user_input = request.json.get('message')
 
@@ -183,18 +231,41 @@ def openai_chat():
   agent_session = get_agent_session()
   if agent_session is None or 'oai_agent_id' not in agent_session:
     return jsonify({'error': 'Failed to resolve agent cookie'}), 400
+  # The agent may have been updated or deleted since the cookie was set, its old assistant is then queued for deletion
+  refreshed = refresh_agent_session(agent_session)
+  if refreshed is None:
+    return jsonify({'error': 'Failed to resolve agent'}), 400
+  if refreshed is not agent_session:
+    agent_session = refreshed
+    agent_cookie = agent_sessions.dumps(agent_session)
+
+    @after_this_request
+    def replace_agent_cookie(response):
+      response.set_cookie('agent_session', agent_cookie, httponly=True, secure=True, samesite='none', max_age=SESSION_STORE_TTL)
+      return response
   
   logging.info(f'Current agent session: {agent_session}')
   logging.info(f'Current chat session: {chat_session}')
+  usage_context = {'chat_session_id': chat_session.get('chat_id'), 'agent_id': agent_session.get('agent_id')}
+  
+  if sse:
+    @stream_with_context
+    def stream_events():
+      yield from chat_sse(chat_ta_events(assistant_id=agent_session['oai_agent_id'], thread_id=chat_session['thread_id'], user_input=user_input, usage_context=usage_context))
+      end = time.time()
+      logging.info(f'Interaction took {end - start} seconds')
+    
+    return Response(stream_events(), content_type='text/event-stream', headers=SSE_HEADERS, status=200)
   
   @stream_with_context
   def stream_response():
     try:
-      for content in chat_ta(assistant_id=agent_session['oai_agent_id'], thread_id=chat_session['thread_id'], user_input=user_input):
-        if isinstance(content, str):
-          yield content
-        elif isinstance(content, dict):
-          yield json.dumps(content)
+      with closing(chat_ta(assistant_id=agent_session['oai_agent_id'], thread_id=chat_session['thread_id'], user_input=user_input, usage_context=usage_context)) as contents:
+        for content in contents:
+          if isinstance(content, str):
+            yield content
+          elif isinstance(content, dict):
+            yield json.dumps(content)
     except TimeoutException as e:
       logging.error(f'Error obtaining response. Operation timed out. {e}')
       yield json.dumps({'error': 'Operation timed out.', 'status_code': 408})
@@ -241,6 +312,7 @@ def check_thread_session():
   Obtains and deserializes the `chat_session` cookie to validate its existence. If it exists, returns its thread_id and current agent_id.
   If the cookie exists and contains partial data, the method 'cleans it up'.
   The method also checks for existing messages on that thread and returns them if present to restore the conversation in the session.
+  The latest page of messages is read from the local mirror, older pages are served by `GET /history/dialog` with `next_cursor`.
   
   URL:
   - GET /openai/check_session
@@ -264,7 +336,7 @@ def check_thread_session():
     agent_id = chat_session['agent_ids'][len(chat_session['agent_ids']) - 1]
     thread_id = chat_session['thread_id']
     try:
-      thread_messages = client.beta.threads.messages.list(thread_id)
+      page = get_thread_messages(thread_id)
     except NotFoundError as e:
       logging.error(f'No thread found with id {thread_id}')
       res_data, status_code = safely_end_chat_session()
@@ -308,27 +380,14 @@ def check_thread_session():
       #           )
       return response
 
-    if thread_messages:
-        messages_list = []
-        for msg in thread_messages:
-          # print(f'message: {msg}')
-          message_dict = {
-              'Id': msg.id,
-              'Created': msg.created_at,
-              'Role': msg.role,
-              'Content': convert_content(msg.content),
-              'Attachments': convert_attachments(msg.attachments)
-          }
-          messages_list.append(message_dict)
-          
-        messages_list.reverse()
-
+    if page is not None:
         return jsonify({
             'message': "Established connection and found an existing chat_session and retrieved its data.",
             'module_name': module_name,
             'agent_id': agent_id,
             'thread_id': thread_id,
-            'messages': messages_list
+            'messages': page['Messages'],
+            'next_cursor': page['NextCursor']
         }), 200
     else:
       return jsonify({'message': "Established connection and found an existing chat_session but failed to retrieve thread messages", 'agent_id': agent_id, 'thread_id': thread_id, 'module_name': module_name}), 200
@@ -358,7 +417,8 @@ def check_thread_session():
 @openai_bp.route('/openai/end_chat', methods=['DELETE'])
 def end_session_chat():
   """
-  Ends the chat session and deletes the chat session cookie. Also deletes all agents and files from OpenAI servers present in the cookie.
+  Ends the chat session and deletes the chat session cookie. Also queues all agents, files and vector stores present in the cookie
+  for deletion from OpenAI servers, they are deleted in the background.
   
   URL:
   - DELETE /openai/end_chat
@@ -1,14 +1,19 @@
 # from requests import request
+import logging
 from flask import Blueprint, jsonify, make_response, request
 
 from config import limiter, user_session_serializer
 from services.openai_service import safely_end_chat_session
 from util_functions.functions import (
+  PasswordHashingBusy,
   check_is_current_user,
   check_password,
+  get_page_args,
   get_user_info,
   hash_password,
+  is_valid_uuid,
   login_user,
+  password_needs_rehash,
   roles_required,
 )
 from services.sql_service import (
@@ -16,6 +21,7 @@ from services.sql_service import (
   check_user_exists,
   get_all_roles,
   get_all_users,
+  get_users_page,
   get_user,
   register_user,
   remove_user,
@@ -77,7 +83,12 @@ def register_user_route():
   if not exists:
     return jsonify({'error': 'User does not exist.'}), 404
   
-  registered_user = register_user(username, email, hash_password(password))
+  try:
+    password_hash = hash_password(password)
+  except PasswordHashingBusy as e:
+    logging.warning(f'Rejected registration of {email}. {e}')
+    return jsonify({'error': 'Server is busy, please try again.'}), 503, {'Retry-After': '1'}
+  registered_user = register_user(username, email, password_hash)
   
   if registered_user is None:
     return jsonify({'error': 'Failed to register user.'}), 400
@@ -186,9 +197,11 @@ def login_route():
   Status Codes:
       200 OK: Login successful.
       401 Unauthorized: Invalid credentials provided.
+      503 Service Unavailable: Too many logins are being verified at the moment (see `BCRYPT_QUEUE_LIMIT`), retry after a second.
 
   Note:
       Uses a `flask limiter` to restrict login attempts to 10 per minute.
+      Password hashes made with a cost factor other than `BCRYPT_ROUNDS` are replaced on login.
   """
   credential = request.json.get("credential")
   password = request.json.get("password")
@@ -197,10 +210,20 @@ def login_route():
   
   if not user or user is None:
     return jsonify({'message': 'Invalid credentials.'}), 401
-  if check_password(user['password_hash'], password):
-    return login_user(user, remember=remember)
-  else:
+  try:
+    valid = check_password(user['password_hash'], password)
+  except PasswordHashingBusy as e:
+    logging.warning(f'Rejected login attempt. {e}')
+    return jsonify({'message': 'Server is busy, please try again.'}), 503, {'Retry-After': '1'}
+  if not valid:
     return jsonify({'message': 'Invalid credentials.'}), 401
+  if password_needs_rehash(user['password_hash']):
+    # The cost factor was changed (`BCRYPT_ROUNDS`), the hash is replaced while the password is known. Retried on the next login if busy.
+    try:
+      update_user(user_id=user['Id'], password=hash_password(password))
+    except PasswordHashingBusy as e:
+      logging.warning(f'Skipped rehashing the password of user {user["Id"]}. {e}')
+  return login_user(user, remember=remember)
 
 
 @users_bp.route('/logout', methods=['POST'])
@@ -286,13 +309,22 @@ def get_users():
   """
   Retrieves all users from the database.
 
-  This endpoint fetches a list of all users.
+  This endpoint fetches a list of all users. Passing any of the parameters below returns a single page of users, newest first.
 
   URL:
   - GET /get_all_users
 
+  Parameters:
+      limit (int): The maximum number of users returned, at most `PAGE_SIZE_MAX`. Defaults to `PAGE_SIZE_DEFAULT`.
+      cursor (str): The `next_cursor` of the previous page.
+      module_id (str): Only users with access to this module.
+      created_after (str): Only users created at or after this ISO date.
+      created_before (str): Only users created before this ISO date.
+      search (str): Only users whose username or email contains this text.
+
   Returns:
-      JSON response (dict): A list of users or an error message, depending on the outcome.
+      JSON response (dict): A list of users or an error message, depending on the outcome. Pages also hold `next_cursor`,
+      null on the last page.
 
   Status Codes:
       200 OK: Users retrieved successfully.
@@ -301,6 +333,18 @@ def get_users():
   Access Control:
       Either `Admin` or `Master` roles are required to obtain users.
   """
+  try:
+    page_args = get_page_args('module_id', 'search')
+  except ValueError as e:
+    return jsonify({'error': str(e)}), 400
+  if page_args is not None:
+    if page_args['module_id'] and not is_valid_uuid(page_args['module_id']):
+      return jsonify({'error': 'Invalid module_id format.'}), 400
+    page = get_users_page(**page_args)
+    if page is None:
+      return jsonify({'error': 'Could not obtain users.'}), 400
+    return jsonify({'users': page['Items'], 'next_cursor': page['NextCursor']}), 200
+
   res = get_all_users()
   if res:
     return jsonify({'users': res}), 200
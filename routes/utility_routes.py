@@ -3,8 +3,14 @@ from flask import Blueprint, request
 from flask.helpers import make_response
 from flask.json import jsonify
 
-from util_functions.functions import get_agent_session, get_chat_session, is_valid_uuid
-from config import agent_session_serializer, chat_session_serializer
+from util_functions.agent_functions import get_prefetch_stats
+from util_functions.oai_functions import get_run_stats
+from services.cleanup_service import get_cleanup_stats
+from services.sql_service import get_job_runs
+from services.sweeper_service import sweep_orphaned_resources
+from util_functions.functions import agent_cache, get_agent_session, get_chat_session, is_valid_uuid, roles_required
+from config import SESSION_STORE_TTL
+from services.session_store import agent_sessions, chat_sessions
 
 
 utility_bp = Blueprint('utilities', __name__)
@@ -68,26 +74,22 @@ def update_chat_session():
             'file_ids': file_ids
         }
         
-        agent_session_serialized = agent_session_serializer.dumps(agent_session_data)
-        
-        if isinstance(agent_session_serialized, bytes):
-            agent_session_serialized = agent_session_serialized.decode('utf-8')
+        agent_session_serialized = agent_sessions.dumps(agent_session_data)
             
     except Exception as e:
         logging.error(f'Error updating agent session cookies because {e}')
         return jsonify({'error': f'Error updating agent session cookie. {e}'}), 400
     try:
-        agent_ids = chat_session['agent_ids']
+        agent_ids = list(chat_session['agent_ids'])
         chat_id = chat_session['chat_id']
         thread_id = chat_session['thread_id']
-        
-        if 'vector_store_id' in chat_session:
-            vector_store_id = chat_session['vector_store_id']
+        vector_store_id = chat_session.get('vector_store_id')
                 
         if 'file_ids' in chat_session and len(chat_session['file_ids']) > 0:
             chat_file_ids = chat_session['file_ids']
             file_ids = chat_file_ids + file_ids
-        agent_ids.append(oai_agent_id)
+        if oai_agent_id not in agent_ids:
+            agent_ids.append(oai_agent_id)
         
         chat_session_data = {
             'agent_ids': agent_ids,
@@ -97,10 +99,7 @@ def update_chat_session():
             'vector_store_id': vector_store_id
         }
         
-        chat_session_serialized = chat_session_serializer.dumps(chat_session_data)
-        
-        if isinstance(chat_session_serialized, bytes):
-            chat_session_serialized = chat_session_serialized.decode('utf-8')
+        chat_session_serialized = chat_sessions.dumps(chat_session_data)
             
     except Exception as e:
         logging.error(f'Error updating chat session cookie because {e}')
@@ -113,13 +112,88 @@ def update_chat_session():
                       httponly=True,
                       secure=True,
                       samesite='none',
-                      max_age=604800)
+                      max_age=SESSION_STORE_TTL)
         response.set_cookie('agent_session',
                       agent_session_serialized,
                       httponly=True,
                       secure=True,
                       samesite='none',
-                      max_age=604800)
+                      max_age=SESSION_STORE_TTL)
         return response
     else:
-        return jsonify({'error': 'Failed to update agent or chat session cookies.'}), 400
\ No newline at end of file
+        return jsonify({'error': 'Failed to update agent or chat session cookies.'}), 400
+
+
+@utility_bp.route('/utility/metrics', methods=['GET'])
+@roles_required('admin')
+def get_metrics():
+    """
+    Retrieves runtime metrics of this worker process.
+    
+    URL:
+    - GET /utility/metrics
+    
+    Returns:
+        JSON response (dict): The metrics grouped by feature. `agent_prefetch` holds the usage of pre-provisioned pointer agents
+        and `agent_cache` the hit rate of the agent definition cache. `runs` holds the runs cancelled because the client
+        disconnected mid-stream and the estimated completion tokens saved. `cleanup` holds the progress of the queue of OpenAI
+        resources to be deleted.
+        
+    Status Codes:
+        200 OK: Metrics retrieved successfully.
+        
+    Access Control:
+        Requires the `Admin` role.
+    """
+    return jsonify({'agent_prefetch': get_prefetch_stats(), 'agent_cache': agent_cache.stats(), 'runs': get_run_stats(), 'cleanup': get_cleanup_stats()}), 200
+
+
+@utility_bp.route('/utility/orphans', methods=['GET'])
+@roles_required('admin')
+def get_orphans():
+    """
+    Reports the OpenAI assistants, files and vector stores the orphan sweeper considers stale, without deleting anything.
+    
+    URL:
+    - GET /utility/orphans
+    
+    Returns:
+        JSON response (dict): The dry-run report of `sweep_orphaned_resources`.
+        
+    Status Codes:
+        200 OK: Report created successfully.
+        500 Internal Server Error: The references to OpenAI resources could not be loaded from the database.
+        
+    Access Control:
+        Requires the `Admin` role.
+    """
+    report = sweep_orphaned_resources(dry_run=True)
+    if report is None:
+        return jsonify({'error': 'Failed to load references to OpenAI resources.'}), 500
+    return jsonify(report), 200
+
+
+@utility_bp.route('/utility/jobs', methods=['GET'])
+@roles_required('admin')
+def get_jobs():
+    """
+    Retrieves the last run of each scheduled job executed by the job worker (`worker.py`).
+    
+    URL:
+    - GET /utility/jobs
+    
+    Returns:
+        JSON response (list[dict]): The name, last start time, duration in seconds, status (`running`, `success` or `failed`), error,
+        number of runs and progress or result (`Details`) of each job.
+        
+    Status Codes:
+        200 OK: Job runs retrieved successfully.
+        500 Internal Server Error: The job runs could not be retrieved.
+        
+    Access Control:
+        Requires the `Admin` role.
+    """
+    job_runs = get_job_runs()
+    if job_runs is None:
+        return jsonify({'error': 'Failed to retrieve job runs.'}), 500
+    return jsonify(job_runs), 200
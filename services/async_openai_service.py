@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import time
+from openai.types.beta.assistant_stream_event import ThreadRunRequiresAction
+from config import ASYNC_OPENAI_CLIENT as async_client, STREAM_FLUSH_BYTES, STREAM_FLUSH_INTERVAL
+from services.openai_service import DONE_EVENT, ERROR_EVENT, MIRRORED_EVENTS, flush_text, answer_tool_calls, mirror_message, mirror_run_event, prepare_user_message, translate_run_event
+from util_functions.oai_functions import RunGuard
+from util_functions.stream_functions import DeltaCoalescer
+
+
+async def chat_ta_events_async(assistant_id: str, thread_id: str, user_input: str, agent_session: dict=None, initial: bool=False, agent_id: str=None, usage_context: dict=None):
+  """
+  Asyncio counterpart of `chat_ta_events`. The OpenAI run is streamed through the async OpenAI client, so a waiting stream
+  holds no thread. Database and other blocking calls (wrapping the message, switching agents) run in worker threads.
+
+  Parameters:
+      assistant_id (str): The unique identifier for the OpenAI assistant.
+      thread_id (str): The identifier for the conversation thread.
+      user_input (str): The user's message to the AI assistant.
+      agent_session (dict): The deserialized `agent_session` cookie. There is no Flask request to read it from here.
+      initial (bool): If the user_input comes from an initial interaction. Defaults to False.
+      agent_id (str): If `initial` is set to True, an `agent_id` is required to find the initial wrapper prompt.
+      usage_context (dict): The `chat_session_id` and `agent_id` the token usage of the run is recorded for.
+
+  Yields:
+      tuple[str, str | dict]: The event type and its data, see `chat_ta_events`.
+  """
+  start = time.time()
+  if not thread_id:
+    yield ERROR_EVENT, {'error': 'missing thread_id'}
+    return
+
+  wrapper = await asyncio.to_thread(prepare_user_message, thread_id=thread_id, user_input=user_input, initial=initial, agent_id=agent_id, agent_session=agent_session)
+
+  message = await async_client.beta.threads.messages.create(thread_id=thread_id,
+                                                            role="user",
+                                                            content=wrapper)
+  await asyncio.to_thread(mirror_message, thread_id, message)
+
+  stream = await async_client.beta.threads.runs.create(thread_id=thread_id, timeout=55,
+                                                       assistant_id=assistant_id, stream=True)
+  coalescer = DeltaCoalescer(flush_bytes=STREAM_FLUSH_BYTES, flush_interval=STREAM_FLUSH_INTERVAL)
+  # Cancelled (CancelledError) or closed (GeneratorExit) when the client disconnects, the run is cancelled as well.
+  guard = RunGuard(thread_id, usage_context=usage_context)
+  try:
+    async for event in stream:
+      guard.observe(event)
+      if isinstance(event, MIRRORED_EVENTS):
+        await asyncio.to_thread(mirror_run_event, thread_id, event)
+      try:
+        for item in translate_run_event(event, coalescer):
+          yield item
+
+        if isinstance(event, ThreadRunRequiresAction):
+          for item in flush_text(coalescer):
+            yield item
+          tool_outputs, events = await asyncio.to_thread(answer_tool_calls, event.data.required_action.submit_tool_outputs.tool_calls, agent_session)
+          for item in events:
+            yield item
+          async with async_client.beta.threads.runs.submit_tool_outputs_stream(thread_id=thread_id, run_id=event.data.id, tool_outputs=tool_outputs) as stream_output:
+            async for output_event in stream_output:
+              guard.observe(output_event)
+              if isinstance(output_event, MIRRORED_EVENTS):
+                await asyncio.to_thread(mirror_run_event, thread_id, output_event)
+              for item in translate_run_event(output_event, coalescer):
+                yield item
+          for item in flush_text(coalescer):
+            yield item
+      except Exception as e:
+        logging.error(f'Encountered an error while executing the stream. {e}')
+        for item in flush_text(coalescer):
+          yield item
+        yield ERROR_EVENT, {'error': 'Error in stream, continuing.', 'status_code': 1040}
+        continue
+  except (asyncio.CancelledError, GeneratorExit):
+    await asyncio.to_thread(guard.cancel)
+    raise
+  finally:
+    await stream.close()
+  for item in flush_text(coalescer):
+    yield item
+  end = time.time()
+  logging.info(f'Async stream execution took {end - start} seconds')
+  yield DONE_EVENT, {'elapsed': end - start}
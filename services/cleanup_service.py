@@ -0,0 +1,165 @@
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from openai import NotFoundError
+from config import OPENAI_CLIENT as client, CLEANUP_BATCH_SIZE, CLEANUP_CONCURRENCY, CLEANUP_LEASE, CLEANUP_MAX_ATTEMPTS, CLEANUP_POLL_INTERVAL, CLEANUP_RETRY_BASE
+from services.sql_service import claim_cleanup_tasks, complete_cleanup_tasks, enqueue_cleanup_tasks, get_cached_file_ids, get_cleanup_task_counts, get_persistent_vector_store_ids, get_pooled_assistant_ids, get_referenced_thread_ids, release_cleanup_tasks, retry_cleanup_task
+
+ASSISTANT = 'assistant'
+FILE = 'file'
+VECTOR_STORE = 'vector_store'
+# Threads are queued by the chat session retention job (see `database.database.delete_old_chat_sessions`)
+THREAD = 'thread'
+
+# Retries are spread out exponentially from `CLEANUP_RETRY_BASE` up to this many seconds
+MAX_RETRY_DELAY = 6 * 3600
+
+cleanup_executor = ThreadPoolExecutor(max_workers=CLEANUP_CONCURRENCY)
+_stats_lock = threading.Lock()
+cleanup_stats = {'deleted': 0, 'not_found': 0, 'skipped': 0, 'released': 0, 'retried': 0, 'gave_up': 0}
+_wake = threading.Event()
+_drainer = None
+_drainer_lock = threading.Lock()
+
+
+def _count(key: str, amount: int=1):
+  with _stats_lock:
+    cleanup_stats[key] += amount
+
+def enqueue_cleanup(assistant_ids: list[str]=None, file_ids: list[str]=None, vector_store_ids: list[str]=None):
+  """
+  Queues OpenAI assistants, files and vector stores for deletion and wakes the cleanup worker. Resources shared between chats
+  (pooled assistants, cached files and persistent vector stores) may be queued, they are skipped when the queue is drained.
+
+  Parameters:
+      assistant_ids (list[str]): The IDs of the assistants to be deleted.
+      file_ids (list[str]): The IDs of the files to be deleted.
+      vector_store_ids (list[str]): The IDs of the vector stores to be deleted.
+
+  Returns:
+      int or None: The number of newly queued resources or None if they could not be queued.
+  """
+  tasks = [(ASSISTANT, assistant_id) for assistant_id in assistant_ids or []] \
+        + [(FILE, file_id) for file_id in file_ids or []] \
+        + [(VECTOR_STORE, vs_id) for vs_id in vector_store_ids or []]
+  queued = enqueue_cleanup_tasks(tasks)
+  if queued:
+    start_cleanup_worker()
+    _wake.set()
+  return queued
+
+def _delete_resource(resource_type: str, resource_id: str):
+  if resource_type == ASSISTANT:
+    return client.beta.assistants.delete(resource_id).deleted
+  if resource_type == FILE:
+    return client.files.delete(resource_id).deleted
+  if resource_type == VECTOR_STORE:
+    return client.beta.vector_stores.delete(resource_id).deleted
+  if resource_type == THREAD:
+    return client.beta.threads.delete(resource_id).deleted
+  raise ValueError(f'Unknown resource type {resource_type}')
+
+def _shared_resources(tasks: list[dict]):
+  """
+  Returns the tasks whose resources are shared and must be kept, and the tasks whose resources could not be checked.
+  """
+  lookups = {ASSISTANT: get_pooled_assistant_ids, FILE: get_cached_file_ids, VECTOR_STORE: get_persistent_vector_store_ids, THREAD: get_referenced_thread_ids}
+  shared, unresolved = set(), set()
+  for resource_type, lookup in lookups.items():
+    ids = [task['ResourceId'] for task in tasks if task['Type'] == resource_type]
+    if not ids:
+      continue
+    found = lookup(ids)
+    if found is None:
+      unresolved.update((resource_type, resource_id) for resource_id in ids)
+    else:
+      shared.update((resource_type, resource_id) for resource_id in found)
+  return shared, unresolved
+
+def _retry_delay(attempts: int):
+  delay = min(CLEANUP_RETRY_BASE * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+  return int(delay * random.uniform(0.5, 1.0))
+
+def drain_cleanup_tasks(batch_size: int=CLEANUP_BATCH_SIZE):
+  """
+  Claims a batch of due cleanup tasks and deletes their resources from OpenAI, `CLEANUP_CONCURRENCY` at a time.
+  Shared resources and threads still used by a chat session are skipped. If that can't be checked, the tasks are released
+  back to the queue and retried later.
+  Deleted and already missing resources are removed from the queue, failed ones are retried with exponential backoff
+  until they run out of attempts.
+
+  Parameters:
+      batch_size (int): The maximum number of tasks processed.
+
+  Returns:
+      int: The number of tasks claimed.
+  """
+  tasks = claim_cleanup_tasks(batch_size, lease=CLEANUP_LEASE, max_attempts=CLEANUP_MAX_ATTEMPTS)
+  if not tasks:
+    return 0
+
+  shared, unresolved = _shared_resources(tasks)
+  if unresolved:
+    # Without knowing whether they are still in use, the resources are neither deleted nor dropped from the queue
+    logging.warning(f'Could not check whether {len(unresolved)} queued resources are still in use, releasing them.')
+    release_cleanup_tasks(list(unresolved), delay=CLEANUP_RETRY_BASE)
+    _count('released', len(unresolved))
+  done = list(shared)
+  _count('skipped', len(shared))
+  futures = {(task['Type'], task['ResourceId']): (task, cleanup_executor.submit(_delete_resource, task['Type'], task['ResourceId']))
+             for task in tasks if (task['Type'], task['ResourceId']) not in shared | unresolved}
+  for key, (task, future) in futures.items():
+    try:
+      if not future.result():
+        raise RuntimeError('OpenAI did not confirm the deletion.')
+      done.append(key)
+      _count('deleted')
+    except NotFoundError:
+      done.append(key)
+      _count('not_found')
+    except Exception as e:
+      if task['Attempts'] >= CLEANUP_MAX_ATTEMPTS:
+        logging.error(f'Giving up on deleting {task["Type"]} {task["ResourceId"]} after {task["Attempts"]} attempts. {e}')
+        _count('gave_up')
+      else:
+        logging.warning(f'Failed to delete {task["Type"]} {task["ResourceId"]} (attempt {task["Attempts"]}), retrying. {e}')
+        _count('retried')
+      retry_cleanup_task(task['Type'], task['ResourceId'], error=str(e), delay=_retry_delay(task['Attempts']))
+
+  complete_cleanup_tasks(done)
+  logging.info(f'Processed {len(tasks)} cleanup tasks, {len(done)} done')
+  return len(tasks)
+
+def _run_drainer():
+  while True:
+    _wake.wait(timeout=CLEANUP_POLL_INTERVAL)
+    _wake.clear()
+    try:
+      while drain_cleanup_tasks() == CLEANUP_BATCH_SIZE:
+        pass
+    except Exception as e:
+      logging.error(f'Cleanup worker failed to drain the queue. {e}')
+
+def start_cleanup_worker():
+  """
+  Starts the background thread draining the cleanup queue in this process, if it is not running yet. Any number of processes
+  may drain the queue at the same time, claimed tasks are never handed out twice.
+  """
+  global _drainer
+  with _drainer_lock:
+    if _drainer is None or not _drainer.is_alive():
+      _drainer = threading.Thread(target=_run_drainer, name='cleanup-worker', daemon=True)
+      _drainer.start()
+
+def get_cleanup_stats():
+  """
+  Returns how many resources this process deleted, found already missing, skipped as shared, released because that could not
+  be checked, scheduled for a retry or gave up on, along with the number of queued (`pending`) and abandoned (`failed`) tasks.
+  """
+  with _stats_lock:
+    stats = dict(cleanup_stats)
+  counts = get_cleanup_task_counts(CLEANUP_MAX_ATTEMPTS) or {}
+  stats['pending'] = counts.get('Pending')
+  stats['failed'] = counts.get('Failed')
+  return stats
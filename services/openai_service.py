@@ -2,11 +2,12 @@ import json
 import logging
 import re
 import time
-from flask import jsonify
+from contextlib import closing
+from flask import jsonify, request
 from flask.helpers import make_response, stream_with_context
 from flask.wrappers import Response
 from openai._exceptions import APIError
-from openai.types.beta.assistant_stream_event import ThreadMessageCompleted, ThreadMessageDelta, ThreadRunRequiresAction, ThreadRunStepCompleted, ThreadRunStepDelta
+from openai.types.beta.assistant_stream_event import ThreadMessageCompleted, ThreadMessageCreated, ThreadMessageDelta, ThreadMessageIncomplete, ThreadRunCompleted, ThreadRunRequiresAction, ThreadRunStepCompleted, ThreadRunStepDelta
 from openai.types.beta.threads.runs.file_search_tool_call_delta import FileSearchToolCallDelta
 from openai.types.beta.threads.runs import FileSearchToolCall
 from openai.types.beta.threads.runs.function_tool_call_delta import FunctionToolCallDelta
@@ -15,12 +16,14 @@ from openai.types.beta.threads.text_delta_block import TextDeltaBlock
 import openai
 from openai import BadRequestError, NotFoundError
 from packaging import version
-from config import OPENAI_CLIENT as client, chat_session_serializer, agent_session_serializer
-from time import sleep
-from util_functions.agent_functions import create_agent, switch_agent
+from config import OPENAI_CLIENT as client, STREAM_FLUSH_BYTES, STREAM_FLUSH_INTERVAL, SESSION_STORE_TTL
+from services.cleanup_service import enqueue_cleanup
+from services.session_store import agent_sessions, chat_sessions
+from util_functions.agent_functions import create_agent, discard_stale_prefetches, switch_agent
 from util_functions.functions import TimeoutException, get_agent_session, get_chat_session, get_module_session, get_user_info, timeout
-from services.sql_service import db_create_chat_session, get_agent_data, update_chat_session
-from util_functions.oai_functions import include_init_message, safely_delete_last_messages, wrap_message
+from services.sql_service import db_create_chat_session, store_chat_messages, update_chat_message, get_agent_data, get_cached_file_ids, update_chat_session
+from util_functions.oai_functions import RunGuard, include_init_message, serialize_message, safely_delete_last_messages, wrap_message
+from util_functions.stream_functions import DeltaCoalescer, sse_stream
 
 required_version = version.parse("1.1.1")
 current_version = version.parse(openai.__version__)
@@ -32,10 +35,170 @@ if current_version < required_version:
 else:
   print("OpenAI version is compatible")
 
+# Event types yielded by `chat_ta_events`.
+TEXT_EVENT = 'text'
+TOOL_EVENT = 'tool'
+AGENT_SWITCH_EVENT = 'agent_switch'
+USAGE_EVENT = 'usage'
+ERROR_EVENT = 'error'
+DONE_EVENT = 'done'
+
+def flush_text(coalescer: DeltaCoalescer):
+  chunk = coalescer.flush()
+  if chunk:
+    yield TEXT_EVENT, chunk
+
+def _run_usage(run):
+  if run is None or run.usage is None:
+    return None
+  return {'run_id': run.id, 'model': run.model, 'prompt_tokens': run.usage.prompt_tokens, 'completion_tokens': run.usage.completion_tokens, 'total_tokens': run.usage.total_tokens}
+
+# Run events that change the `ChatMessage` mirror, see `mirror_run_event`.
+MIRRORED_EVENTS = (ThreadMessageCreated, ThreadMessageCompleted, ThreadMessageIncomplete)
+
+def mirror_message(thread_id: str, message):
+  """
+  Stores a message added to a thread in the local `ChatMessage` mirror, which also serves as the ledger of the message IDs
+  of the thread. Failures are logged, they never interrupt the stream.
+  """
+  try:
+    store_chat_messages(thread_id, [serialize_message(message)])
+  except Exception as e:
+    logging.error(f'Failed to mirror message {message.id} of thread {thread_id}. {e}')
+
+def mirror_run_event(thread_id: str, event):
+  """
+  Mirrors the messages of a run: assistant messages are recorded as soon as they are created, so a cancelled run leaves no
+  untracked message behind, and their content is filled in once they are completed.
+  """
+  if isinstance(event, ThreadMessageCreated):
+    mirror_message(thread_id, event.data)
+  elif isinstance(event, (ThreadMessageCompleted, ThreadMessageIncomplete)):
+    try:
+      update_chat_message(serialize_message(event.data))
+    except Exception as e:
+      logging.error(f'Failed to mirror message {event.data.id} of thread {thread_id}. {e}')
+
+def prepare_user_message(thread_id:str, user_input:str, initial:bool=False, agent_id:str=None, agent_session:dict=None):
+  """
+  Wraps the user message with the wrapper or initial prompt of the agent it is sent to, see `chat_ta_events` for the parameters.
+  If `initial` is set to True, the last two messages of the thread are deleted first.
+
+  Returns:
+      str: The message to be sent to the thread.
+  """
+  wrapper = user_input
+  if initial:
+    if not agent_id:
+      raise NotFoundError(f'Missing agent_id!')
+    else:
+      safely_delete_last_messages(thread_id=thread_id) # This placement removes context of the deleted messages for the upcoming response, but risks deleted messages even if the conversation fails.
+      agent_data = get_agent_data(agentId=agent_id)
+    
+      initial_present, initial_input = include_init_message(user_input, agent_data=agent_data, config='concat')
+      if not initial_present:
+        initial_input = wrap_message(user_input, agent_data=agent_data, config='start')
+      wrapper = initial_input
+      logging.info(f'Wrapping message: {wrapper}')
+  else:
+    if not agent_session or 'agent_id' not in agent_session:
+      logging.warning(f'Could not resolve agent_session cookie. Failed to alter message...')
+    else:
+      agent_data = get_agent_data(agentId=agent_session['agent_id'])
+      wrapper = wrap_message(wrapper, agent_data=agent_data, config='start')
+      logging.info(f'Wrapping message: {wrapper}')
+  return wrapper
+
+def translate_run_event(event, coalescer: DeltaCoalescer):
+  """
+  Translates a streamed OpenAI run event into the events yielded by `chat_ta_events`. Required actions are not handled here,
+  since answering them differs between the sync and async chat paths.
+
+  Parameters:
+      event (AssistantStreamEvent): The streamed run event.
+      coalescer (DeltaCoalescer): The coalescer buffering the text of the run.
+
+  Yields:
+      tuple[str, str | dict]: The event type and its data.
+  """
+  if isinstance(event, ThreadMessageDelta):
+    for block in event.data.delta.content or []:
+      if isinstance(block, TextDeltaBlock) and block.text and block.text.value:
+        chunk = coalescer.push(re.sub(r'【.*?†source】', '', block.text.value))
+        if chunk:
+          yield TEXT_EVENT, chunk
+  if isinstance(event, ThreadRunStepDelta):
+    if isinstance(event.data.delta.step_details.tool_calls[0], FunctionToolCallDelta):
+      if event.data.delta.step_details.tool_calls[0].function is not None and event.data.delta.step_details.tool_calls[0].function.name is not None:
+        yield from flush_text(coalescer)
+        yield TOOL_EVENT, {'action': 'function_call', 'tool_name': event.data.delta.step_details.tool_calls[0].function.name, 'status': 'in_progress'}
+    elif isinstance(event.data.delta.step_details.tool_calls[0], FileSearchToolCallDelta):
+      if event.data.delta.step_details.tool_calls[0].file_search is not None:
+        yield from flush_text(coalescer)
+        yield TOOL_EVENT, {'action': 'file_search', 'status': 'in_progress'}
+        
+  # File ciations not wanted here.
+  # if isinstance(event, ThreadMessageCompleted):
+  #   message_content = event.data.content[0].text
+  #   annotations = message_content.annotations
+  #   citations = []
+  #   for index, annotation in enumerate(annotations):
+  #     message_content.validate = message_content.value.replace(annotation.text, f'[{index}]')
+  #     if file_citation := getattr(annotation, 'file_citation', None):
+  #       cited_file = client.files.retrieve(file_id=file_citation.file_id)
+  #       citations.append(f'[{index}] {cited_file.filename}')
+    
+  #   yield message_content.value ## Duplicate message
+  #   yield "\n".join(citations)
+        
+  if isinstance(event, ThreadRunStepCompleted):
+    if isinstance(event.data.step_details, ToolCallsStepDetails):
+      if isinstance(event.data.step_details.tool_calls[0], FileSearchToolCall):
+        yield from flush_text(coalescer)
+        yield TOOL_EVENT, {'action': 'file_search', 'status': 'completed'}
+  
+  if isinstance(event, ThreadRunCompleted):
+    usage = _run_usage(event.data)
+    if usage:
+      yield from flush_text(coalescer)
+      yield USAGE_EVENT, usage
+
+def answer_tool_calls(tool_calls, agent_session):
+  """
+  Executes the function calls a run requires, see `chat_ta_events`.
+
+  Parameters:
+      tool_calls (list): The tool calls of the `requires_action` run.
+      agent_session (dict): The current `agent_session` cookie.
+
+  Returns:
+      tuple[list[dict], list[tuple[str, dict]]]: The tool outputs to be submitted to the run and the events to be yielded.
+  """
+  tool_outputs = []
+  events = []
+  for tool_call in tool_calls:
+    print(f'Calling {tool_call.function.name}')
+    if tool_call.function.name == 'point_to_agent':
+      result = switch_agent(agent_session=agent_session)
+      if isinstance(result, tuple):
+        result, cookies = result
+        print(f'output: {result if result else 'No initial prompt present.'}')
+        print(f'output cookies: {cookies}')
+        tool_outputs.append({'tool_call_id': tool_call.id, 'output': f'Successfully switched agents! {result}'})
+        if cookies:
+          events.append((TOOL_EVENT, {'action': 'function_call', 'tool_name': tool_call.function.name, 'status': 'completed'}))
+          events.append((AGENT_SWITCH_EVENT, cookies))
+      else:
+        tool_outputs.append({'tool_call_id': tool_call.id, 'output': result})
+        events.append((TOOL_EVENT, {'action': 'function_call', 'tool_name': tool_call.function.name, 'status': 'failed'}))
+    else:
+      tool_outputs.append({'tool_call_id': tool_call.id, 'output': 'Function does not exist.'})
+  return tool_outputs, events
+
 # @timeout(4)
-def chat_ta(assistant_id:str, thread_id:str, user_input:str, initial:bool=False, agent_id:str=None):
+def chat_ta_events(assistant_id:str, thread_id:str, user_input:str, initial:bool=False, agent_id:str=None, usage_context:dict=None):
   """
-  Sends a message to an OpenAI assistant and manages the conversation within a specific thread, counting the tokens used.
+  Sends a message to an OpenAI assistant and manages the conversation within a specific thread, yielding the course of the run as typed events.
   This method also wraps the user message with wrapper prompts according to its parameters and the agent's data.
 
   Parameters:
@@ -44,128 +207,98 @@ def chat_ta(assistant_id:str, thread_id:str, user_input:str, initial:bool=False,
       user_input (str): The user's message to the AI assistant.
       initial (bool): If the user_input comes from an initial interaction. Defaults to False. This is meant for initializing new agents amidst a conversation, it is not needed at the beginning.
       agent_id (str): If `initial` is set to True, an `agent_id` is required to find the initial wrapper prompt.
+      usage_context (dict): The `chat_session_id` and `agent_id` the token usage of the run is recorded for (see `services.usage_service.record_usage`).
 
-  Returns:
-      dict: A dictionary with either a 'success' key containing the assistant's response or an 'error' key with an error message.
+  Yields:
+      tuple[str, str | dict]: The event type and its data:
+      - `text`: A chunk of the response text (str).
+      - `tool`: The status of a tool call, e.g. `{'action': 'file_search', 'status': 'completed'}`.
+      - `agent_switch`: The cookie data of the agent switched to by `point_to_agent`.
+      - `usage`: The tokens used by a completed run. The usage is also written to the `token_usage` table.
+      - `error`: An error, either recoverable (`status_code` 1040) or fatal.
+      - `done`: The end of the stream.
 
   Notes:
-      - Uses `tiktoken` library to count tokens for both the user's input and the assistant's response.
       - Manages messages and interactions via `client.beta.threads.messages.create` and `client.beta.threads.runs.create`.
       - Handles timeouts, returning an error if response time exceeds 55 seconds.
       - If `initial` is set to True, deletes last two messages (prompt + response). This is a cleanup method, since the response
       containing the switch flag doesn't need to be displayed.
-
-  Examples:
-      >>> response = chat_ta('asst_abc123', 'thread_abc123', 'Hello, assistant!')
-      >>> print(response)
-      {'success': "Assistant's response text here."}
-
-      >>> response = chat_ta('asst_abc123', '', 'Hello, assistant!')
-      >>> print(response)
-      {'error': 'missing thread_id'}
+      - `services.async_openai_service.chat_ta_events_async` is the asyncio counterpart of this method.
   """
   # time.sleep(10)
   start = time.time()
   if not thread_id:
     print('Error: Missing thread_id')
-    return {'error': 'missing thread_id'}
+    yield ERROR_EVENT, {'error': 'missing thread_id'}
+    return
   
   print(f"Received message: '{user_input}' for thread ID: {thread_id}")
   
-  wrapper = user_input
   agent_session = get_agent_session()
-  if initial:
-    if not agent_id:
-      raise NotFoundError(f'Missing agent_id!')
-    else:
-      safely_delete_last_messages(thread_id=thread_id) # This placement removes context of the deleted messages for the upcoming response, but risks deleted messages even if the conversation fails.
-      agent_data = get_agent_data(agentId=agent_id)
-    
-      initial_present, initial_input = include_init_message(user_input, agent_data=agent_data, config='concat')
-      if not initial_present:
-        initial_input = wrap_message(user_input, agent_data=agent_data, config='start')
-      wrapper = initial_input
-      logging.info(f'Wrapping message: {wrapper}')
-  else:
-    if not agent_session or 'agent_id' not in agent_session:
-      logging.warning(f'Could not resolve agent_session cookie. Failed to alter message...')
-    else:
-      agent_data = get_agent_data(agentId=agent_session['agent_id']) # put this into cookies so it doesn't slow down the chat
-      wrapper = wrap_message(wrapper, agent_data=agent_data, config='start')
-      logging.info(f'Wrapping message: {wrapper}')
+  wrapper = prepare_user_message(thread_id=thread_id, user_input=user_input, initial=initial, agent_id=agent_id, agent_session=agent_session)
   
-  client.beta.threads.messages.create(thread_id=thread_id,
-                                      role="user",
-                                      content=wrapper)
+  message = client.beta.threads.messages.create(thread_id=thread_id,
+                                                role="user",
+                                                content=wrapper)
+  mirror_message(thread_id, message)
   
   stream = client.beta.threads.runs.create(thread_id=thread_id, timeout=55,
                                         assistant_id=assistant_id, stream=True,)
-  for event in stream:  
-    try:
-      # print(event)
-      if isinstance(event, ThreadMessageDelta):
-        if isinstance(event.data.delta.content[0], TextDeltaBlock):
-          yield re.sub(r'【.*?†source】', '', event.data.delta.content[0].text.value)
-        sleep(0.05)
-      if isinstance(event, ThreadRunStepDelta):
-        if isinstance(event.data.delta.step_details.tool_calls[0], FunctionToolCallDelta):
-          if event.data.delta.step_details.tool_calls[0].function is not None and event.data.delta.step_details.tool_calls[0].function.name is not None:
-            yield json.dumps({'action': 'function_call', 'tool_name': event.data.delta.step_details.tool_calls[0].function.name, 'status': 'in_progress'})
-            sleep(0.5)
-        elif isinstance(event.data.delta.step_details.tool_calls[0], FileSearchToolCallDelta):
-          if event.data.delta.step_details.tool_calls[0].file_search is not None:
-            yield json.dumps({'action': 'file_search', 'status': 'in_progress'})
-            
-      # File ciations not wanted here.
-      # if isinstance(event, ThreadMessageCompleted):
-      #   message_content = event.data.content[0].text
-      #   annotations = message_content.annotations
-      #   citations = []
-      #   for index, annotation in enumerate(annotations):
-      #     message_content.validate = message_content.value.replace(annotation.text, f'[{index}]')
-      #     if file_citation := getattr(annotation, 'file_citation', None):
-      #       cited_file = client.files.retrieve(file_id=file_citation.file_id)
-      #       citations.append(f'[{index}] {cited_file.filename}')
-        
-      #   yield message_content.value ## Duplicate message
-      #   yield "\n".join(citations)
-            
-      if isinstance(event, ThreadRunStepCompleted):
-        if isinstance(event.data.step_details, ToolCallsStepDetails):
-          if isinstance(event.data.step_details.tool_calls[0], FileSearchToolCall):
-            yield json.dumps({'action': 'file_search', 'status': 'completed'})
-            
-      if isinstance(event, ThreadRunRequiresAction):
-        tool_calls = event.data.required_action.submit_tool_outputs.tool_calls
-        tool_outputs = []
-        for tool_call in tool_calls:
-          print(f'Calling {tool_call.function.name}')
-          if tool_call.function.name == 'point_to_agent':
-            result = switch_agent(agent_session=agent_session)
-            if isinstance(result, tuple):
-              result, cookies = result
-              print(f'output: {result if result else 'No initial prompt present.'}')
-              print(f'output cookies: {cookies}')
-              tool_outputs.append({'tool_call_id': tool_call.id, 'output': f'Successfully switched agents! {result}'})
-              if cookies:
-                yield json.dumps({'action': 'function_call', 'tool_name': tool_call.function.name, 'status': 'completed'})
-                sleep(0.5)
-                yield cookies
-            else:
-              tool_outputs.append({'tool_call_id': tool_call.id, 'output': result})
-              yield json.dumps({'action': 'function_call', 'tool_name': tool_call.function.name, 'status': 'failed'})
-          else:
-            tool_outputs.append({'tool_call_id': tool_call.id, 'output': 'Function does not exist.'})
-        with client.beta.threads.runs.submit_tool_outputs_stream(thread_id=thread_id, run_id=event.data.id, tool_outputs=tool_outputs) as stream_output:
-          for text in stream_output.text_deltas:
-            yield text
-            sleep(0.05)
-    except Exception as e:
-      logging.error(f'Encountered an error while executing the stream. {e}')
-      yield json.dumps({'error': 'Error in stream, continuing.', 'status_code': 1040})
-      continue
+  # Text deltas are coalesced into larger chunks, anything else flushes the buffered text first so it is never overtaken.
+  coalescer = DeltaCoalescer(flush_bytes=STREAM_FLUSH_BYTES, flush_interval=STREAM_FLUSH_INTERVAL)
+  # The generator is closed (GeneratorExit) when the client disconnects, the run is cancelled instead of generating on.
+  guard = RunGuard(thread_id, usage_context=usage_context)
+  try:
+    for event in stream:  
+      guard.observe(event)
+      mirror_run_event(thread_id, event)
+      try:
+        yield from translate_run_event(event, coalescer)
+              
+        if isinstance(event, ThreadRunRequiresAction):
+          yield from flush_text(coalescer)
+          tool_outputs, events = answer_tool_calls(event.data.required_action.submit_tool_outputs.tool_calls, agent_session)
+          yield from events
+          with client.beta.threads.runs.submit_tool_outputs_stream(thread_id=thread_id, run_id=event.data.id, tool_outputs=tool_outputs) as stream_output:
+            for output_event in stream_output:
+              guard.observe(output_event)
+              mirror_run_event(thread_id, output_event)
+              yield from translate_run_event(output_event, coalescer)
+            yield from flush_text(coalescer)
+      except Exception as e:
+        logging.error(f'Encountered an error while executing the stream. {e}')
+        yield from flush_text(coalescer)
+        yield ERROR_EVENT, {'error': 'Error in stream, continuing.', 'status_code': 1040}
+        continue
+  except GeneratorExit:
+    guard.cancel()
+    raise
+  finally:
+    stream.close()
+  yield from flush_text(coalescer)
   end = time.time()
   logging.info(f'Stream execution took {end - start} seconds')
+  yield DONE_EVENT, {'elapsed': end - start}
+
+def chat_ta(assistant_id:str, thread_id:str, user_input:str, initial:bool=False, agent_id:str=None, usage_context:dict=None):
+  """
+  Sends a message to an OpenAI assistant and streams the response as plain text, see `chat_ta_events` for the parameters.
+  Text is yielded as is, tool statuses and errors as JSON strings and agent switches as a dict with the cookie data.
+  Usage and the end of the stream are not reported in this format.
+
+  Examples:
+      >>> for content in chat_ta('asst_abc123', 'thread_abc123', 'Hello, assistant!'):
+      ...   print(content)
+      "Assistant's response text here."
+  """
+  with closing(chat_ta_events(assistant_id=assistant_id, thread_id=thread_id, user_input=user_input, initial=initial, agent_id=agent_id, usage_context=usage_context)) as events:
+    for event_type, data in events:
+      if event_type == TEXT_EVENT:
+        yield data
+      elif event_type in (TOOL_EVENT, ERROR_EVENT):
+        yield json.dumps(data)
+      elif event_type == AGENT_SWITCH_EVENT:
+        yield data
 
 def delete_agent(agent_id: str):
   """
@@ -213,7 +346,40 @@ def delete_agent(agent_id: str):
     logging.error(f'Failed to delete agent with Id {agent_id}')
     return None
   
-def initialize_agent_chat(agent_id: str, thread_id: str, user_input: str):
+# Headers keeping proxies from buffering or caching Server-Sent Event streams.
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def chat_sse(events):
+  """
+  Frames the events of `chat_ta_events` as Server-Sent Events. Text chunks are sent as `{'text': chunk}` and exceptions
+  raised during the run end the stream with an `error` event followed by `done`.
+
+  Parameters:
+    events (Iterable[tuple[str, str | dict]]): The events yielded by `chat_ta_events`.
+
+  Returns:
+    Generator[str]: The framed events.
+  """
+  def guarded():
+    try:
+      with closing(events):
+        for event_type, data in events:
+          yield event_type, {'text': data} if event_type == TEXT_EVENT else data
+    except TimeoutException as e:
+      logging.error(f'Error obtaining response. Operation timed out. {e}')
+      yield ERROR_EVENT, {'error': 'Operation timed out.', 'status_code': 408}
+      yield DONE_EVENT, {}
+    except APIError as e:
+      logging.error(f'Error occurred while processing chat message: {e}')
+      yield ERROR_EVENT, {'error': f'An error occurred while communicating with the agent. {e}', 'status_code': 400}
+      yield DONE_EVENT, {}
+    except Exception as e:
+      logging.error(f'Error occurred while processing chat message: {e}')
+      yield ERROR_EVENT, {'error': f'An error occurred while communicating with the agent. {e}', 'status_code': 400}
+      yield DONE_EVENT, {}
+  return sse_stream(guarded())
+
+def initialize_agent_chat(agent_id: str, thread_id: str, user_input: str, sse: bool=False):
   """
   Initializes a new OpenAI agent and immediately sends a message to that agent. 
   The method sets a cookie for the chat session if none exists, and adds agent_ids and file_ids used within the `chat_session` to the cookie if it already exists. 
@@ -225,6 +391,7 @@ def initialize_agent_chat(agent_id: str, thread_id: str, user_input: str):
     agent_id (str): The ID of the agent to be initialized. This is the ID of the database-stored metadata of the agent, not the OpenAI ID.
     thread_id (str): The ID of the thread the conversation is currently being held on.
     user_input (str): The user message to be sent to the initialized agent.
+    sse (bool): Whether to stream the response as Server-Sent Events (see `chat_sse`) instead of plain text. Defaults to False.
     
   Returns
     JSON response (dict): A message indicating successful initialization with a new thread ID and OAI agent ID including the response from the agent,
@@ -236,11 +403,8 @@ def initialize_agent_chat(agent_id: str, thread_id: str, user_input: str):
   if not new_oai_agent_id or new_oai_agent_id is None:
     return jsonify({'error': 'Agent not found'}), 404
   
-  agent_serializer = agent_session_serializer
   # IMPORTANT: agent_id: Database-stored agent, oai_agent_id: OpenAI ID of the temp agent, file_ids: OpenAI IDs of temporarily stored files on OpenAI.
-  agent_data = agent_serializer.dumps({'agent_id': agent_id, 'oai_agent_id': new_oai_agent_id, 'file_ids': file_ids})
-  if isinstance(agent_data, bytes):
-    agent_data = agent_data.decode('utf-8')
+  agent_data = agent_sessions.dumps({'agent_id': agent_id, 'oai_agent_id': new_oai_agent_id, 'file_ids': file_ids, 'vector_store_id': vs_id})
   
   chat_session = get_chat_session()
   
@@ -258,23 +422,26 @@ def initialize_agent_chat(agent_id: str, thread_id: str, user_input: str):
     chat_id = chat_session['chat_id']
   
   agent_ids = []
+  chat_file_ids = []
   if chat_session and 'agent_ids' in chat_session and 'file_ids' in chat_session:
-    agent_ids = chat_session['agent_ids']
-    file_ids.append(chat_session['file_ids'])
-    
-  agent_ids.append(new_oai_agent_id)
+    agent_ids = list(chat_session['agent_ids'])
+    for file_id in chat_session['file_ids']:
+      # Older cookies nest the file IDs of previous agents
+      chat_file_ids.extend(file_id if isinstance(file_id, list) else [file_id])
+  
+  if new_oai_agent_id not in agent_ids:
+    agent_ids.append(new_oai_agent_id)
+  chat_file_ids.extend(file_id for file_id in file_ids if file_id not in chat_file_ids)
   
-  chat_serializer = chat_session_serializer
-  session_data = chat_serializer.dumps({'agent_ids': agent_ids, 'thread_id': thread_id, 'file_ids': file_ids, 'chat_id': chat_id, 'vector_store_id': vs_id})
-  logging.info(f"CURRENT CHAT SESSION DATA: 'agent_ids': {agent_ids}, 'thread_id': {thread_id}, 'file_ids': {file_ids}")
-  if isinstance(session_data, bytes):
-    session_data = session_data.decode('utf-8')
+  session_data = chat_sessions.dumps({'agent_ids': agent_ids, 'thread_id': thread_id, 'file_ids': chat_file_ids, 'chat_id': chat_id, 'vector_store_id': vs_id})
+  logging.info(f"CURRENT CHAT SESSION DATA: 'agent_ids': {agent_ids}, 'thread_id': {thread_id}, 'file_ids': {chat_file_ids}")
+  usage_context = {'chat_session_id': chat_id, 'agent_id': agent_id}
   
   @stream_with_context
   def stream_response():
     try:
-      for content in chat_ta(assistant_id=new_oai_agent_id, thread_id=thread_id, user_input=user_input, initial=True, agent_id=agent_id):
-        yield content
+      with closing(chat_ta(assistant_id=new_oai_agent_id, thread_id=thread_id, user_input=user_input, initial=True, agent_id=agent_id, usage_context=usage_context)) as contents:
+        yield from contents
     except TimeoutException as e:
       logging.error(f'Error obtaining response. Operation timed out. {e}')
       yield json.dumps({'error': 'Operation timed out.', 'status_code': 408})
@@ -285,19 +452,26 @@ def initialize_agent_chat(agent_id: str, thread_id: str, user_input: str):
       logging.error(f'Error occurred while processing chat message: {e}')
       yield json.dumps({'error': f'An error occurred while communicating with the agent. {e}', 'status_code': 400})
   
-  response = Response(stream_response(), content_type='text/plain', status=200)
+  @stream_with_context
+  def stream_events():
+    yield from chat_sse(chat_ta_events(assistant_id=new_oai_agent_id, thread_id=thread_id, user_input=user_input, initial=True, agent_id=agent_id, usage_context=usage_context))
+  
+  if sse:
+    response = Response(stream_events(), content_type='text/event-stream', headers=SSE_HEADERS, status=200)
+  else:
+    response = Response(stream_response(), content_type='text/plain', status=200)
   response.set_cookie('chat_session',
                       session_data,
                       httponly=True,
                       secure=True,
                       samesite='none',
-                      max_age=604800)
+                      max_age=SESSION_STORE_TTL)
   response.set_cookie('agent_session',
                       agent_data,
                       httponly=True,
                       secure=True,
                       samesite='none',
-                      max_age=604800)
+                      max_age=SESSION_STORE_TTL)
   
   end = time.time()
   logging.info(f'Chat initialization took {end - start} seconds')
@@ -344,7 +518,7 @@ def batch_delete_agents(agent_ids: list[str]):
     
 def batch_delete_files(file_ids: list[str]):
   """
-  Deletes files from OpenAI servers.
+  Deletes files from OpenAI servers. Files held by the OpenAI file cache are shared across agents and are skipped.
   
   Returns:
     True or False and list: True if the deletion is fully successfull and False when it fails. A list of non-deleted files_ids is returned on fail.
@@ -356,6 +530,13 @@ def batch_delete_files(file_ids: list[str]):
   logging.info(f'Attempting to delete files from OpenAI {[file for file in file_ids]}')
   
   valid_file_ids = [file_id for file_id in file_ids if file_id]
+  cached_file_ids = get_cached_file_ids(valid_file_ids)
+  if cached_file_ids is None:
+    logging.error(f'Could not check which files are cached, keeping {valid_file_ids}')
+    return False, valid_file_ids
+  if cached_file_ids:
+    logging.info(f'Skipping cached files {list(cached_file_ids)}')
+    valid_file_ids = [file_id for file_id in valid_file_ids if file_id not in cached_file_ids]
 
   for file_id in valid_file_ids:
     try:
@@ -437,49 +618,40 @@ def batch_delete_vector_stores(vs_ids: list[str] | str):
   
 def safely_end_chat_session():
   """
-  Attempts to iteratively remove agents and files used during the chat session from OpenAI servers.
-  The method retrieves the chat_session cookie and uses the agent_ids and file_ids to identify files for removal.
-  The ChatSession in the database is updated to contain the last agent used by the chat session.
+  Queues the agents, files and vector stores used during the chat session for removal from OpenAI servers and returns right away.
+  The method retrieves the chat_session cookie and uses the agent_ids, file_ids and vector_store_id to identify the resources.
+  The queue is drained in the background by `services.cleanup_service`, with retries, so the IDs are not lost with the cookie
+  if OpenAI is unavailable. Pooled assistants and persistent vector stores are shared between chats and are never removed.
   
   Returns:
     dict[str, str | list], literal[200 | 400]: A message along with data and a status code indicating the success or failure of the method.
   """
   chat_session = get_chat_session()
+  discard_stale_prefetches()
   
   if not chat_session or chat_session is None or 'agent_ids' not in chat_session:
       return {'error': 'Could not resolve chat session cookie.'}, 400
   
   file_ids = []
-  agent_ids = chat_session['agent_ids']
-  if 'file_ids' in chat_session:
-      file_ids = chat_session['file_ids']
-  
-  agents_status, agents_deleted = batch_delete_agents(agent_ids)
-  files_status, files_deleted = batch_delete_files(file_ids)
-  
-  if not agents_status and not files_status:
-    logging.error(f'Failed to delete files: {files_deleted} and agents {agents_deleted}')
-    return {'error': 'Failed to delete all or some agents and files.', 'non_deleted_files': files_deleted, 'non_deleted_agents': agents_deleted}, 400
-  
-  if not files_status:
-    logging.error(f'Failed to delete files: {files_deleted}')
-    return {'error': "Failed to delete all or some files", 'non_deleted_files': files_deleted}, 400
+  for file_id in chat_session.get('file_ids', []):
+    # Older cookies nest the file IDs of previous agents
+    file_ids.extend(file_id if isinstance(file_id, list) else [file_id])
+  vs_ids = chat_session.get('vector_store_id') or []
+  if isinstance(vs_ids, str):
+    vs_ids = [vs_ids]
   
-  if not agents_status:
-    logging.error(f'Failed to delete agents: {agents_deleted}')
-    return {'error': "Failed to delete all or some agents", 'non_deleted_agents': agents_deleted}, 400
-    
-  if 'vector_store_id' in chat_session:
-    vs_status, vs_deleted = batch_delete_vector_stores(vs_ids=chat_session['vector_store_id'])
-    if not vs_status:
-      logging.error(f'Failed to delete vector stores: {vs_deleted}')
-      return {'error': "Failed to delete all or some vector stores", 'non_deleted_vector_stores': vs_deleted}, 400
+  queued = enqueue_cleanup(assistant_ids=chat_session['agent_ids'], file_ids=file_ids, vector_store_ids=vs_ids)
+  if queued is None:
+    logging.error(f'Failed to queue agents {chat_session["agent_ids"]}, files {file_ids} and vector stores {vs_ids} for removal')
+    return {'error': 'Failed to queue agents, files and vector stores for removal.', 'non_deleted_agents': chat_session['agent_ids'], 'non_deleted_files': file_ids, 'non_deleted_vector_stores': vs_ids}, 400
   
-  return {'message': 'Agents and files removed from OpenAI.'}, 200
+  chat_sessions.discard(request.cookies.get('chat_session'))
+  agent_sessions.discard(request.cookies.get('agent_session'))
+  return {'message': 'Agents and files queued for removal from OpenAI.'}, 200
 
 def chat_util_agent(agent_id: str, thread_id: str, input: str, chat_session_id: str, config: str):
   """
-  Initializes, messages and then deletes a utility agent. Intended for utility operations like conducting analysis or
+  Messages a utility agent through its pooled assistant. Intended for utility operations like conducting analysis or
   summaries at the end of a conversation.
   
   Parameters:
@@ -498,17 +670,16 @@ def chat_util_agent(agent_id: str, thread_id: str, input: str, chat_session_id:
   def stream_response():
     full_response = ''
     try:
-      for content in chat_ta(assistant_id=oai_agent_id, thread_id=thread_id, user_input=input):
+      for content in chat_ta(assistant_id=oai_agent_id, thread_id=thread_id, user_input=input, usage_context={'chat_session_id': chat_session_id, 'agent_id': agent_id}):
         full_response += content
         yield content
     finally:
+      # `messages_len` is kept up to date by the message ledger (see `services.sql_service.store_chat_messages`)
       safely_delete_last_messages(thread_id=thread_id)
-      client.beta.assistants.delete(assistant_id=oai_agent_id)
-      messages = client.beta.threads.messages.list(thread_id=thread_id)
       if config == 'analysis':
-        update_chat_session(chat_session_id=chat_session_id, analysis=full_response, messages_len=len(messages.data))
+        update_chat_session(chat_session_id=chat_session_id, analysis=full_response)
       elif config == 'summary':
-        update_chat_session(chat_session_id=chat_session_id, summary=full_response, messages_len=len(messages.data))
+        update_chat_session(chat_session_id=chat_session_id, summary=full_response)
 
   response = Response(stream_response(), content_type='text/plain', status=200)
   
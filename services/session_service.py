@@ -1,5 +1,6 @@
 from flask import Flask, jsonify, g, current_app, request
 from config import user_session_serializer, assistant_session_serializer
+from util_functions.functions import load_session_cookie
 
 # set session none => dashboard
 def check_assistant_session(app: Flask, session):
@@ -62,13 +63,13 @@ def check_session_validation():
     return
 
   if request.endpoint not in exempt_endpoints:
-    serializer = user_session_serializer
     session = request.cookies.get('user_session')
     if not session:
       return jsonify({'error': 'No session data.'}), 401
 
     try:
-      g.user_session_data = serializer.loads(session)
+      # Memoized for the request, the helpers of `util_functions.functions` read the cookie from `g` afterwards.
+      g.user_session_data = load_session_cookie('user_session', user_session_serializer)
     except:
       print('Invalid or expired session data.')
       return jsonify({'error': 'Invalid or expired session data.'}), 401
\ No newline at end of file
@@ -0,0 +1,116 @@
+import copy
+import logging
+import secrets
+from datetime import timedelta
+from flask import after_this_request, g, request
+from itsdangerous import BadSignature
+from config import SESSION_CACHE_SIZE, SESSION_CACHE_TTL, SESSION_LEGACY_COOKIES, SESSION_STORE_TTL, agent_session_serializer, chat_session_serializer
+from services.sql_service import delete_session_states, get_session_state, save_session_state, session_state_exists
+from util_functions.functions import TTLCache, current_time_prague, load_session_cookie
+
+
+class SessionStore:
+  """
+  Server-side store of the chat or agent session, used in place of the signed cookie serializer. `dumps` stores the session
+  in the `session_states` table and returns a short opaque handle to be set as the cookie, `loads` resolves a handle back to
+  the session. Stored sessions are never changed, `dumps` always stores under a new handle, so the in-process front cache
+  can't serve a session another worker has changed since. A session may have been discarded by another worker though,
+  so a cache hit is only served after checking that the session is still stored (see `loads`).
+
+  Cookies signed by `serializer` that still hold the whole session are accepted while `SESSION_LEGACY_COOKIES` is set and
+  are replaced by a handle on the first request reading them (see `load_request_session`).
+
+  Parameters:
+    kind (str): 'chat' or 'agent', stored with each session so a handle can't be used as the other cookie.
+    cookie (str): The name of the cookie holding the handle.
+    serializer (URLSafeSerializer): The serializer of the legacy cookies.
+  """
+
+  def __init__(self, kind: str, cookie: str, serializer):
+    self.kind = kind
+    self.cookie = cookie
+    self.serializer = serializer
+    self.cache = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL) if SESSION_CACHE_SIZE > 0 else None
+
+  @staticmethod
+  def is_legacy(value: str):
+    # Handles are URL-safe base64, signed cookies always contain the '.' separating the payload and the signature.
+    return '.' in value
+
+  def dumps(self, data: dict):
+    """
+    Stores the session and returns the handle to set as the cookie. If the session can't be stored, a legacy cookie holding
+    the session is returned instead while those are accepted.
+    """
+    handle = secrets.token_urlsafe(18)
+    if save_session_state(handle, self.kind, data, current_time_prague() + timedelta(seconds=SESSION_STORE_TTL)):
+      if self.cache is not None:
+        self.cache.set(handle, copy.deepcopy(data))
+      return handle
+    if SESSION_LEGACY_COOKIES:
+      logging.warning(f'Falling back to a signed {self.cookie} cookie, the session could not be stored.')
+      return self.serializer.dumps(data)
+    raise RuntimeError(f'Failed to store the {self.kind} session.')
+
+  def loads(self, value: str):
+    """
+    Resolves a cookie value to the session. Returns None for unknown, expired and discarded handles.
+    Raises `BadSignature` for invalid legacy cookies and for any legacy cookie once they are no longer accepted.
+
+    The front cache spares loading and decoding the session, a cached session is still checked against the `session_states`
+    table, so a session discarded on any worker is never served again. If the check fails, the cached session is served.
+    """
+    if self.is_legacy(value):
+      if not SESSION_LEGACY_COOKIES:
+        raise BadSignature(f'Signed {self.cookie} cookies are no longer accepted.')
+      return self.serializer.loads(value)
+    if self.cache is not None:
+      data = self.cache.get(value)
+      if data is not None:
+        if session_state_exists(value, self.kind) is False:
+          self.cache.invalidate(value)
+          return None
+        return copy.deepcopy(data)
+    state = get_session_state(value, self.kind)
+    if state is None:
+      return None
+    data, _ = state
+    if self.cache is not None:
+      self.cache.set(value, copy.deepcopy(data))
+    return data
+
+  def discard(self, value: str):
+    """
+    Deletes the stored session a cookie points to, legacy cookies hold nothing to delete.
+    """
+    if not value or self.is_legacy(value):
+      return
+    if self.cache is not None:
+      self.cache.invalidate(value)
+    delete_session_states([value])
+
+  def load_request_session(self):
+    """
+    Reads the session of the current request, once per request (see `load_session_cookie`). A legacy cookie is stored
+    server-side and replaced by a handle in the response, unless the response sets the cookie itself.
+    """
+    data = load_session_cookie(self.cookie, self)
+    value = request.cookies.get(self.cookie)
+    reissued = g.setdefault('reissued_session_cookies', set())
+    if data is None or not self.is_legacy(value) or self.cookie in reissued or not SESSION_LEGACY_COOKIES:
+      return data
+    reissued.add(self.cookie)
+    handle = self.dumps(data)
+    if self.is_legacy(handle):
+      return data
+
+    @after_this_request
+    def replace_cookie(response):
+      if not any(header.startswith(f'{self.cookie}=') for header in response.headers.getlist('Set-Cookie')):
+        response.set_cookie(self.cookie, handle, httponly=True, secure=True, samesite='none', max_age=SESSION_STORE_TTL)
+      return response
+    return data
+
+
+chat_sessions = SessionStore('chat', 'chat_session', chat_session_serializer)
+agent_sessions = SessionStore('agent', 'agent_session', agent_session_serializer)
@@ -1,12 +1,18 @@
 import logging
-from database.database import SessionLocal, session_scope
-from database.models import Module, User, Role, ChatSession, Transcript, Document, Agent, agent_file_table, document_module_table
-from sqlalchemy.exc import SQLAlchemyError, NoResultFound
+from config import OPENAI_FILE_REVALIDATE_AFTER
+from database.database import SessionLocal, query_budget, session_scope
+from database.models import Module, User, Role, ChatSession, ChatMessage, CleanupTask, JobRun, SessionState, Transcript, Document, Agent, AgentAssistant, OpenAIFile, VectorStore, VectorStoreFile, agent_chat_table, agent_file_table, document_module_table, user_module_table, user_roles
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError, NoResultFound
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import selectinload
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+import copy
 import uuid
+from collections import defaultdict
 from flask import jsonify
-from datetime import datetime
-from util_functions.sql_functions import associate_modules, check_for_duplicate, compute_file_hash, create_default_agents, get_doc_content, get_module, get_modules_as_dicts, get_roles_as_dicts, get_user_name, update_default_agents
-from util_functions.functions import hash_password, is_email
+from datetime import datetime, timedelta
+from util_functions.sql_functions import associate_modules, check_for_duplicate, compute_file_hash, create_default_agents, get_doc_content, get_module, get_modules_as_dicts, get_roles_as_dicts, get_user_name, delete_agent_vector_store, invalidate_agent_assistants, update_default_agents
+from util_functions.functions import agent_cache, compile_serializer, current_time_prague, encode_cursor, format_timestamp, hash_password, is_email
 from werkzeug.utils import secure_filename
 import os
 import hashlib
@@ -34,7 +40,7 @@ def get_module_by_id(module_id: str):
             'Voice': module.voice,
             'Analytics': module.convo_analytics,
             'Summaries': module.summaries,
-            'Created': module.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+            'Created': format_timestamp(module.created),
         }
       else:
         return None
@@ -65,8 +71,8 @@ def get_all_modules():
         'Voice': module.voice,
         'ConvoAnalytics': module.convo_analytics,
         'Summaries': module.summaries,
-        'Created': module.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        'LastModified': module.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        'Created': format_timestamp(module.created),
+        'LastModified': format_timestamp(module.last_modified)
       } for module in modules_query]
       return modules
   except Exception as e:
@@ -125,8 +131,8 @@ def create_new_module(
         'Voice': new_module.voice,
         'ConvoAnalytics': new_module.convo_analytics,
         'Summaries': new_module.summaries,
-        'Created': new_module.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        'LastModified': new_module.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        'Created': format_timestamp(new_module.created),
+        'LastModified': format_timestamp(new_module.last_modified)
       }
       return module_data, 201
   except Exception as e:
@@ -192,6 +198,7 @@ def update_module(
       
       if updated_fields:
         session.commit()
+        agent_cache.clear()
         logging.info(f'Module {module_id} updated. Fields changed: {", ".join(updated_fields)}')
       else:
         logging.info(f'No changes made to Module {module_id}.')
@@ -204,8 +211,8 @@ def update_module(
         'Voice': module.voice,
         'ConvoAnalytics': module.convo_analytics,
         'Summaries': module.summaries,
-        'Created': module.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        'LastModified': module.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        'Created': format_timestamp(module.created),
+        'LastModified': format_timestamp(module.last_modified)
       }
   except SQLAlchemyError as e:
     logging.error(f'SQLAlchemy error updating module {module_id}. {e}')
@@ -218,41 +225,50 @@ def update_module(
 
 def delete_module(module_id: str):
   """
-  Deletes a module from the database.
+  Deletes a module from the database along with its documents that are not related to any other module.
+  The orphaned documents are found in one grouped query over `document_module` and deleted in bulk.
+  Their files are not removed from the storage here, so that no transaction is held open while waiting on Supabase.
   
   Parameters:
     module_id (str): The unique identifier of the module to be deleted.
     
   Returns:
-    str or None: The unique identifier of the deleted module or None if the deletion failed.
+    tuple[str, list[str]] or tuple[None, None]: The unique identifier of the deleted module and the storage keys of the deleted documents
+    (see `delete_files`), or None, None if the deletion failed.
   """
   try:
     with session_scope() as session:
       module = session.query(Module).filter(Module.id == module_id).first()
       
       if not module:
-                logging.error(f'Module with ID: {module_id} not found.')
-                return None
-              
-      orphaned_documents = []
-      for document in module.documents:
-        other_modules = session.query(Module).join(Module.documents).filter(Document.id == document.id).filter(Module.id != module_id).all()
-        if not other_modules:
-          orphaned_documents.append(document)
-          
-      for document in orphaned_documents:
-        session.delete(document)
+        logging.error(f'Module with ID: {module_id} not found.')
+        return None, None
+      
+      module_documents = session.query(document_module_table.c.document_id).filter(document_module_table.c.module_id == module_id)
+      orphaned_documents = session.query(Document.id, Document.url) \
+                                  .join(document_module_table, document_module_table.c.document_id == Document.id) \
+                                  .filter(Document.id.in_(module_documents)) \
+                                  .group_by(Document.id, Document.url) \
+                                  .having(func.count() == 1).all()
+      document_ids = [document.id for document in orphaned_documents]
       
       session.delete(module)
+      session.flush()
+      if document_ids:
+        # Agents of other modules may still reference the documents, the association has no ON DELETE CASCADE.
+        session.execute(agent_file_table.delete().where(agent_file_table.c.document_id.in_(document_ids)))
+        session.query(Document).filter(Document.id.in_(document_ids)).delete(synchronize_session=False)
       session.commit()
+      # Agents of the module are deleted by cascade and documents may have been removed from agents of other modules.
+      agent_cache.clear()
       
-      return module_id
+      return module_id, [document.url for document in orphaned_documents if document.url]
   except SQLAlchemyError as e:
     logging.error(f'Failed to delete module with ID: {module_id}. {e}')
-    return None
+    return None, None
   except Exception as e:
     logging.error(f'Failed to delete module with ID: {module_id}. {e}')
-    return None
+    return None, None
 
 
 def add_user(email, roles, modules):
@@ -292,9 +308,9 @@ def add_user(email, roles, modules):
               "Id":
               id,
               "Created":
-              new_user.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+              format_timestamp(new_user.created),
               "LastModified":
-              new_user.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+              format_timestamp(new_user.last_modified),
               "Email":
               new_user.email,
               "Roles":
@@ -329,8 +345,8 @@ def register_user(username: str, email: str, password_hash: str):
         "Id": str(user.id),
         "Username": user.username,
         "Email": user.email,
-        "Created": user.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        "LastModified": user.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+        "Created": format_timestamp(user.created),
+        "LastModified": format_timestamp(user.last_modified),
         "Roles":
         get_roles_as_dicts(user.roles),
         "Modules":
@@ -467,6 +483,47 @@ def get_user_modules(user_modules_ids):
     return []
 
 
+_serialize_user = compile_serializer({
+    "Id": ("id", str),
+    "Username": "username",
+    "Email": "email",
+    "Created": ("created", format_timestamp),
+    "LastModified": ("last_modified", format_timestamp),
+})
+
+def _user_list_query(session):
+  return session.query(User.id, User.username, User.email, User.created, User.last_modified)
+
+def _user_dicts(session, users):
+  user_ids = [user.id for user in users]
+  roles, modules = defaultdict(list), defaultdict(list)
+  if user_ids:
+    for user_id, role_id, role_name in session.query(user_roles.c.user_id, Role.id, Role.name) \
+                                              .join(Role, Role.id == user_roles.c.role_id).filter(user_roles.c.user_id.in_(user_ids)):
+      roles[user_id].append({"Id": str(role_id), "Name": role_name})
+    for user_id, module_id, module_name in session.query(user_module_table.c.user_id, Module.id, Module.name) \
+                                                  .join(Module, Module.id == user_module_table.c.module_id).filter(user_module_table.c.user_id.in_(user_ids)):
+      modules[user_id].append({"Id": str(module_id), "Name": module_name})
+  return [{**_serialize_user(user), "Roles": roles[user.id], "Modules": modules[user.id]} for user in users]
+
+def _keyset_page(query, model, limit: int, cursor: tuple=None):
+  """
+  Returns a page of `query`, newest first, ordered by `created` and `id` of `model`, and the cursor of the next page.
+  """
+  if cursor is not None:
+    query = query.filter(tuple_(model.created, model.id) < cursor)
+  rows = query.order_by(model.created.desc(), model.id.desc()).limit(limit + 1).all()
+  next_cursor = encode_cursor(rows[limit - 1].created, rows[limit - 1].id) if len(rows) > limit else None
+  return rows[:limit], next_cursor
+
+def _created_between(query, model, created_after: datetime=None, created_before: datetime=None):
+  if created_after is not None:
+    query = query.filter(model.created >= created_after)
+  if created_before is not None:
+    query = query.filter(model.created < created_before)
+  return query
+
+@query_budget(3)
 def get_all_users():
   """
   Retrieves all users from the database along with their associated roles and modules.
@@ -476,57 +533,42 @@ def get_all_users():
   """
   try:
     with session_scope() as session:
-      users = session.query(User).all()
+      return _user_dicts(session, _user_list_query(session).all())
+  except Exception as e:
+    print(f"An error occured: {e}")
+    return []
 
-      all_roles = session.query(Role).all()
-      all_modules = session.query(Module).all()
+@query_budget(3)
+def get_users_page(limit: int, cursor: tuple=None, module_id: str=None, created_after: datetime=None, created_before: datetime=None, search: str=None):
+  """
+  Retrieves a page of users, newest first, along with their associated roles and modules.
 
-      roles_dict = {role.id: role for role in all_roles}
-      modules_dict = {
-          module.id: module
-          for module in all_modules
-      }
+  Parameters:
+      limit (int): The maximum number of users returned.
+      cursor (tuple[datetime, UUID]): The decoded `NextCursor` of the previous page, see `decode_cursor`. None for the first page.
+      module_id (str): Only users with access to this module.
+      created_after (datetime): Only users created at or after this time.
+      created_before (datetime): Only users created before this time.
+      search (str): Only users whose username or email contains this text.
 
-      users_data = []
-      for user in users:
-        user_roles_ids = [role.id for role in user.roles]
-        user_modules_ids = [module.id for module in user.modules]
-
-        user_roles = [{
-            "Id": str(role.id),
-            "Name": role.name
-        } for role_id in user_roles_ids for role in (roles_dict.get(role_id), )
-                      if role]
-        user_modules = [
-            {
-                "Id": str(module.id),
-                "Name": module.name
-            } for module_id in user_modules_ids
-            for module in (modules_dict.get(module_id), ) if module
-        ]
-
-        users_data.append({
-            "Id":
-            str(user.id),
-            "Username":
-            user.username,
-            "Email": 
-            user.email,
-            "Roles":
-            user_roles,
-            "Modules":
-            user_modules,
-            "Created":
-            user.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-            "LastModified":
-            user.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        })
-      return users_data
+  Returns:
+      dict or None: The users (`Items`) and the cursor of the next page (`NextCursor`, None on the last page), or None if an error occurs.
+  """
+  try:
+    with session_scope() as session:
+      query = _created_between(_user_list_query(session), User, created_after, created_before)
+      if module_id:
+        query = query.filter(User.id.in_(session.query(user_module_table.c.user_id).filter(user_module_table.c.module_id == uuid.UUID(module_id))))
+      if search:
+        query = query.filter((User.username.ilike(f'%{search}%')) | (User.email.ilike(f'%{search}%')))
+      users, next_cursor = _keyset_page(query, User, limit, cursor)
+      return {'Items': _user_dicts(session, users), 'NextCursor': next_cursor}
   except Exception as e:
-    print(f"An error occured: {e}")
-    return []
+    logging.error(f'Failed to retrieve a page of users. {e}')
+    return None
 
 
+@query_budget(3)
 def get_user(credential: str):
   """
   Retrieves a user by email or username from the database.
@@ -539,10 +581,11 @@ def get_user(credential: str):
   """
   try:
     with session_scope() as session:
+      user_options = (selectinload(User.roles), selectinload(User.modules).load_only(Module.id, Module.name))
       if is_email(credential):
-        user = session.query(User).filter(User.email == credential).first()
+        user = session.query(User).options(*user_options).filter(User.email == credential).first()
       else:
-        user = session.query(User).filter(User.username == credential).first()
+        user = session.query(User).options(*user_options).filter(User.username == credential).first()
 
       if user:
         user_data = {
@@ -553,15 +596,15 @@ def get_user(credential: str):
             'Email':
             user.email,
             'Roles':
-            get_user_roles([role.id for role in user.roles]),
+            [{"Id": str(role.id), "Name": role.name} for role in user.roles],
             'Modules': 
-            get_user_modules([module.id for module in user.modules]),
+            [{"Id": str(module.id), "Name": module.name} for module in user.modules],
             'password_hash':
             user.password_hash,
             'Created':
-            user.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+            format_timestamp(user.created),
             'LastModified':
-            user.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+            format_timestamp(user.last_modified)
         }
 
         return user_data
@@ -616,8 +659,8 @@ def update_user(user_id,
 
         updated_user = {
             "Id": str(user.id),
-            "Created": user.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-            "LastModified": current_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+            "Created": format_timestamp(user.created),
+            "LastModified": format_timestamp(current_time),
             "Username": user.username,
             "Email": user.email,
             "Roles": get_roles_as_dicts(user.roles),
@@ -662,8 +705,8 @@ def upload_files(files, module_ids: list[str]=None):
               "Id": existing_doc.id,
               "Name": existing_doc.name,
               "Content_hash": existing_doc.content_hash,
-              "Created": existing_doc.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-              "LastModified": existing_doc.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+              "Created": format_timestamp(existing_doc.created),
+              "LastModified": format_timestamp(existing_doc.last_modified)
           }))
           continue
 
@@ -678,8 +721,8 @@ def upload_files(files, module_ids: list[str]=None):
             "Id": str(document.id),
             "Name": document.name,
             "Content_hash": document.content_hash,
-            "Created": document.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-            "LastModified": document.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+            "Created": format_timestamp(document.created),
+            "LastModified": format_timestamp(document.last_modified)
         }})
 
   except Exception as e:
@@ -689,57 +732,103 @@ def upload_files(files, module_ids: list[str]=None):
   return responses
 
 # FILES METADATA
+def _document_rows(files: list[dict], originals: dict, now: datetime):
+  """
+  Builds the `documents` rows of new files. `content_hash` is unique, a file whose content is already stored is linked to the
+  document holding the hash through `duplicate_of` instead. `originals` maps the stored hashes to their documents and is
+  extended by the hashes of this batch, whose duplicates are returned apart to be inserted once their original is.
+  """
+  rows, duplicates = [], []
+  for file in files:
+    content_hash = file.get('ContentHash')
+    row = {'id': uuid.uuid4(), 'name': file['Name'], 'url': file['URL'], 'fileType': file['FileType'],
+           'content_hash': content_hash, 'duplicate_of': None, 'created': now, 'last_modified': now}
+    if content_hash in originals:
+      row.update({'content_hash': None, 'duplicate_of': originals[content_hash]})
+      if row['duplicate_of'] is None:
+        duplicates.append((row, content_hash))
+        continue
+    elif content_hash:
+      originals[content_hash] = None
+    rows.append(row)
+  return rows, duplicates
+
 def upload_files_metadata(files, module_id: str):
   """
-  Uploads files metadata to the database.
+  Uploads files metadata to the database and relates the files to the module. Files already stored under the same URL are
+  not duplicated. All files are stored in one transaction with a constant number of queries: one lookup of the existing URLs
+  and content hashes, one `INSERT ... ON CONFLICT` of the new documents and one insert into `document_module`.
   
   Parameters:
-  - files (dict[str, str]): The data to upload. Should consist of `Name`, `URL`, and `FileType`.
+  - files (dict[str, str]): The data to upload. Should consist of `Name`, `URL`, and `FileType`, optionally `ContentHash`.
   - module_id (str): The ID of the module these files are tied to.
   
   Returns:
-  - list (list[dict[str, str | any]]): A list of the metadata of uploaded files. An error message for each failed file.
-  """
-  with session_scope() as session:
-    responses = []
-    for file in files:
-      existing_file = session.query(Document).filter(Document.url == file['URL']).first()
-      if existing_file:
-        responses.append({
-          "Id": str(existing_file.id),
-          "Name": existing_file.name,
-          'URL': existing_file.url,
-          'FileType': existing_file.fileType,
-          "Created": existing_file.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-          "LastModified": existing_file.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
-        })
-        logging.info(f'Found existing file for {file['URL']}.')
-        continue
-      try:
-        file_metadata = Document(id=uuid.uuid4(), name=file['Name'], url=file['URL'], fileType=file['FileType'])
-        module = session.query(Module).filter(Module.id == module_id).first()
-        modules = []
-        file_modules = file_metadata.modules
-        modules.extend(file_modules)
-        modules.append(module)
-        file_metadata.modules = modules
-        
-        session.add(file_metadata)
-        session.commit()
-        responses.append({
-          "Id": str(file_metadata.id),
-          "Name": file_metadata.name,
-          'URL': file_metadata.url,
-          'FileType': file_metadata.fileType,
-          "Created": file_metadata.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-          "LastModified": file_metadata.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
-        })
-      except Exception as e:
-        logging.error(f"An error occurred saving file metadata: {e}")
-        responses.append({'error': f'An error occurred during upload. {str(e)}'})
-        continue
-    return responses
+  - list (list[dict[str, str | any]]): A list of the metadata of uploaded files. An error message for each file if they could not be stored.
+  """
+  # Failed storage uploads are passed on by some callers, they are reported back as errors.
+  stored_files = [file for file in files if 'error' not in file and file.get('URL')]
+  if not stored_files:
+    return [{'error': 'An error occurred during upload. The file was not stored.'} for _ in files]
+  try:
+    with session_scope() as session:
+      if not session.query(Module.id).filter(Module.id == module_id).first():
+        logging.error(f'Module with ID: {module_id} not found, file metadata not stored.')
+        return [{'error': 'An error occurred during upload. Module not found.'} for _ in files]
+
+      urls = {file['URL'] for file in stored_files}
+      hashes = list({file['ContentHash'] for file in stored_files if file.get('ContentHash')})
+      stored = session.query(Document.id, Document.name, Document.url, Document.fileType, Document.content_hash, Document.created, Document.last_modified) \
+                      .filter(Document.url.in_(list(urls)) | Document.content_hash.in_(hashes)).all()
+      documents = {}
+      for document in stored:
+        if document.url in urls and document.url not in documents:
+          documents[document.url] = document
+          logging.info(f'Found existing file for {document.url}.')
+      originals = {document.content_hash: document.id for document in stored if document.content_hash}
+
+      new_files, seen = [], set(documents)
+      for file in stored_files:
+        if file['URL'] not in seen:
+          seen.add(file['URL'])
+          new_files.append(file)
+      rows, duplicates = _document_rows(new_files, originals, current_time_prague())
+      returning = (Document.id, Document.name, Document.url, Document.fileType, Document.content_hash, Document.created, Document.last_modified)
+      if rows:
+        inserted = session.execute(pg_insert(Document).values(rows).on_conflict_do_nothing(index_elements=['content_hash']).returning(*returning)).all()
+        documents.update({document.url: document for document in inserted})
+        originals.update({document.content_hash: document.id for document in inserted if document.content_hash})
+        # Content stored by a concurrent upload in the meantime, the documents are stored without the hash and are linked to
+        # the concurrent upload on their first agent sync (see `set_document_content_hash`).
+        later = [{**row, 'content_hash': None} for row in rows if row['url'] not in documents]
+        # Duplicates of this batch are linked to their original, unless that was skipped itself.
+        later += [{**row, 'duplicate_of': originals.get(content_hash)} for row, content_hash in duplicates]
+        if later:
+          inserted = session.execute(pg_insert(Document).values(later).returning(*returning)).all()
+          documents.update({document.url: document for document in inserted})
+
+      session.execute(pg_insert(document_module_table).values([{'document_id': document.id, 'module_id': module_id} for document in documents.values()])
+                      .on_conflict_do_nothing())
+      session.commit()
+      return [_serialize_file(documents[file['URL']]) if file.get('URL') in documents and 'error' not in file
+              else {'error': 'An error occurred during upload. The file was not stored.'} for file in files]
+  except Exception as e:
+    logging.error(f"An error occurred saving file metadata: {e}")
+    return [{'error': f'An error occurred during upload. {str(e)}'} for _ in files]
+
 
+_serialize_file = compile_serializer({
+    "Id": ("id", str),
+    "Name": "name",
+    "URL": "url",
+    "FileType": "fileType",
+    "Created": ("created", format_timestamp),
+    "LastModified": ("last_modified", format_timestamp),
+})
+
+def _file_list_query(session, module_id: str):
+  return session.query(Document.id, Document.name, Document.url, Document.fileType, Document.created, Document.last_modified) \
+                .join(document_module_table, document_module_table.c.document_id == Document.id).filter(document_module_table.c.module_id == module_id)
 
 def get_all_files(module_id: str):
   """
@@ -753,23 +842,34 @@ def get_all_files(module_id: str):
   """
   try:
     with session_scope() as session:
-      docs = session.query(Document).join(Document.modules).filter(Module.id == module_id).all()
-      return [{
-          "Id":
-          str(doc.id),
-          "Name":
-          doc.name,
-          "URL": doc.url,
-          "FileType": doc.fileType,
-          "Created":
-          doc.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-          "LastModified":
-          doc.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
-      } for doc in docs]
+      return [_serialize_file(doc) for doc in _file_list_query(session, module_id).all()]
   except Exception as e:
     print(f"An error occurred: {e}")
     return None
 
+def get_files_page(module_id: str, limit: int, cursor: tuple=None, created_after: datetime=None, created_before: datetime=None):
+  """
+  Retrieves a page of the files related to the set module, newest first.
+
+  Parameters:
+      module_id (string): The unique identifier of the selected module.
+      limit (int): The maximum number of files returned.
+      cursor (tuple[datetime, UUID]): The decoded `NextCursor` of the previous page, see `decode_cursor`. None for the first page.
+      created_after (datetime): Only files uploaded at or after this time.
+      created_before (datetime): Only files uploaded before this time.
+
+  Returns:
+      dict or None: The files (`Items`) and the cursor of the next page (`NextCursor`, None on the last page), or None if an error occurs.
+  """
+  try:
+    with session_scope() as session:
+      query = _created_between(_file_list_query(session, module_id), Document, created_after, created_before)
+      docs, next_cursor = _keyset_page(query, Document, limit, cursor)
+      return {'Items': [_serialize_file(doc) for doc in docs], 'NextCursor': next_cursor}
+  except Exception as e:
+    logging.error(f'Failed to retrieve a page of files of module {module_id}. {e}')
+    return None
+
 
 def delete_doc(docId, module_id: str):
   """
@@ -806,6 +906,7 @@ def delete_doc(docId, module_id: str):
       else:
         session.delete(document)
         session.commit()
+        agent_cache.clear()
         print(f"Deleted document with ID {docId}")
         return docId, file_key
   except Exception as e:
@@ -870,6 +971,150 @@ def get_filesIO_by_id(docIds):
     print(f"An error occurred: {e}")
     return None
 
+def set_document_content_hash(doc_id: str, content_hash: str):
+  """
+  Backfills the content hash of a document that was stored before hashes were recorded on upload.
+  If another document already holds the same hash, the document is linked to it as a duplicate instead and
+  `get_agent_data` reports the original's hash for it. Only the cached data of the agents using the document is invalidated.
+
+  Parameters:
+      doc_id (str): The ID of the document.
+      content_hash (str): The SHA-256 hex digest of the document content.
+
+  Returns:
+      bool: True if the hash or the original was stored, False otherwise.
+  """
+  try:
+    with session_scope() as session:
+      document = session.query(Document).filter(Document.id == uuid.UUID(str(doc_id))).first()
+      if not document or document.content_hash or document.duplicate_of:
+        return False
+      original = session.query(Document.id).filter(Document.content_hash == content_hash).first()
+      if original:
+        document.duplicate_of = original.id
+      else:
+        document.content_hash = content_hash
+      agent_ids = [str(row.agent_id) for row in session.query(agent_file_table.c.agent_id).filter(agent_file_table.c.document_id == document.id)]
+      session.commit()
+      agent_cache.invalidate(*agent_ids)
+      return True
+  except Exception as e:
+    logging.error(f'Failed to backfill content hash of document {doc_id}. {e}')
+    return False
+
+
+def get_openai_file(content_hash: str):
+  """
+  Retrieves the cached OpenAI file uploaded for the given document content.
+
+  Parameters:
+      content_hash (str): The SHA-256 hex digest of the document content.
+
+  Returns:
+      dict or None: The `FileId` of the cached file and whether it is `Stale` (due for re-validation against OpenAI), or None if the content was never uploaded.
+  """
+  try:
+    with session_scope() as session:
+      cached = session.query(OpenAIFile).filter(OpenAIFile.content_hash == content_hash).first()
+      if not cached:
+        return None
+      # `last_validated` is stored as the naive Prague time, like it is written by `register_openai_file` and `mark_openai_file_validated`
+      revalidate_before = current_time_prague().replace(tzinfo=None) - timedelta(seconds=OPENAI_FILE_REVALIDATE_AFTER)
+      return {
+        'FileId': cached.file_id,
+        'Stale': cached.last_validated is None or cached.last_validated < revalidate_before
+      }
+  except Exception as e:
+    logging.error(f'Failed to retrieve cached OpenAI file for {content_hash}. {e}')
+    return None
+
+
+def register_openai_file(content_hash: str, file_id: str, filename: str=None):
+  """
+  Adds an uploaded OpenAI file to the file cache. If the same content was cached concurrently, the cached file wins.
+
+  Parameters:
+      content_hash (str): The SHA-256 hex digest of the document content.
+      file_id (str): The OpenAI ID of the uploaded file.
+      filename (str): The name the file was uploaded under.
+
+  Returns:
+      str or None: The OpenAI file ID cached for the content or None if the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      try:
+        session.add(OpenAIFile(content_hash=content_hash, file_id=file_id, filename=filename, last_validated=current_time_prague().replace(tzinfo=None)))
+        session.flush()
+        return file_id
+      except IntegrityError:
+        session.rollback()
+        existing = session.query(OpenAIFile).filter(OpenAIFile.content_hash == content_hash).first()
+        return existing.file_id if existing else None
+  except Exception as e:
+    logging.error(f'Failed to cache OpenAI file {file_id}. {e}')
+    return None
+
+
+def mark_openai_file_validated(content_hash: str):
+  """
+  Records that the cached OpenAI file for the given content was confirmed to still exist on OpenAI.
+
+  Parameters:
+      content_hash (str): The SHA-256 hex digest of the document content.
+  """
+  try:
+    with session_scope() as session:
+      session.query(OpenAIFile).filter(OpenAIFile.content_hash == content_hash).update({'last_validated': current_time_prague().replace(tzinfo=None)}, synchronize_session=False)
+  except Exception as e:
+    logging.error(f'Failed to mark cached OpenAI file for {content_hash} as validated. {e}')
+
+
+def remove_openai_file(content_hash: str=None, file_id: str=None):
+  """
+  Removes an entry from the OpenAI file cache either by content hash or by OpenAI file ID.
+
+  Parameters:
+      content_hash (str): The SHA-256 hex digest of the document content.
+      file_id (str): The OpenAI ID of the cached file.
+  """
+  try:
+    with session_scope() as session:
+      query = session.query(OpenAIFile)
+      if content_hash is not None:
+        query = query.filter(OpenAIFile.content_hash == content_hash)
+      elif file_id is not None:
+        query = query.filter(OpenAIFile.file_id == file_id)
+      else:
+        return
+      query.delete(synchronize_session=False)
+  except Exception as e:
+    logging.error(f'Failed to remove cached OpenAI file {content_hash or file_id}. {e}')
+
+
+def get_cached_file_ids(file_ids: list[str]):
+  """
+  Filters the given OpenAI file IDs down to the ones held by the OpenAI file cache.
+
+  Parameters:
+      file_ids (list[str]): The OpenAI file IDs to check.
+
+  Returns:
+      set[str] or None: The IDs of cached files. These are shared across chats and must not be deleted by chat cleanup.
+      None if the lookup fails, in which case none of the files may be deleted.
+  """
+  valid_ids = [file_id for file_id in file_ids if file_id and isinstance(file_id, str)]
+  if not valid_ids:
+    return set()
+  try:
+    with session_scope() as session:
+      rows = session.query(OpenAIFile.file_id).filter(OpenAIFile.file_id.in_(valid_ids)).all()
+      return {row.file_id for row in rows}
+  except Exception as e:
+    logging.error(f'Failed to resolve cached OpenAI files. {e}')
+    return None
+
+
 def get_agent_data(agentId):
   """
   Retrieves detailed information and associated documents for a specific agent based on the agent's ID.
@@ -879,10 +1124,14 @@ def get_agent_data(agentId):
 
   Returns:
       dict or None: A dictionary containing the agent's details and documents if found, None otherwise.
+      Served from `agent_cache` when possible, a copy is returned so callers may modify it.
   """
+  cached = agent_cache.get(str(agentId))
+  if cached is not None:
+    return copy.deepcopy(cached)
   try:
     with session_scope() as session:
-      agent = session.query(Agent).filter_by(id=agentId).first()
+      agent = session.query(Agent).options(selectinload(Agent.documents).selectinload(Document.original)).filter_by(id=agentId).first()
       if not agent:
         return None
       
@@ -897,11 +1146,13 @@ def get_agent_data(agentId):
         "AgentPointer": str(agent.agent_id_pointer),
         "Director": agent.director,
         "PromptChaining": agent.prompt_chaining,
-        "Documents": [{"Id": str(doc.id), "Name": doc.name, 'URL': doc.url} for doc in agent.documents],
-        "Created": agent.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        "LastModified": agent.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        "Documents": [{"Id": str(doc.id), "Name": doc.name, 'URL': doc.url, 'ContentHash': doc.content_hash or (doc.original.content_hash if doc.original else None)}
+                      for doc in agent.documents],
+        "Created": format_timestamp(agent.created),
+        "LastModified": format_timestamp(agent.last_modified)
       }
-      return agent_dict
+      agent_cache.set(agent_dict['Id'], agent_dict)
+      return copy.deepcopy(agent_dict)
   except InvalidTextRepresentation as e:
     print(f'Invalid input! {e}')
     return None
@@ -910,6 +1161,217 @@ def get_agent_data(agentId):
     return None
 
 
+def get_agent_assistant(config_hash: str):
+  """
+  Retrieves a pooled OpenAI assistant by the hash of the agent configuration it was created from.
+
+  Parameters:
+      config_hash (str): The hash of the agent configuration (agent ID, system prompt, model and tools, see `compute_agent_config_hash`).
+
+  Returns:
+      dict or None: The OpenAI IDs of the pooled assistant and its resources if found, None otherwise.
+  """
+  try:
+    with session_scope() as session:
+      assistant = session.query(AgentAssistant).filter(AgentAssistant.config_hash == config_hash).first()
+      if not assistant:
+        return None
+      return {
+        'AgentId': str(assistant.agent_id),
+        'AssistantId': assistant.oai_assistant_id,
+        'VectorStoreId': assistant.vector_store_id,
+        'FileIds': assistant.file_ids or []
+      }
+  except Exception as e:
+    logging.error(f'Failed to retrieve pooled assistant for config {config_hash}. {e}')
+    return None
+
+
+def register_agent_assistant(agent_id: str, config_hash: str, oai_assistant_id: str, vector_store_id: str=None, file_ids: list[str]=None):
+  """
+  Registers an OpenAI assistant in the assistant pool. If another worker registered an assistant for the same
+  configuration in the meantime, the already registered assistant wins.
+
+  Parameters:
+      agent_id (str): The ID of the database-stored agent the assistant was created for.
+      config_hash (str): The hash of the agent configuration the assistant was created from.
+      oai_assistant_id (str): The OpenAI ID of the assistant.
+      vector_store_id (str): The OpenAI ID of the vector store used by the assistant, if any.
+      file_ids (list[str]): The OpenAI IDs of the files uploaded for the assistant, if any.
+
+  Returns:
+      str or None: The OpenAI ID of the pooled assistant for this configuration or None if the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      try:
+        session.add(AgentAssistant(id=uuid.uuid4(),
+                                   agent_id=uuid.UUID(str(agent_id)),
+                                   config_hash=config_hash,
+                                   oai_assistant_id=oai_assistant_id,
+                                   vector_store_id=vector_store_id or None,
+                                   file_ids=file_ids or []))
+        session.flush()
+        return oai_assistant_id
+      except IntegrityError:
+        session.rollback()
+        existing = session.query(AgentAssistant).filter(AgentAssistant.config_hash == config_hash).first()
+        return existing.oai_assistant_id if existing else None
+  except Exception as e:
+    logging.error(f'Failed to register pooled assistant {oai_assistant_id} for agent {agent_id}. {e}')
+    return None
+
+
+def get_pooled_assistant_ids(oai_assistant_ids: list[str]):
+  """
+  Filters the given OpenAI assistant IDs down to the ones that belong to the assistant pool.
+
+  Parameters:
+      oai_assistant_ids (list[str]): The OpenAI assistant IDs to check.
+
+  Returns:
+      set[str] or None: The IDs of pooled assistants. These must not be deleted when a chat ends.
+      None if the lookup fails, in which case none of the assistants may be deleted.
+  """
+  valid_ids = [oai_id for oai_id in oai_assistant_ids if oai_id]
+  if not valid_ids:
+    return set()
+  try:
+    with session_scope() as session:
+      rows = session.query(AgentAssistant.oai_assistant_id).filter(AgentAssistant.oai_assistant_id.in_(valid_ids)).all()
+      return {row.oai_assistant_id for row in rows}
+  except Exception as e:
+    logging.error(f'Failed to resolve pooled assistants. {e}')
+    return None
+
+
+def get_agent_vector_store(agent_id: str):
+  """
+  Retrieves the persistent OpenAI vector store of an agent along with the files it currently holds.
+
+  Parameters:
+      agent_id (str): The ID of the database-stored agent.
+
+  Returns:
+      dict or None: The OpenAI `VectorStoreId` and the `Files` in the store as OpenAI file IDs mapped to their document IDs, or None if the agent has no vector store yet.
+  """
+  try:
+    with session_scope() as session:
+      store = session.query(VectorStore).filter(VectorStore.agent_id == uuid.UUID(str(agent_id))).first()
+      if not store:
+        return None
+      return {
+        'VectorStoreId': store.vector_store_id,
+        'Files': {file.file_id: str(file.document_id) if file.document_id else None for file in store.files}
+      }
+  except Exception as e:
+    logging.error(f'Failed to retrieve vector store of agent {agent_id}. {e}')
+    return None
+
+
+def register_agent_vector_store(agent_id: str, vector_store_id: str, files: dict[str, str]=None):
+  """
+  Registers the persistent OpenAI vector store of an agent. If another worker registered a vector store for the agent
+  in the meantime, the already registered vector store wins.
+
+  Parameters:
+      agent_id (str): The ID of the database-stored agent.
+      vector_store_id (str): The OpenAI ID of the vector store.
+      files (dict[str, str]): The OpenAI file IDs the vector store was created with, mapped to their document IDs.
+
+  Returns:
+      str or None: The OpenAI ID of the agent's vector store or None if the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      try:
+        store = VectorStore(id=uuid.uuid4(), agent_id=uuid.UUID(str(agent_id)), vector_store_id=vector_store_id)
+        store.files = [VectorStoreFile(file_id=file_id, document_id=uuid.UUID(str(doc_id)) if doc_id else None)
+                       for file_id, doc_id in (files or {}).items()]
+        session.add(store)
+        session.flush()
+        return vector_store_id
+      except IntegrityError:
+        session.rollback()
+        existing = session.query(VectorStore).filter(VectorStore.agent_id == uuid.UUID(str(agent_id))).first()
+        return existing.vector_store_id if existing else None
+  except Exception as e:
+    logging.error(f'Failed to register vector store {vector_store_id} for agent {agent_id}. {e}')
+    return None
+
+
+def update_vector_store_files(vector_store_id: str, added: dict[str, str]=None, removed: list[str]=None):
+  """
+  Records files added to or removed from a persistent vector store.
+
+  Parameters:
+      vector_store_id (str): The OpenAI ID of the vector store.
+      added (dict[str, str]): The OpenAI file IDs added to the store, mapped to their document IDs.
+      removed (list[str]): The OpenAI file IDs removed from the store.
+
+  Returns:
+      bool: True if the changes were recorded, False otherwise.
+  """
+  try:
+    with session_scope() as session:
+      store = session.query(VectorStore).filter(VectorStore.vector_store_id == vector_store_id).first()
+      if not store:
+        logging.error(f'Vector store {vector_store_id} is not registered.')
+        return False
+      if removed:
+        session.query(VectorStoreFile).filter(VectorStoreFile.vector_store_id == store.id,
+                                              VectorStoreFile.file_id.in_(removed)).delete(synchronize_session=False)
+      for file_id, doc_id in (added or {}).items():
+        session.merge(VectorStoreFile(vector_store_id=store.id, file_id=file_id, document_id=uuid.UUID(str(doc_id)) if doc_id else None))
+      return True
+  except Exception as e:
+    logging.error(f'Failed to record file changes of vector store {vector_store_id}. {e}')
+    return False
+
+
+def get_persistent_vector_store_ids(vector_store_ids: list[str]):
+  """
+  Filters the given OpenAI vector store IDs down to the persistent vector stores of agents and the vector stores owned by pooled assistants.
+
+  Parameters:
+      vector_store_ids (list[str]): The OpenAI vector store IDs to check.
+
+  Returns:
+      set[str] or None: The IDs of persistent vector stores. These are shared across chats and must not be deleted when a chat ends.
+      None if the lookup fails, in which case none of the vector stores may be deleted.
+  """
+  valid_ids = [vs_id for vs_id in vector_store_ids if vs_id]
+  if not valid_ids:
+    return set()
+  try:
+    with session_scope() as session:
+      rows = session.query(VectorStore.vector_store_id).filter(VectorStore.vector_store_id.in_(valid_ids)).all()
+      pooled_rows = session.query(AgentAssistant.vector_store_id).filter(AgentAssistant.vector_store_id.in_(valid_ids)).all()
+      return {row.vector_store_id for row in rows} | {row.vector_store_id for row in pooled_rows}
+  except Exception as e:
+    logging.error(f'Failed to resolve persistent vector stores. {e}')
+    return None
+
+
+def get_document_agent_ids(doc_id: str):
+  """
+  Retrieves the IDs of the agents a document is attached to.
+
+  Parameters:
+      doc_id (str): The ID of the document.
+
+  Returns:
+      list[str]: The IDs of the agents using the document.
+  """
+  try:
+    with session_scope() as session:
+      rows = session.query(agent_file_table.c.agent_id).filter(agent_file_table.c.document_id == uuid.UUID(str(doc_id))).all()
+      return [str(row.agent_id) for row in rows]
+  except Exception as e:
+    logging.error(f'Failed to retrieve agents of document {doc_id}. {e}')
+    return []
+
+
 def upload_agent_metadata(agent_details: dict[str, str],
                           module_id: str, document_ids: list[str]=None):
   """
@@ -945,6 +1407,7 @@ def upload_agent_metadata(agent_details: dict[str, str],
 
       session.add(new_agent)
       session.commit()
+      agent_cache.invalidate(str(new_agent.id))
 
       return {
           "Id": str(new_agent.id),
@@ -956,8 +1419,8 @@ def upload_agent_metadata(agent_details: dict[str, str],
           "AgentPointer": str(new_agent.agent_id_pointer),
           "Description": new_agent.description,
           "Documents": [{"Id": str(doc.id), "Name": doc.name} for doc in new_agent.documents],
-          "Created": new_agent.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-          "LastModified": new_agent.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+          "Created": format_timestamp(new_agent.created),
+          "LastModified": format_timestamp(new_agent.last_modified)
       }
 
   except Exception as e:
@@ -965,6 +1428,38 @@ def upload_agent_metadata(agent_details: dict[str, str],
     return None
 
 
+_serialize_agent = compile_serializer({
+    "Id": ("id", str),
+    "Name": "name",
+    "Model": "model",
+    "Instructions": "system_prompt",
+    "Description": "description",
+    "WrapperPrompt": "wrapper_prompt",
+    "InitialPrompt": "initial_prompt",
+    "AgentPointer": ("agent_id_pointer", str),
+    "Director": "director",
+    "Summarizer": "summarizer",
+    "Analytic": "analytic",
+    "PromptChaining": "prompt_chaining",
+    "Created": ("created", format_timestamp),
+    "LastModified": ("last_modified", format_timestamp),
+})
+
+def _agent_list_query(session, module_id: str):
+  return session.query(Agent.id, Agent.name, Agent.model, Agent.system_prompt, Agent.description, Agent.wrapper_prompt, Agent.initial_prompt,
+                       Agent.agent_id_pointer, Agent.director, Agent.summarizer, Agent.analytic, Agent.prompt_chaining, Agent.created,
+                       Agent.last_modified).filter(Agent.module_id == module_id)
+
+def _agent_dicts(session, agents):
+  agent_ids = [agent.id for agent in agents]
+  documents = defaultdict(list)
+  if agent_ids:
+    for agent_id, doc_id, doc_name in session.query(agent_file_table.c.agent_id, Document.id, Document.name) \
+                                             .join(Document, Document.id == agent_file_table.c.document_id).filter(agent_file_table.c.agent_id.in_(agent_ids)):
+      documents[agent_id].append({"Id": str(doc_id), "Name": doc_name})
+  return [{**_serialize_agent(agent), "Documents": documents[agent.id]} for agent in agents]
+
+@query_budget(2)
 def retrieve_all_agents(module_id: str):
   """
   Retrieves all agents related to the selected module from the database.
@@ -980,30 +1475,36 @@ def retrieve_all_agents(module_id: str):
   """
   try:
     with session_scope() as session:
-      agents = session.query(Agent).join(Agent.module).filter(Module.id == module_id).all()
-      
-      return [{
-        "Id": str(agent.id),
-        "Name": agent.name,
-        "Model": agent.model,
-        "Instructions": agent.system_prompt,
-        "Description": agent.description,
-        "WrapperPrompt": agent.wrapper_prompt,
-        "InitialPrompt": agent.initial_prompt,
-        "AgentPointer": str(agent.agent_id_pointer),
-        "Director": agent.director,
-        "Summarizer": agent.summarizer,
-        "Analytic": agent.analytic,
-        "PromptChaining": agent.prompt_chaining,
-        "Documents": [{"Id": str(doc.id), "Name": doc.name} for doc in agent.documents],
-        "Created": agent.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        "LastModified": agent.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
-      } for agent in agents]
+      return _agent_dicts(session, _agent_list_query(session, module_id).all())
 
   except Exception as e:
     print(f"An error occurred: {e}")
     return None
 
+@query_budget(2)
+def retrieve_agents_page(module_id: str, limit: int, cursor: tuple=None, created_after: datetime=None, created_before: datetime=None):
+  """
+  Retrieves a page of the agents related to the selected module, newest first.
+
+  Parameters:
+    module_id (str): The ID of the module to filter agents by.
+    limit (int): The maximum number of agents returned.
+    cursor (tuple[datetime, UUID]): The decoded `NextCursor` of the previous page, see `decode_cursor`. None for the first page.
+    created_after (datetime): Only agents created at or after this time.
+    created_before (datetime): Only agents created before this time.
+
+  Returns:
+      dict or None: The agents (`Items`) and the cursor of the next page (`NextCursor`, None on the last page), or None if an error occurs.
+  """
+  try:
+    with session_scope() as session:
+      query = _created_between(_agent_list_query(session, module_id), Agent, created_after, created_before)
+      agents, next_cursor = _keyset_page(query, Agent, limit, cursor)
+      return {'Items': _agent_dicts(session, agents), 'NextCursor': next_cursor}
+  except Exception as e:
+    logging.error(f'Failed to retrieve a page of agents of module {module_id}. {e}')
+    return None
+
 def delete_agent(agent_id):
   """
   Deletes a specific agent from the database based on the agent's ID.
@@ -1021,12 +1522,16 @@ def delete_agent(agent_id):
       result = session.query(Agent).filter_by(id=agent_id).first()
       if result:
         result_id = result.id
+        invalidate_agent_assistants(result_id, session)
+        delete_agent_vector_store(result_id, session)
         session.delete(result)
         session.commit()
         logging.info(f"Deleted agent with ID {agent_id}")
         tied_agents = session.query(Agent).filter(Agent.agent_id_pointer == result_id).all()
         for agent in tied_agents:
           agent.agent_id_pointer = None
+        session.commit()
+        agent_cache.invalidate(str(result_id), *[str(agent.id) for agent in tied_agents])
         logging.info(f'Deleted agent pointer associations.')
         return agent_id
       else:
@@ -1061,6 +1566,8 @@ def update_agent(agent_id, name, description, instructions, wrapper_prompt, init
       if not result:
         return None
 
+      # Document changes are synced into the agent's vector store, only gaining or losing `file_search` needs a new assistant.
+      previous_config = (result.system_prompt, result.model, result.agent_id_pointer, bool(result.documents))
       if document_ids is not []:
         documents = session.query(Document).filter(
             Document.id.in_(document_ids)).all()
@@ -1073,7 +1580,10 @@ def update_agent(agent_id, name, description, instructions, wrapper_prompt, init
       result.initial_prompt = initial_prompt
       result.model = model
       result.agent_id_pointer = uuid.UUID(agent_pointer) if agent_pointer else None
+      if previous_config != (result.system_prompt, result.model, result.agent_id_pointer, bool(result.documents)):
+        invalidate_agent_assistants(result.id, session)
       session.commit()
+      agent_cache.invalidate(str(result.id))
       return {
         "Id": str(result.id),
         "Name": result.name,
@@ -1086,8 +1596,8 @@ def update_agent(agent_id, name, description, instructions, wrapper_prompt, init
         "InitialPrompt": result.initial_prompt,
         "AgentPointer": str(result.agent_id_pointer),
         "PromptChaining": result.prompt_chaining,
-        "Created": result.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        "LastModified": result.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        "Created": format_timestamp(result.created),
+        "LastModified": format_timestamp(result.last_modified)
       }
       
   except Exception as e:
@@ -1124,8 +1634,8 @@ def get_director_agent_info(module_id: str):
         "InitialPrompt": result.initial_prompt,
         "AgentPointer": str(result.agent_id_pointer),
         "PromptChaining": result.prompt_chaining,
-        "Created": result.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        "LastModified": result.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        "Created": format_timestamp(result.created),
+        "LastModified": format_timestamp(result.last_modified)
       }
   
   except SQLAlchemyError as e:
@@ -1164,8 +1674,8 @@ def get_analytic_agent(module_id):
         "InitialPrompt": result.initial_prompt,
         "AgentPointer": str(result.agent_id_pointer),
         "PromptChaining": result.prompt_chaining,
-        "Created": result.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        "LastModified": result.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        "Created": format_timestamp(result.created),
+        "LastModified": format_timestamp(result.last_modified)
       }
 
   except SQLAlchemyError as e:
@@ -1204,8 +1714,8 @@ def get_summarizer_agent(module_id):
         "InitialPrompt": result.initial_prompt,
         "AgentPointer": str(result.agent_id_pointer),
         "PromptChaining": result.prompt_chaining,
-        "Created": result.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        "LastModified": result.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        "Created": format_timestamp(result.created),
+        "LastModified": format_timestamp(result.last_modified)
       }
 
   except SQLAlchemyError as e:
@@ -1239,7 +1749,8 @@ def db_create_chat_session(thread_id: str, module_id: str, user_id: str):
                                  userID=uuid.UUID(user_id),
                                  convo_analytics=module.convo_analytics,
                                  summaries=module.summaries,
-                                 module_name=module.name)
+                                 module_name=module.name,
+                                 mirrored=True)
       session.add(chat_session)
       session.commit()
       return {
@@ -1248,8 +1759,8 @@ def db_create_chat_session(thread_id: str, module_id: str, user_id: str):
         'UserID': str(chat_session.userID),
         'LastAgent': str(chat_session.last_agent),
         'ThreadID': chat_session.threadID,
-        'Created': chat_session.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        'LastModified': chat_session.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        'Created': format_timestamp(chat_session.created),
+        'LastModified': format_timestamp(chat_session.last_modified)
       }
   except SQLAlchemyError as e:
     logging.error(f"An error occurred while creating chat session for thread {thread_id}. {e}")
@@ -1258,6 +1769,52 @@ def db_create_chat_session(thread_id: str, module_id: str, user_id: str):
     logging.error(f"An error occurred while creating chat session for thread {thread_id}. {e}")
     return None
   
+def _chat_session_dicts(session, chat_sessions):
+  module_ids = [str(chat_session.moduleID) for chat_session in chat_sessions if chat_session.moduleID]
+
+  modules = session.query(Module).filter(Module.id.in_(module_ids)).all() if module_ids else []
+  modules_info = {str(module.id): {'Name': module.name, 'Analytics': module.convo_analytics, 'Summaries': module.summaries} for module in modules}
+
+  def get_module_name(module_name: str, module_id: str = None):
+    if module_id and module_id in modules_info:
+      return modules_info[module_id]['Name']
+    return module_name
+  
+  def get_module_analytics(module_analytics: bool, module_id: str = None):
+    if module_id and module_id in modules_info:
+      return modules_info[module_id]['Analytics']
+    return module_analytics
+  
+  def get_module_summaries(module_summaries: bool, module_id: str =None):
+    if module_id and module_id in modules_info:
+      return modules_info[module_id]['Summaries']
+    return module_summaries
+
+# MODULE NAME SHOULD BE UPDATED HERE WHEN UPDATING THE MODULE. CURRENT APPROACH WON'T SOLVE IF THE MODULE IS DELETED --> WHEN MODULE IS DELETED, THE
+# NAME THAT THE CHAT SESSION HAD PRIOR TO THE MODULE UPDATE WILL BE DISPLAYED. at least that's what i think
+  return [{
+    "Id": str(chat_session.id),
+    'UserName': chat_session.user_email,
+    'LastAgent': str(chat_session.last_agent),
+    'ModuleName': get_module_name(chat_session.module_name, str(chat_session.moduleID) if chat_session.moduleID else None),
+    'ModuleID': str(chat_session.moduleID) if chat_session.moduleID else None,
+    'Analytics': get_module_analytics(chat_session.convo_analytics, str(chat_session.moduleID) if chat_session.moduleID else None),
+    'Summaries': get_module_summaries(chat_session.summaries, str(chat_session.moduleID) if chat_session.moduleID else None),
+    'Analysis': chat_session.analysis,
+    'Summary': chat_session.summary,
+    'MessagesLen': chat_session.messages_len,
+    'ThreadID': chat_session.threadID,
+    'Created': format_timestamp(chat_session.created),
+    'LastModified': format_timestamp(chat_session.last_modified)
+  } for chat_session in chat_sessions]
+
+def _chat_session_list_query(session, user_id: str):
+  return session.query(ChatSession.id, ChatSession.last_agent, ChatSession.module_name, ChatSession.moduleID, ChatSession.convo_analytics,
+                       ChatSession.summaries, ChatSession.analysis, ChatSession.summary, ChatSession.messages_len, ChatSession.threadID,
+                       ChatSession.created, ChatSession.last_modified, User.email.label('user_email')) \
+                .join(User, User.id == ChatSession.userID).filter(ChatSession.userID == uuid.UUID(user_id))
+
+@query_budget(2)
 def retrieve_chat_sessions(user_id: str):
   """
   Retrieves all ChatSession rows tied to the `user_id`.
@@ -1270,44 +1827,7 @@ def retrieve_chat_sessions(user_id: str):
   """
   try:
     with session_scope() as session:
-      chat_sessions = session.query(ChatSession).filter(ChatSession.userID == uuid.UUID(user_id)).all()
-      module_ids = [str(chat_session.moduleID) for chat_session in chat_sessions if chat_session.moduleID]
-
-      modules = session.query(Module).filter(Module.id.in_(module_ids)).all()
-      modules_info = {str(module.id): {'Name': module.name, 'Analytics': module.convo_analytics, 'Summaries': module.summaries} for module in modules}
-
-      def get_module_name(module_name: str, module_id: str = None):
-        if module_id and module_id in modules_info:
-          return modules_info[module_id]['Name']
-        return module_name
-      
-      def get_module_analytics(module_analytics: bool, module_id: str = None):
-        if module_id and module_id in modules_info:
-          return modules_info[module_id]['Analytics']
-        return module_analytics
-      
-      def get_module_summaries(module_summaries: bool, module_id: str =None):
-        if module_id and module_id in modules_info:
-          return modules_info[module_id]['Summaries']
-        return module_summaries
-
-# MODULE NAME SHOULD BE UPDATED HERE WHEN UPDATING THE MODULE. CURRENT APPROACH WON'T SOLVE IF THE MODULE IS DELETED --> WHEN MODULE IS DELETED, THE
-# NAME THAT THE CHAT SESSION HAD PRIOR TO THE MODULE UPDATE WILL BE DISPLAYED. at least that's what i think
-      return [{
-        "Id": str(chat_session.id),
-        'UserName': chat_session.user.email,
-        'LastAgent': str(chat_session.last_agent),
-        'ModuleName': get_module_name(chat_session.module_name, str(chat_session.moduleID) if chat_session.moduleID else None),
-        'ModuleID': str(chat_session.moduleID) if chat_session.moduleID else None,
-        'Analytics': get_module_analytics(chat_session.convo_analytics, str(chat_session.moduleID) if chat_session.moduleID else None),
-        'Summaries': get_module_summaries(chat_session.summaries, str(chat_session.moduleID) if chat_session.moduleID else None),
-        'Analysis': chat_session.analysis,
-        'Summary': chat_session.summary,
-        'MessagesLen': chat_session.messages_len,
-        'ThreadID': chat_session.threadID,
-        'Created': chat_session.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        'LastModified': chat_session.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
-      } for chat_session in chat_sessions]
+      return _chat_session_dicts(session, _chat_session_list_query(session, user_id).all())
   except SQLAlchemyError as e:
     logging.error(f"An SQLAlchemy error occurred while retrieving chat sessions for user {user_id}. {e}")
     return None
@@ -1315,6 +1835,33 @@ def retrieve_chat_sessions(user_id: str):
     logging.error(f"An error occurred while retrieving chat sessions for user {user_id}. {e}")
     return None
 
+@query_budget(2)
+def retrieve_chat_sessions_page(user_id: str, limit: int, cursor: tuple=None, module_id: str=None, created_after: datetime=None, created_before: datetime=None):
+  """
+  Retrieves a page of the ChatSession rows tied to the `user_id`, newest first.
+  
+  Parameters:
+    user_id (str): The ID of the user to whom the chat sessions belong to.
+    limit (int): The maximum number of chat sessions returned.
+    cursor (tuple[datetime, UUID]): The decoded `NextCursor` of the previous page, see `decode_cursor`. None for the first page.
+    module_id (str): Only chat sessions held in this module.
+    created_after (datetime): Only chat sessions started at or after this time.
+    created_before (datetime): Only chat sessions started before this time.
+    
+  Returns:
+    dict or None: The chat sessions (`Items`) and the cursor of the next page (`NextCursor`, None on the last page) or None if the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      query = _created_between(_chat_session_list_query(session, user_id), ChatSession, created_after, created_before)
+      if module_id:
+        query = query.filter(ChatSession.moduleID == uuid.UUID(module_id))
+      chat_sessions, next_cursor = _keyset_page(query, ChatSession, limit, cursor)
+      return {'Items': _chat_session_dicts(session, chat_sessions), 'NextCursor': next_cursor}
+  except Exception as e:
+    logging.error(f"An error occurred while retrieving a page of chat sessions for user {user_id}. {e}")
+    return None
+
   
 def delete_chat_session(chat_id: str):
   """
@@ -1373,7 +1920,7 @@ def update_chat_session(chat_session_id: str,
       
       return {
         "Id": str(chat_session.id),
-        'UserName': chat_session.user.email,
+        'UserName': chat_session.user_email,
         'LastAgent': str(chat_session.last_agent),
         'ModuleName': chat_session.module_name,
         'ModuleID': str(chat_session.moduleID),
@@ -1383,8 +1930,449 @@ def update_chat_session(chat_session_id: str,
         'Summary': chat_session.summary,
         'MessagesLen': chat_session.messages_len,
         'ThreadID': chat_session.threadID,
-        'Created': chat_session.created.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
-        'LastModified': chat_session.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        'Created': format_timestamp(chat_session.created),
+        'LastModified': format_timestamp(chat_session.last_modified)
+      }
+  except Exception as e:
+    logging.error(f"An error occurred while updating chat session {chat_session_id}. {e}")
+
+def _message_rows(chat_session_id, messages: list[dict]):
+  now = current_time_prague()
+  return [{
+    'id': uuid.uuid4(),
+    'chat_session_id': chat_session_id,
+    'message_id': message['MessageId'],
+    'role': message['Role'],
+    'content': message['Content'],
+    'attachments': message['Attachments'],
+    'created_at': message['CreatedAt'],
+    'created': now,
+    'last_modified': now
+  } for message in messages]
+
+def store_chat_messages(thread_id: str, messages: list[dict]):
+  """
+  Mirrors new messages of a thread into the `ChatMessage` table and adds them to the `messages_len` of its chat session.
+  Messages are only stored if the chat session of the thread is already mirrored, otherwise they are picked up by
+  `backfill_chat_messages` together with the older messages, keeping their order. Already stored messages are skipped.
+
+  Parameters:
+    thread_id (str): The ID of the thread the messages were added to.
+    messages (list[dict]): The messages as serialized by `util_functions.oai_functions.serialize_message`.
+
+  Returns:
+    bool or None: True if the messages were stored, False if the thread is not mirrored or None if the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      chat_session = session.query(ChatSession.id, ChatSession.mirrored).filter(ChatSession.threadID == thread_id).order_by(ChatSession.created).first()
+      if chat_session is None or not chat_session.mirrored:
+        return False
+      result = session.execute(pg_insert(ChatMessage).values(_message_rows(chat_session.id, messages)).on_conflict_do_nothing(index_elements=['message_id']))
+      if result.rowcount > 0:
+        session.query(ChatSession).filter(ChatSession.id == chat_session.id).update(
+          {ChatSession.messages_len: func.coalesce(ChatSession.messages_len, 0) + result.rowcount,
+           ChatSession.last_modified: current_time_prague()}, synchronize_session=False)
+      return True
+  except Exception as e:
+    logging.error(f'Failed to mirror messages of thread {thread_id}. {e}')
+    return None
+
+def backfill_chat_messages(thread_id: str, messages: list[dict]):
+  """
+  Stores all messages of a thread created before the mirror existed, marks its chat session as mirrored and sets its `messages_len`.
+
+  Parameters:
+    thread_id (str): The ID of the thread.
+    messages (list[dict]): All messages of the thread in chronological order, serialized by `util_functions.oai_functions.serialize_message`.
+
+  Returns:
+    bool or None: True if the thread was backfilled or None if there is no chat session for the thread or the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      chat_session = session.query(ChatSession).filter(ChatSession.threadID == thread_id).order_by(ChatSession.created).with_for_update().first()
+      if chat_session is None:
+        return None
+      if chat_session.mirrored:
+        return True
+      if messages:
+        session.execute(pg_insert(ChatMessage).values(_message_rows(chat_session.id, messages)).on_conflict_do_nothing(index_elements=['message_id']))
+      chat_session.mirrored = True
+      chat_session.messages_len = session.query(func.count(ChatMessage.id)).filter(ChatMessage.chat_session_id == chat_session.id).scalar()
+      return True
+  except Exception as e:
+    logging.error(f'Failed to backfill messages of thread {thread_id}. {e}')
+    return None
+
+def get_chat_messages(thread_id: str, limit: int=50, before: int=None):
+  """
+  Retrieves a page of mirrored messages of a thread, newest page first. Pages are keyed by the `seq` of the oldest message of the
+  previous page, so reading further back costs the same as reading the first page.
+
+  Parameters:
+    thread_id (str): The ID of the thread.
+    limit (int): The maximum number of messages returned. Defaults to 50.
+    before (int): The cursor returned with the previous page. Omit for the latest messages.
+
+  Returns:
+    dict or None: `Mirrored` whether the thread is mirrored, `Messages` the page in chronological order and `NextCursor` the cursor of the
+    next (older) page or None if there are no older messages. None if there is no chat session for the thread or the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      chat_session = session.query(ChatSession.id, ChatSession.mirrored).filter(ChatSession.threadID == thread_id).order_by(ChatSession.created).first()
+      if chat_session is None:
+        return None
+      if not chat_session.mirrored:
+        return {'Mirrored': False, 'Messages': [], 'NextCursor': None}
+      query = session.query(ChatMessage).filter(ChatMessage.chat_session_id == chat_session.id)
+      if before is not None:
+        query = query.filter(ChatMessage.seq < before)
+      rows = query.order_by(ChatMessage.seq.desc()).limit(limit + 1).all()
+      has_more = len(rows) > limit
+      rows = rows[:limit]
+      rows.reverse()
+      return {
+        'Mirrored': True,
+        'Messages': [{
+          'Id': row.message_id,
+          'Created': row.created_at,
+          'Role': row.role,
+          'Content': row.content,
+          'Attachments': row.attachments or []
+        } for row in rows],
+        'NextCursor': rows[0].seq if has_more and rows else None
       }
   except Exception as e:
-    logging.error(f"An error occurred while updating chat session {chat_session_id}. {e}")
\ No newline at end of file
+    logging.error(f'Failed to retrieve messages of thread {thread_id}. {e}')
+    return None
+
+def delete_chat_messages(message_ids: list[str]):
+  """
+  Removes messages deleted from their OpenAI thread from the mirror and subtracts them from the `messages_len` of their chat sessions.
+
+  Parameters:
+    message_ids (list[str]): The OpenAI IDs of the deleted messages.
+  """
+  if not message_ids:
+    return
+  try:
+    with session_scope() as session:
+      counts = session.query(ChatMessage.chat_session_id, func.count(ChatMessage.id)).filter(ChatMessage.message_id.in_(message_ids)).group_by(ChatMessage.chat_session_id).all()
+      session.query(ChatMessage).filter(ChatMessage.message_id.in_(message_ids)).delete(synchronize_session=False)
+      for chat_session_id, count in counts:
+        session.query(ChatSession).filter(ChatSession.id == chat_session_id).update(
+          {ChatSession.messages_len: func.greatest(func.coalesce(ChatSession.messages_len, 0) - count, 0)}, synchronize_session=False)
+  except Exception as e:
+    logging.error(f'Failed to remove messages {message_ids} from the mirror. {e}')
+
+def update_chat_message(message: dict):
+  """
+  Updates the content of a mirrored message, e.g. once the assistant finished writing it.
+
+  Parameters:
+    message (dict): The message as serialized by `util_functions.oai_functions.serialize_message`.
+  """
+  try:
+    with session_scope() as session:
+      session.query(ChatMessage).filter(ChatMessage.message_id == message['MessageId']).update(
+        {ChatMessage.content: message['Content'], ChatMessage.attachments: message['Attachments'], ChatMessage.last_modified: current_time_prague()},
+        synchronize_session=False)
+  except Exception as e:
+    logging.error(f'Failed to update mirrored message {message["MessageId"]}. {e}')
+
+def get_last_message_ids(thread_id: str, count: int):
+  """
+  Retrieves the OpenAI IDs of the last messages of a thread from the `ChatMessage` ledger, without listing the thread on OpenAI.
+
+  Parameters:
+    thread_id (str): The ID of the thread.
+    count (int): The number of messages.
+
+  Returns:
+    list[str] or None: The message IDs, newest first, or None if the thread is not mirrored or the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      chat_session = session.query(ChatSession.id, ChatSession.mirrored).filter(ChatSession.threadID == thread_id).order_by(ChatSession.created).first()
+      if chat_session is None or not chat_session.mirrored:
+        return None
+      rows = session.query(ChatMessage.message_id).filter(ChatMessage.chat_session_id == chat_session.id).order_by(ChatMessage.seq.desc()).limit(count).all()
+      return [row.message_id for row in rows]
+  except Exception as e:
+    logging.error(f'Failed to retrieve the last messages of thread {thread_id}. {e}')
+    return None
+
+def enqueue_cleanup_tasks(tasks: list[tuple[str, str]]):
+  """
+  Adds OpenAI resources to the cleanup outbox. Resources that are already queued are skipped.
+
+  Parameters:
+    tasks (list[tuple[str, str]]): `(resource_type, resource_id)` pairs, the type being 'assistant', 'file', 'vector_store' or 'thread'.
+
+  Returns:
+    int or None: The number of newly queued resources or None if the operation fails.
+  """
+  tasks = list(dict.fromkeys((resource_type, resource_id) for resource_type, resource_id in tasks if resource_id))
+  if not tasks:
+    return 0
+  try:
+    with session_scope() as session:
+      now = current_time_prague()
+      result = session.execute(pg_insert(CleanupTask).values([{
+        'resource_type': resource_type,
+        'resource_id': resource_id,
+        'attempts': 0,
+        'next_attempt_at': now,
+        'created': now,
+        'last_modified': now
+      } for resource_type, resource_id in tasks]).on_conflict_do_nothing(index_elements=['resource_type', 'resource_id']))
+      return result.rowcount
+  except Exception as e:
+    logging.error(f'Failed to queue {tasks} for cleanup. {e}')
+    return None
+
+def claim_cleanup_tasks(limit: int, lease: int, max_attempts: int):
+  """
+  Claims due cleanup tasks. Rows locked by other workers are skipped, and claimed tasks are hidden for `lease` seconds, so concurrent
+  workers never process the same task while no lock is held during the deletion itself.
+
+  Parameters:
+    limit (int): The maximum number of tasks claimed.
+    lease (int): The seconds after which a task is handed out again if its worker did not report back.
+    max_attempts (int): Tasks with this many attempts are no longer claimed.
+
+  Returns:
+    list[dict] or None: The claimed tasks or None if the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      now = current_time_prague()
+      tasks = session.query(CleanupTask).filter(CleanupTask.next_attempt_at <= now, CleanupTask.attempts < max_attempts) \
+        .order_by(CleanupTask.next_attempt_at).limit(limit).with_for_update(skip_locked=True).all()
+      claimed = []
+      for task in tasks:
+        task.attempts += 1
+        task.next_attempt_at = now + timedelta(seconds=lease)
+        claimed.append({'Type': task.resource_type, 'ResourceId': task.resource_id, 'Attempts': task.attempts})
+      return claimed
+  except Exception as e:
+    logging.error(f'Failed to claim cleanup tasks. {e}')
+    return None
+
+def complete_cleanup_tasks(tasks: list[tuple[str, str]]):
+  """
+  Removes processed tasks from the cleanup outbox.
+
+  Parameters:
+    tasks (list[tuple[str, str]]): `(resource_type, resource_id)` pairs of the processed tasks.
+  """
+  if not tasks:
+    return
+  try:
+    with session_scope() as session:
+      session.query(CleanupTask).filter(tuple_(CleanupTask.resource_type, CleanupTask.resource_id).in_(tasks)).delete(synchronize_session=False)
+  except Exception as e:
+    logging.error(f'Failed to complete cleanup tasks {tasks}. {e}')
+
+def retry_cleanup_task(resource_type: str, resource_id: str, error: str, delay: int):
+  """
+  Schedules a failed cleanup task to be retried after `delay` seconds.
+  """
+  try:
+    with session_scope() as session:
+      session.query(CleanupTask).filter(CleanupTask.resource_type == resource_type, CleanupTask.resource_id == resource_id).update(
+        {CleanupTask.next_attempt_at: current_time_prague() + timedelta(seconds=delay), CleanupTask.last_error: error[:500],
+         CleanupTask.last_modified: current_time_prague()}, synchronize_session=False)
+  except Exception as e:
+    logging.error(f'Failed to reschedule cleanup of {resource_type} {resource_id}. {e}')
+
+def release_cleanup_tasks(tasks: list[tuple[str, str]], delay: int):
+  """
+  Hands claimed cleanup tasks back to the queue without counting the claim as an attempt, to be claimed again after `delay` seconds.
+  Used when the tasks could not be processed for reasons unrelated to the resources themselves.
+
+  Parameters:
+    tasks (list[tuple[str, str]]): `(resource_type, resource_id)` pairs of the claimed tasks.
+    delay (int): The seconds after which the tasks are handed out again.
+  """
+  if not tasks:
+    return
+  try:
+    with session_scope() as session:
+      now = current_time_prague()
+      session.query(CleanupTask).filter(tuple_(CleanupTask.resource_type, CleanupTask.resource_id).in_(tasks)).update(
+        {CleanupTask.attempts: func.greatest(CleanupTask.attempts - 1, 0), CleanupTask.next_attempt_at: now + timedelta(seconds=delay),
+         CleanupTask.last_modified: now}, synchronize_session=False)
+  except Exception as e:
+    logging.error(f'Failed to release cleanup tasks {tasks}. {e}')
+
+def get_cleanup_task_counts(max_attempts: int):
+  """
+  Counts the queued cleanup tasks (`Pending`) and those that ran out of attempts (`Failed`).
+
+  Returns:
+    dict or None: The counts or None if the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      failed = CleanupTask.attempts >= max_attempts
+      pending, failed = session.query(func.count(CleanupTask.resource_id).filter(~failed), func.count(CleanupTask.resource_id).filter(failed)).one()
+      return {'Pending': pending, 'Failed': failed}
+  except Exception as e:
+    logging.error(f'Failed to count cleanup tasks. {e}')
+    return None
+
+def get_referenced_thread_ids(thread_ids: list[str]):
+  """
+  Filters the given OpenAI thread IDs down to the ones still used by a chat session.
+
+  Parameters:
+    thread_ids (list[str]): The OpenAI thread IDs to check.
+
+  Returns:
+    set[str] or None: The IDs of threads that must not be deleted. None if the lookup fails, in which case none of the threads may be deleted.
+  """
+  valid_ids = [thread_id for thread_id in thread_ids if thread_id]
+  if not valid_ids:
+    return set()
+  try:
+    with session_scope() as session:
+      rows = session.query(ChatSession.threadID).filter(ChatSession.threadID.in_(valid_ids)).distinct().all()
+      return {row.threadID for row in rows}
+  except Exception as e:
+    logging.error(f'Failed to resolve referenced threads. {e}')
+    return None
+
+def get_openai_references(active_since: datetime):
+  """
+  Collects everything the database knows about OpenAI resources, used by the orphan sweeper to tell stale resources from live ones.
+
+  Parameters:
+    active_since (datetime): Chat sessions modified since then count as live.
+
+  Returns:
+    dict or None: The OpenAI IDs of pooled assistants (`Assistants`), of persistent and pooled vector stores (`VectorStores`),
+    of cached and vector store files (`Files`), the queued cleanup tasks as (type, ID) pairs (`Queued`), the IDs of agents used
+    in live chat sessions (`LiveAgents`) and the modules of live chat sessions (`LiveModules`). None if the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      pooled = session.query(AgentAssistant.oai_assistant_id, AgentAssistant.vector_store_id).all()
+      live = session.query(ChatSession.id).filter(ChatSession.last_modified >= active_since)
+      live_agents = session.query(ChatSession.last_agent).filter(ChatSession.last_modified >= active_since, ChatSession.last_agent.isnot(None)).all() \
+                  + session.query(agent_chat_table.c.agent_id).filter(agent_chat_table.c.chat_session_id.in_(live)).all()
+      return {
+        'Assistants': {row.oai_assistant_id for row in pooled},
+        'VectorStores': {row.vector_store_id for row in pooled if row.vector_store_id}
+                        | {row.vector_store_id for row in session.query(VectorStore.vector_store_id).all()},
+        'Files': {row.file_id for row in session.query(OpenAIFile.file_id).all()}
+                 | {row.file_id for row in session.query(VectorStoreFile.file_id).all()},
+        'Queued': {(row.resource_type, row.resource_id) for row in session.query(CleanupTask.resource_type, CleanupTask.resource_id).all()},
+        'LiveAgents': {str(row[0]) for row in live_agents},
+        'LiveModules': {row.module_name for row in session.query(ChatSession.module_name).filter(ChatSession.last_modified >= active_since).distinct() if row.module_name},
+      }
+  except Exception as e:
+    logging.error(f'Failed to collect OpenAI references. {e}')
+    return None
+
+def get_job_runs():
+  """
+  Retrieves the last run of each scheduled job.
+
+  Returns:
+    list[dict] or None: The name, start, duration in seconds, status, error, number of runs and progress or result of each job,
+    or None if the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      return [{
+        'Name': job_run.name,
+        'LastStarted': format_timestamp(job_run.last_started),
+        'LastDuration': job_run.last_duration,
+        'LastStatus': job_run.last_status,
+        'LastError': job_run.last_error,
+        'Runs': job_run.runs,
+        'Details': job_run.details,
+      } for job_run in session.query(JobRun).order_by(JobRun.name).all()]
+  except Exception as e:
+    logging.error(f'Failed to retrieve job runs. {e}')
+    return None
+
+def save_session_state(handle: str, kind: str, data: dict, expires: datetime):
+  """
+  Stores the state of a chat or agent session under a new handle.
+
+  Parameters:
+    handle (str): The opaque handle the session is stored under, set as the cookie value.
+    kind (str): 'chat' or 'agent'.
+    data (dict): The JSON-serializable session state.
+    expires (datetime): When the session stops being served.
+
+  Returns:
+    bool: True if the session was stored, False otherwise.
+  """
+  try:
+    with session_scope() as session:
+      session.execute(pg_insert(SessionState).values(handle=handle, kind=kind, data=data, expires=expires, created=current_time_prague()))
+      return True
+  except Exception as e:
+    logging.error(f'Failed to store {kind} session state. {e}')
+    return False
+
+def get_session_state(handle: str, kind: str):
+  """
+  Retrieves the state of a chat or agent session that has not expired yet.
+
+  Parameters:
+    handle (str): The handle from the session cookie.
+    kind (str): 'chat' or 'agent'.
+
+  Returns:
+    tuple[dict, datetime] or None: The session state and its expiry, or None if there is no such live session or the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      row = session.query(SessionState.data, SessionState.expires) \
+                   .filter(SessionState.handle == handle, SessionState.kind == kind, SessionState.expires > current_time_prague()).first()
+      return (row.data, row.expires) if row else None
+  except Exception as e:
+    logging.error(f'Failed to retrieve {kind} session state. {e}')
+    return None
+
+def session_state_exists(handle: str, kind: str):
+  """
+  Checks whether a chat or agent session is still stored and has not expired, without loading its state.
+
+  Parameters:
+    handle (str): The handle from the session cookie.
+    kind (str): 'chat' or 'agent'.
+
+  Returns:
+    bool or None: Whether the session exists, or None if the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      return session.query(session.query(SessionState.handle)
+                           .filter(SessionState.handle == handle, SessionState.kind == kind, SessionState.expires > current_time_prague()).exists()).scalar()
+  except Exception as e:
+    logging.error(f'Failed to check {kind} session state. {e}')
+    return None
+
+def delete_session_states(handles: list[str]):
+  """
+  Deletes stored chat and agent sessions, e.g. when a chat ends.
+
+  Parameters:
+    handles (list[str]): The handles of the sessions to be deleted.
+
+  Returns:
+    int or None: The number of deleted sessions or None if the operation fails.
+  """
+  try:
+    with session_scope() as session:
+      return session.query(SessionState).filter(SessionState.handle.in_(handles)).delete(synchronize_session=False)
+  except Exception as e:
+    logging.error(f'Failed to delete session states. {e}')
+    return None
@@ -1,8 +1,10 @@
 from io import BytesIO
+import hashlib
 import json
 import logging
+from collections import defaultdict
 from werkzeug.datastructures.file_storage import FileStorage
-from config import SB_CLIENT
+from config import SB_CLIENT, STORAGE_DELETE_BATCH
 from util_functions.functions import normalize_file_name
 from supabase import StorageException
 
@@ -17,17 +19,18 @@ def upload_file(bucket_name: str, file_storage: FileStorage, folder: str, module
     - module_id (str): The ID of the module the file belongs to.
     
     Returns:
-    - dict[str, any]: The `Id`, `URL`, `Name`, `ModuleID` and `FileType` of the uploaded file.
+    - dict[str, any]: The `Id`, `URL`, `Name`, `ModuleID`, `FileType` and `ContentHash` of the uploaded file.
     """
     try:
         storage_path = f'{folder}/{module_id}/{normalize_file_name(file_storage.filename)}'
         fileType = file_storage.filename.split('.')[-1]
         file_content = file_storage.read()
+        content_hash = hashlib.sha256(file_content).hexdigest()
         response = SB_CLIENT.storage.from_(bucket_name).upload(storage_path, file_content)
         response = response.json()
         
         logging.info(f"File uploaded successfully: {response.get('Key')}")
-        return {'Id': response.get('Id'), 'URL': response.get('Key'), 'Name': file_storage.filename, 'ModuleID': str(module_id), 'FileType': fileType}
+        return {'Id': response.get('Id'), 'URL': response.get('Key'), 'Name': file_storage.filename, 'ModuleID': str(module_id), 'FileType': fileType, 'ContentHash': content_hash}
     except Exception as e:
         logging.error(f"Failed to upload file due to an unexpected error! {e}")
         
@@ -69,7 +72,8 @@ def serve_file(file_key: str):
     
 def delete_files(file_keys: list[str]):
     """
-    Deletes files from the Supabase storage based on the file keys.
+    Deletes files from the Supabase storage based on the file keys. The files are removed with one request per bucket
+    (at most `STORAGE_DELETE_BATCH` files each) instead of one request per file.
     
     Parameters:
     - file_keys (list[str]): List of keys used to delete the files from the storage.
@@ -77,16 +81,23 @@ def delete_files(file_keys: list[str]):
     Returns:
     - list[str], bool: The list of deleted file keys if the operation was successful. An empty list otherwise. A bool indicator of whether the operation was successful is also returned.
     """
+    buckets = defaultdict(list)
+    for file_key in file_keys:
+        bucket_name = file_key.split('/')[0]
+        buckets[bucket_name].append(file_key.replace(f'{bucket_name}/', '', 1))
+
     deleted_files = []
-    try:
-        for file_key in file_keys:
-            bucket_name = file_key.split('/')[0]
-            file_path = file_key.replace(f'{bucket_name}/', '')
-            response = SB_CLIENT.storage.from_(bucket_name).remove([file_path])
-            if response:
-                deleted_files.append(file_key)
-        
-        return deleted_files, True if deleted_files else False
-    except Exception as e:
-        logging.error(f"Failed to delete some or all files! {e}")
-        return deleted_files, False
\ No newline at end of file
+    failed = False
+    for bucket_name, file_paths in buckets.items():
+        for i in range(0, len(file_paths), STORAGE_DELETE_BATCH):
+            batch = file_paths[i:i + STORAGE_DELETE_BATCH]
+            try:
+                response = SB_CLIENT.storage.from_(bucket_name).remove(batch)
+                removed = {file.get('name') for file in response or []}
+                deleted_files.extend(f'{bucket_name}/{file_path}' for file_path in batch if file_path in removed)
+                failed = failed or len(removed) < len(batch)
+            except Exception as e:
+                logging.error(f"Failed to delete {len(batch)} files from bucket {bucket_name}! {e}")
+                failed = True
+
+    return deleted_files, bool(deleted_files) and not failed
@@ -0,0 +1,121 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from config import OPENAI_CLIENT as client, SWEEP_DELETE_BUDGET, SWEEP_DRY_RUN, SWEEP_MAX_PAGES, SWEEP_MIN_AGE
+from services.cleanup_service import ASSISTANT, FILE, VECTOR_STORE, enqueue_cleanup
+from services.sql_service import get_openai_references
+from util_functions.functions import current_time_prague
+
+# Chat vector stores created before agents got persistent vector stores were named after the module of the chat
+LEGACY_VS_PREFIX = 'temp_vs-'
+AGENT_VS_PREFIX = 'agent_vs-'
+
+
+def _list_resources(resource_type: str, cutoff: int):
+  """
+  Pages through the OpenAI resources of a type from the oldest, stopping at the first one created after `cutoff`.
+  """
+  if resource_type == ASSISTANT:
+    lister = client.beta.assistants.list
+  elif resource_type == VECTOR_STORE:
+    lister = client.beta.vector_stores.list
+  else:
+    lister = lambda **kwargs: client.files.list(purpose='assistants', **kwargs)
+
+  resources = []
+  after = None
+  for _ in range(SWEEP_MAX_PAGES):
+    page = lister(limit=100, order='asc', after=after) if after else lister(limit=100, order='asc')
+    for resource in page.data:
+      if resource.created_at >= cutoff:
+        return resources
+      resources.append(resource)
+    if not page.data or not page.has_next_page():
+      return resources
+    after = page.data[-1].id
+  logging.warning(f'Stopped listing {resource_type}s after {SWEEP_MAX_PAGES} pages.')
+  return resources
+
+def _owner(resource_type: str, resource):
+  """
+  Returns the agent or module the resource was created for, if it can be told from the resource.
+  """
+  agent_id = (getattr(resource, 'metadata', None) or {}).get('agent_id')
+  if agent_id:
+    return 'agent', agent_id
+  name = getattr(resource, 'name', None) or ''
+  if resource_type == VECTOR_STORE and name.startswith(AGENT_VS_PREFIX):
+    return 'agent', name[len(AGENT_VS_PREFIX):]
+  if resource_type == VECTOR_STORE and name.startswith(LEGACY_VS_PREFIX):
+    return 'module', name[len(LEGACY_VS_PREFIX):]
+  return None, None
+
+def sweep_orphaned_resources(dry_run: bool=SWEEP_DRY_RUN, budget: int=SWEEP_DELETE_BUDGET):
+  """
+  Finds OpenAI assistants, files and vector stores leaked by chats that never ended (expired cookies, `end_chat` never called)
+  and queues them for deletion (see `enqueue_cleanup`). The three resource types are listed concurrently.
+
+  A resource is stale if it is older than `SWEEP_MIN_AGE` hours, it isn't pooled, cached, an agent's persistent vector store or
+  already queued, and the agent or module it was created for has no chat session modified within `SWEEP_MIN_AGE` hours.
+  At most `budget` stale resources are queued per sweep, the oldest first, the rest is picked up by the next sweep.
+
+  Parameters:
+      dry_run (bool): Only report the stale resources without queueing them. Defaults to `SWEEP_DRY_RUN`.
+      budget (int): The maximum number of resources queued for deletion.
+
+  Returns:
+      dict or None: The report of the sweep. `Scanned` holds the number of listed resources per type, `Stale` the stale resources,
+      `Queued` the number of resources queued for deletion and `Deferred` the number left for the next sweep. None if the
+      database references could not be loaded, nothing is deleted then.
+  """
+  start = time.time()
+  now = current_time_prague()
+  references = get_openai_references(now - timedelta(hours=SWEEP_MIN_AGE))
+  if references is None:
+    logging.error('Skipping the orphan sweep, references to OpenAI resources could not be loaded.')
+    return None
+  cutoff = int((datetime.now(timezone.utc) - timedelta(hours=SWEEP_MIN_AGE)).timestamp())
+  known = {ASSISTANT: references['Assistants'], FILE: references['Files'], VECTOR_STORE: references['VectorStores']}
+  live = {'agent': references['LiveAgents'], 'module': references['LiveModules']}
+
+  report = {'DryRun': dry_run, 'Scanned': {}, 'Stale': [], 'Queued': 0, 'Deferred': 0, 'Errors': []}
+  with ThreadPoolExecutor(max_workers=3) as executor:
+    listings = {resource_type: executor.submit(_list_resources, resource_type, cutoff) for resource_type in (ASSISTANT, FILE, VECTOR_STORE)}
+  for resource_type, listing in listings.items():
+    try:
+      resources = listing.result()
+    except Exception as e:
+      logging.error(f'Failed to list OpenAI {resource_type}s. {e}')
+      report['Errors'].append(f'Failed to list {resource_type}s. {e}')
+      continue
+    report['Scanned'][resource_type] = len(resources)
+    for resource in resources:
+      if resource.id in known[resource_type] or (resource_type, resource.id) in references['Queued']:
+        continue
+      owner_type, owner = _owner(resource_type, resource)
+      if owner_type and owner in live[owner_type]:
+        continue
+      report['Stale'].append({
+        'Type': resource_type,
+        'Id': resource.id,
+        'Name': getattr(resource, 'name', None) or getattr(resource, 'filename', None),
+        'CreatedAt': resource.created_at,
+      })
+
+  report['Stale'].sort(key=lambda resource: resource['CreatedAt'])
+  if not dry_run and report['Stale']:
+    batch = report['Stale'][:budget]
+    queued = enqueue_cleanup(assistant_ids=[resource['Id'] for resource in batch if resource['Type'] == ASSISTANT],
+                             file_ids=[resource['Id'] for resource in batch if resource['Type'] == FILE],
+                             vector_store_ids=[resource['Id'] for resource in batch if resource['Type'] == VECTOR_STORE])
+    if queued is None:
+      report['Errors'].append('Failed to queue stale resources for deletion.')
+    else:
+      report['Queued'] = queued
+      report['Deferred'] = len(report['Stale']) - len(batch)
+
+  end = time.time()
+  logging.info(f'Orphan sweep {"(dry run) " if dry_run else ""}scanned {report["Scanned"]}, found {len(report["Stale"])} stale resources '
+               f'and queued {report["Queued"]} in {end - start} seconds')
+  return report
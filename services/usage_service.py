@@ -0,0 +1,158 @@
+import atexit
+import logging
+import threading
+import uuid
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from config import OPENAI_TOKEN_PRICES, USAGE_FLUSH_INTERVAL, USAGE_FLUSH_SIZE
+from database.database import session_scope
+from database.models import Agent, ChatSession, Module, TokenUsage
+from util_functions.functions import current_time_prague
+
+# Rows waiting to be inserted. Streams only append here, the INSERT happens on the flusher thread.
+_buffer = []
+_buffer_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_flush_requested = threading.Event()
+_flusher = None
+# Rows of failed flushes are retried with the next batch, up to this many buffered rows.
+MAX_BUFFERED_ROWS = USAGE_FLUSH_SIZE * 20
+# Usage is kept without these references if the chat session, agent or module was deleted before the flush.
+REFERENCES = {'chat_session_id': ChatSession, 'agent_id': Agent, 'module_id': Module}
+
+
+def _as_uuid(value):
+  if value is None:
+    return None
+  try:
+    return uuid.UUID(str(value))
+  except ValueError:
+    return None
+
+def _token_cost(model: str, tokens: int, index: int):
+  prices = OPENAI_TOKEN_PRICES.get(model)
+  if prices is None and model:
+    # Dated snapshots (e.g. gpt-4o-2024-08-06) are priced like their base model
+    prices = next((price for name, price in sorted(OPENAI_TOKEN_PRICES.items(), key=lambda item: -len(item[0])) if model.startswith(name)), None)
+  if prices is None or tokens is None:
+    return None
+  return round(tokens * prices[index])
+
+def record_usage(usage: dict, chat_session_id: str=None, agent_id: str=None, module_id: str=None):
+  """
+  Buffers the token usage of a run to be written to the `token_usage` table. Never blocks on the database,
+  buffered rows are inserted in batches by a background thread (see `flush_usage`).
+
+  Parameters:
+      usage (dict): The usage of the run as reported in the `usage` event of `chat_ta_events`.
+      chat_session_id (str): The ID of the chat session the run belongs to.
+      agent_id (str): The ID of the database-stored agent the run was executed by.
+      module_id (str): The ID of the module the chat is held in. Resolved from the chat session when omitted.
+  """
+  now = current_time_prague()
+  row = {
+    'id': uuid.uuid4(),
+    'run_id': usage.get('run_id'),
+    'chat_session_id': _as_uuid(chat_session_id),
+    'agent_id': _as_uuid(agent_id),
+    'module_id': _as_uuid(module_id),
+    'model': usage.get('model'),
+    'input_tokens': usage.get('prompt_tokens'),
+    'output_tokens': usage.get('completion_tokens'),
+    'input_cost': _token_cost(usage.get('model'), usage.get('prompt_tokens'), 0),
+    'output_cost': _token_cost(usage.get('model'), usage.get('completion_tokens'), 1),
+    'date': now,
+    'created': now,
+    'last_modified': now,
+  }
+  with _buffer_lock:
+    _buffer.append(row)
+    full = len(_buffer) >= USAGE_FLUSH_SIZE
+  _ensure_flusher()
+  if full:
+    _flush_requested.set()
+
+def flush_usage():
+  """
+  Inserts all buffered token usage rows in a single statement. Module IDs missing from the rows are resolved from their chat sessions.
+  If a row violates a constraint, the rows are inserted one by one instead (see `_insert_rows`). If the insert fails otherwise,
+  the rows are put back into the buffer to be retried with the next batch.
+
+  Returns:
+      int: The number of rows written.
+  """
+  with _flush_lock:
+    with _buffer_lock:
+      rows = _buffer[:]
+      _buffer.clear()
+    if not rows:
+      return 0
+    try:
+      try:
+        with session_scope() as session:
+          unresolved = {row['chat_session_id'] for row in rows if row['module_id'] is None and row['chat_session_id']}
+          if unresolved:
+            modules = dict(session.query(ChatSession.id, ChatSession.moduleID).filter(ChatSession.id.in_(unresolved)).all())
+            for row in rows:
+              if row['module_id'] is None and row['chat_session_id']:
+                row['module_id'] = modules.get(row['chat_session_id'])
+          session.execute(insert(TokenUsage), rows)
+        return len(rows)
+      except IntegrityError as e:
+        logging.warning(f'Failed to write {len(rows)} token usage rows in one batch, inserting them one by one. {e.orig}')
+        return _insert_rows(rows)
+    except Exception as e:
+      logging.error(f'Failed to write {len(rows)} token usage rows. {e}')
+      with _buffer_lock:
+        room = MAX_BUFFERED_ROWS - len(_buffer)
+        kept = rows[-room:] if room > 0 else []
+        if len(kept) < len(rows):
+          logging.error(f'Dropping {len(rows) - len(kept)} token usage rows, the buffer is full.')
+        _buffer[:0] = kept
+      return 0
+
+def _insert_rows(rows: list[dict]):
+  """
+  Inserts token usage rows one by one, each in its own savepoint. References to chat sessions, agents and modules deleted
+  before the flush are cleared first, a row that still can't be inserted is dropped.
+
+  Returns:
+      int: The number of rows written.
+  """
+  written = 0
+  with session_scope() as session:
+    for column, model in REFERENCES.items():
+      ids = {row[column] for row in rows if row[column]}
+      if not ids:
+        continue
+      existing = {row.id for row in session.query(model.id).filter(model.id.in_(ids)).all()}
+      for row in rows:
+        if row[column] and row[column] not in existing:
+          logging.warning(f'Writing token usage of run {row["run_id"]} without its {column}, {row[column]} no longer exists.')
+          row[column] = None
+    for row in rows:
+      try:
+        with session.begin_nested():
+          session.execute(insert(TokenUsage), [row])
+        written += 1
+      except IntegrityError as e:
+        logging.error(f'Dropping token usage of run {row["run_id"]}, it can not be written. {e.orig}')
+  return written
+
+def _run_flusher():
+  while True:
+    _flush_requested.wait(timeout=USAGE_FLUSH_INTERVAL)
+    _flush_requested.clear()
+    flush_usage()
+
+def _ensure_flusher():
+  global _flusher
+  if _flusher is not None and _flusher.is_alive():
+    return
+  with _buffer_lock:
+    if _flusher is None or not _flusher.is_alive():
+      _flusher = threading.Thread(target=_run_flusher, name='usage-flusher', daemon=True)
+      _flusher.start()
+
+# The flusher is a daemon thread, buffered rows are written before the interpreter exits.
+atexit.register(flush_usage)
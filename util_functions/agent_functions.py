@@ -1,18 +1,140 @@
+import hashlib
+import json
 import logging
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from flask import request, g, current_app
-from openai._exceptions import BadRequestError
-from services.sql_service import get_agent_data
-from config import OPENAI_CLIENT as client, chat_session_serializer, agent_session_serializer
+from flask import request, g, current_app, has_request_context
+from openai._exceptions import BadRequestError, NotFoundError
+from services.sql_service import get_agent_assistant, get_agent_data, get_pooled_assistant_ids, get_agent_vector_store, get_openai_file, mark_openai_file_validated, register_agent_assistant, register_agent_vector_store, register_openai_file, remove_openai_file, set_document_content_hash, update_vector_store_files
+from config import AGENT_PREFETCH_TTL, OPENAI_CLIENT as client, OPENAI_UPLOAD_CONCURRENCY, chat_session_serializer, agent_session_serializer
 from services.storage_service import serve_file
-from util_functions.functions import get_agent_session, get_chat_session, get_module_session
+from util_functions.functions import get_agent_session
 
+# Bounds the number of concurrent storage downloads and OpenAI file operations across all requests.
+upload_executor = ThreadPoolExecutor(max_workers=OPENAI_UPLOAD_CONCURRENCY, thread_name_prefix='oai-upload')
+# Provisions the next agent of an `AgentPointer` chain in the background. Kept apart from `upload_executor`,
+# since provisioning waits on uploads and must not occupy the workers running them.
+prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='agent-prefetch')
+
+# Pre-provisioned pointer agents keyed by the ID of the agent pointing to them.
+_prefetched_agents = {}
+_prefetch_lock = threading.Lock()
+prefetch_stats = {'scheduled': 0, 'hits': 0, 'misses': 0, 'discarded': 0, 'failed': 0}
+
+
+def _provision_pointer_agent(pointer_id):
+  agent_data = get_agent_data(pointer_id)
+  if not agent_data:
+    return None
+  oai_agent_id, vs_id = provision_agent(agent_data)
+  if not oai_agent_id:
+    return None
+  return {'AgentData': agent_data, 'AssistantId': oai_agent_id, 'VectorStoreId': vs_id or ''}
+
+def prefetch_next_agent(agent_data):
+  """
+  Starts provisioning the agent the given agent points to in the background, so it is ready when `point_to_agent` fires.
+  Does nothing if the agent doesn't point to another agent or its pointer agent is already being provisioned.
+
+  Parameters:
+      agent_data (dict): The data of the agent the user started chatting with, as returned by `get_agent_data`.
+  """
+  pointer_id = agent_data.get('AgentPointer')
+  if not pointer_id or pointer_id == 'None':
+    return
+  discard_stale_prefetches()
+  with _prefetch_lock:
+    entry = _prefetched_agents.get(agent_data['Id'])
+    if entry and entry['AgentId'] == pointer_id:
+      return
+    _prefetched_agents[agent_data['Id']] = {
+      'AgentId': pointer_id,
+      'Future': prefetch_executor.submit(_provision_pointer_agent, pointer_id),
+      'Created': time.time(),
+      'Claimed': False
+    }
+    prefetch_stats['scheduled'] += 1
+  logging.info(f'Pre-provisioning pointer agent {pointer_id} of agent {agent_data["Id"]}')
+
+def claim_prefetched_agent(agent_id, pointer_id):
+  """
+  Returns the pre-provisioned pointer agent of an agent, waiting for it if it is still being provisioned.
+  The entry stays registered, since pooled assistants can be handed to any number of chats, until its assistant
+  leaves the pool.
+
+  Parameters:
+      agent_id (str): The ID of the agent that is switching.
+      pointer_id (str): The ID of the agent being switched to.
+
+  Returns:
+      dict or None: The `AgentData`, `AssistantId` and `VectorStoreId` of the pointer agent or None if it wasn't pre-provisioned
+      or is no longer current.
+  """
+  with _prefetch_lock:
+    entry = _prefetched_agents.get(agent_id)
+    if not entry or entry['AgentId'] != pointer_id:
+      prefetch_stats['misses'] += 1
+      return None
+  try:
+    result = entry['Future'].result()
+  except Exception as e:
+    logging.error(f'Pre-provisioning of agent {pointer_id} failed. {e}')
+    result = None
+  # The pointer agent may have been updated or deleted since, possibly by another worker, which drops its assistant from the pool
+  stale = result is not None and not is_assistant_pooled(result['AssistantId'])
+  with _prefetch_lock:
+    if result is None or stale:
+      prefetch_stats['discarded' if stale else 'failed'] += 1
+      prefetch_stats['misses'] += 1
+      if _prefetched_agents.get(agent_id) is entry:
+        _prefetched_agents.pop(agent_id)
+      return None
+    entry['Claimed'] = True
+    prefetch_stats['hits'] += 1
+  return result
+
+def discard_stale_prefetches(max_age: int=AGENT_PREFETCH_TTL):
+  """
+  Drops pre-provisioned agents older than `max_age` seconds. Pre-provisioned assistants are pooled,
+  so dropping an entry only frees the registry, the assistant stays available for later chats.
+
+  Parameters:
+      max_age (int): The age in seconds after which an entry is dropped. Defaults to `AGENT_PREFETCH_TTL`.
+
+  Returns:
+      int: The number of dropped entries that were never used.
+  """
+  now = time.time()
+  unused = 0
+  with _prefetch_lock:
+    for agent_id, entry in list(_prefetched_agents.items()):
+      if now - entry['Created'] < max_age or not entry['Future'].done():
+        continue
+      _prefetched_agents.pop(agent_id)
+      if not entry['Claimed']:
+        unused += 1
+    prefetch_stats['discarded'] += unused
+  return unused
+
+def get_prefetch_stats():
+  """
+  Returns how often pre-provisioned pointer agents were scheduled, used (`hits`), missing when an agent switched (`misses`),
+  dropped without being used (`discarded`) or failed to provision, along with the number of currently registered entries.
+  """
+  with _prefetch_lock:
+    stats = dict(prefetch_stats)
+    stats['pending'] = len(_prefetched_agents)
+  claims = stats['hits'] + stats['misses']
+  stats['hit_rate'] = stats['hits'] / claims if claims else None
+  return stats
 
 def switch_agent(agent_session):
     """
     Switches the current agent to a new one based on the agent pointer stored in the database.
     Updates the agent session and chat session cookies with the new agent data.
+    The pointer agent pre-provisioned by `prefetch_next_agent` is used if available.
     
     Parameters:
         agent_session (dict): The currently set agent cookie.
@@ -35,8 +157,14 @@ def switch_agent(agent_session):
         logging.error(f'`AgentPointer` field in {get_agent} is set to None')
         return 'Failed to switch agents! There is no other agent connected.'
       
-      get_agent_pointer = get_agent_data(get_agent['AgentPointer'])
-      new_oai_agent_id, file_ids, vs_id = create_agent(get_agent_pointer['Id'])
+      prefetched = claim_prefetched_agent(agent_id, get_agent['AgentPointer'])
+      if prefetched:
+        get_agent_pointer = prefetched['AgentData']
+        new_oai_agent_id, file_ids, vs_id = prefetched['AssistantId'], [], prefetched['VectorStoreId']
+        prefetch_next_agent(get_agent_pointer)
+      else:
+        get_agent_pointer = get_agent_data(get_agent['AgentPointer'])
+        new_oai_agent_id, file_ids, vs_id = create_agent(get_agent_pointer['Id'])
       agent_session_data = {
           'agent_id': str(get_agent_pointer['Id']),
           'oai_agent_id': new_oai_agent_id,
@@ -51,126 +179,387 @@ def switch_agent(agent_session):
     logging.info(f'Switching agents took {end - start} seconds')
     return get_agent_pointer['InitialPrompt'], {'agent_session': agent_session_data}
 
-def create_agent(agent_id):
+def build_agent_tools(agent_data):
   """
-  Creates a new agent on the OpenAI server or retrieves details of an existing agent based on the provided ID.
+  Builds the list of OpenAI tools an agent requires based on its database-stored configuration.
 
   Parameters:
-      agent_id (str): The unique identifier for the agent, used to store or retrieve the agent's data locally.
+      agent_data (dict): The agent data as returned by `get_agent_data`.
 
   Returns:
-      [str, list] or None: The unique identifier of the created or retrieved agent, or None if creation failed.
+      list[dict]: The tools to be attached to the OpenAI assistant.
+  """
+  tools = []
+  if len(agent_data['Documents']) > 0:
+    tools.append({"type": "file_search"})
+  if 'AgentPointer' in agent_data and agent_data['AgentPointer'] is not None and agent_data['AgentPointer'] != 'None':
+    tools.append({
+      'type': 'function',
+      'function': {
+        'name': 'point_to_agent',
+        'description': 'Function for switching to another agent.'
+      }})
+  return tools
+
+def compute_agent_config_hash(agent_data, tools):
+  """
+  Computes the key under which an agent's OpenAI assistant is pooled. Only the parts of the agent that
+  end up in the OpenAI assistant are hashed, so renaming an agent or editing its description keeps the pooled assistant.
+  Documents are not hashed since they live in the agent's persistent vector store, which is synced in place. The agent's ID
+  is hashed instead, so agents with the same prompt, model and tools never share an assistant (and its vector store).
 
-  Raises:
-      OSError: If necessary directories or files cannot be created.
-      IOError: If there's an error in reading from or writing to the local JSON file.
-      ApiError: If there's an issue with the OpenAI client during agent creation or file upload.
+  Parameters:
+      agent_data (dict): The agent data as returned by `get_agent_data`.
+      tools (list[dict]): The tools attached to the assistant.
+
+  Returns:
+      str: A SHA-256 hex digest of the agent configuration.
+  """
+  config = {
+    'agent_id': str(agent_data['Id']),
+    'system_prompt': agent_data['Instructions'],
+    'model': agent_data['Model'],
+    'tools': tools,
+  }
+  return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_or_upload_file(document, report: dict=None):
+  """
+  Returns the OpenAI file ID for an agent document, uploading the document only if its content was never uploaded before.
+  Uploaded files are cached by content hash and shared by every assistant that uses the same content. Cached entries
+  older than `OPENAI_FILE_REVALIDATE_AFTER` seconds are checked against OpenAI before being reused.
+
+  Parameters:
+      document (dict): A document as listed in the `Documents` field of `get_agent_data`.
+      report (dict): Optional dictionary the time spent on `Download` and `Upload` and the `Error`, if any, are written to.
+
+  Returns:
+      str or None: The OpenAI file ID or None if the document could not be downloaded or uploaded.
+  """
+  if report is None:
+    report = {}
+  report.update({'Download': 0.0, 'Upload': 0.0, 'Cached': False, 'Error': None})
+
+  def download():
+    start = time.time()
+    file_bytes = serve_file(document['URL'])
+    report['Download'] += time.time() - start
+    if not file_bytes:
+      report['Error'] = f'Failed to download {document["URL"]} from storage.'
+    return file_bytes
+
+  file_bytes = None
+  content_hash = document.get('ContentHash')
+  if not content_hash:
+    # Documents stored before hashes were recorded on upload are hashed once and backfilled.
+    file_bytes = download()
+    if not file_bytes:
+      return None
+    content_hash = hashlib.sha256(file_bytes.getvalue()).hexdigest()
+    set_document_content_hash(document['Id'], content_hash)
+
+  cached = get_openai_file(content_hash)
+  if cached:
+    report['Cached'] = True
+    if not cached['Stale']:
+      return cached['FileId']
+    try:
+      client.files.retrieve(cached['FileId'])
+      mark_openai_file_validated(content_hash)
+      return cached['FileId']
+    except NotFoundError:
+      logging.warning(f'Cached file {cached["FileId"]} no longer exists in OpenAI, uploading {document["Name"]} again.')
+      remove_openai_file(content_hash=content_hash)
+      report['Cached'] = False
+    except Exception as e:
+      # OpenAI being unreachable is no reason to upload the file again.
+      logging.error(f'Failed to revalidate cached file {cached["FileId"]}. {e}')
+      return cached['FileId']
+
+  if file_bytes is None:
+    file_bytes = download()
+    if not file_bytes:
+      return None
+  start = time.time()
+  try:
+    uploaded = client.files.create(file=(document['Name'], file_bytes), purpose='assistants')
+  except Exception as e:
+    logging.error(f'Failed to upload {document["Name"]} to OpenAI. {e}')
+    report['Error'] = f'Failed to upload {document["Name"]} to OpenAI. {e}'
+    return None
+  finally:
+    report['Upload'] += time.time() - start
+
+  file_id = register_openai_file(content_hash, uploaded.id, document['Name'])
+  if file_id is None:
+    return uploaded.id
+  if file_id != uploaded.id:
+    # The same content was uploaded concurrently, keep the cached file.
+    try:
+      client.files.delete(uploaded.id)
+    except Exception as e:
+      logging.error(f'Failed to discard duplicate file {uploaded.id}. {e}')
+  return file_id
+
+def resolve_agent_files(documents):
+  """
+  Resolves the OpenAI file IDs of agent documents concurrently. Downloads from storage and uploads to OpenAI run on
+  the shared upload executor, which is bounded by `OPENAI_UPLOAD_CONCURRENCY`.
+
+  Parameters:
+      documents (list[dict]): Documents as listed in the `Documents` field of `get_agent_data`.
+
+  Returns:
+      tuple[dict[str, str], list[dict]]: The resolved OpenAI file IDs mapped to their document IDs and the documents that failed
+      to resolve, each with its `Id`, `Name` and `error`.
+  """
+  start = time.time()
+  reports = {document['Id']: {} for document in documents}
+  futures = {upload_executor.submit(get_or_upload_file, document, reports[document['Id']]): document for document in documents}
+
+  resolved = {}
+  errors = []
+  for future in as_completed(futures):
+    document = futures[future]
+    try:
+      file_id = future.result()
+    except Exception as e:
+      logging.error(f'Unexpected error resolving OpenAI file for document {document["Id"]}. {e}')
+      reports[document['Id']]['Error'] = str(e)
+      file_id = None
+    if file_id:
+      resolved[file_id] = document['Id']
+    else:
+      errors.append({'Id': document['Id'], 'Name': document['Name'], 'error': reports[document['Id']].get('Error') or 'Failed to resolve file.'})
 
-  Notes:
-      - Uses `client.beta.assistants.create` to create an agent with properties like name and instructions.
-      - Manages file uploads via `client.files.create` and stores agent details locally in `/tmp/agents/{agent_id}.json`.
-      - Ensures the `/tmp/agents` directory exists for storing agent data.
+  breakdown = ', '.join(f'{document["Name"]}: download {report.get("Download", 0):.2f}s upload {report.get("Upload", 0):.2f}s{" (cached)" if report.get("Cached") else ""}'
+                        for document in documents for report in [reports[document['Id']]])
+  logging.info(f'Resolving {len(documents)} file(s) took {time.time() - start} seconds [{breakdown}]')
+  return resolved, errors
+
+def sync_agent_vector_store(agent_data):
+  """
+  Brings the agent's persistent vector store in line with its current document set, creating the store if the agent
+  doesn't have one yet. Only files that were added to or removed from the agent are sent to OpenAI, so files that are
+  already indexed stay indexed. Files are resolved concurrently and a new vector store is created while they are.
+  Documents that fail to resolve are reported and their files are left in the store until the next sync.
+
+  Parameters:
+      agent_data (dict): The agent data as returned by `get_agent_data`.
+
+  Returns:
+      tuple[str, list[dict]]: The OpenAI ID of the agent's vector store, None if the agent has no documents or the sync failed,
+      and the documents that failed to resolve (see `resolve_agent_files`).
+  """
+  start = time.time()
+  store = get_agent_vector_store(agent_data['Id'])
+  vs_future = None
+  if store is None and agent_data['Documents']:
+    vs_future = upload_executor.submit(client.beta.vector_stores.create, name=f'agent_vs-{agent_data['Id']}', metadata={'agent_id': agent_data['Id']})
+
+  desired, errors = resolve_agent_files(agent_data['Documents'])
+  failed_doc_ids = {error['Id'] for error in errors}
+  resolved = time.time()
+
+  if vs_future is not None:
+    try:
+      vector_store = vs_future.result()
+    except Exception as e:
+      logging.error(f'Error creating vector store for agent {agent_data["Id"]}: {e}')
+      return None, errors
+    try:
+      if not desired:
+        client.beta.vector_stores.delete(vector_store.id)
+        return None, errors
+      client.beta.vector_stores.file_batches.create(vector_store_id=vector_store.id, file_ids=list(desired))
+    except Exception as e:
+      logging.error(f'Failed to add files to vector store {vector_store.id}. {e}')
+      return None, errors
+    vector_store_id = register_agent_vector_store(agent_data['Id'], vector_store.id, desired)
+    if vector_store_id == vector_store.id:
+      logging.info(f'Creating vector store {vector_store_id} took {time.time() - start} seconds ({resolved - start} resolving files)')
+      return vector_store_id, errors
+    # Another worker registered a vector store for the agent first, drop ours and sync theirs.
+    try:
+      client.beta.vector_stores.delete(vector_store.id)
+    except Exception as e:
+      logging.error(f'Failed to discard duplicate vector store {vector_store.id}. {e}')
+    store = get_agent_vector_store(agent_data['Id'])
+  if store is None:
+    return None, errors
+
+  vector_store_id = store['VectorStoreId']
+  added = {file_id: doc_id for file_id, doc_id in desired.items() if file_id not in store['Files']}
+  stale = [file_id for file_id, doc_id in store['Files'].items() if file_id not in desired and doc_id not in failed_doc_ids]
+  removed = []
+  if added:
+    try:
+      client.beta.vector_stores.file_batches.create(vector_store_id=vector_store_id, file_ids=list(added))
+    except Exception as e:
+      logging.error(f'Failed to add files {list(added)} to vector store {vector_store_id}. {e}')
+      added = {}
+
+  def remove(file_id):
+    try:
+      client.beta.vector_stores.files.delete(file_id=file_id, vector_store_id=vector_store_id)
+    except NotFoundError:
+      pass
+    return file_id
+
+  futures = {upload_executor.submit(remove, file_id): file_id for file_id in stale}
+  for future in as_completed(futures):
+    try:
+      removed.append(future.result())
+    except Exception as e:
+      logging.error(f'Failed to remove file {futures[future]} from vector store {vector_store_id}. {e}')
+
+  if added or removed:
+    logging.info(f'Synced vector store {vector_store_id} of agent {agent_data["Id"]}: added {list(added)}, removed {removed}')
+    update_vector_store_files(vector_store_id, added, removed)
+  logging.info(f'Syncing vector store {vector_store_id} took {time.time() - start} seconds ({resolved - start} resolving files)')
+  return vector_store_id, errors
+
+def provision_agent(agent_data):
+  """
+  Returns the pooled OpenAI assistant for the agent's current configuration, creating and registering it first
+  if the pool doesn't hold one yet. Pooled assistants are shared across chats and users and are only removed
+  when the agent is updated or deleted.
+
+  Parameters:
+      agent_data (dict): The agent data as returned by `get_agent_data`.
+
+  Returns:
+      tuple[str, str] or tuple[None, None]: The OpenAI ID of the pooled assistant and of the agent's persistent vector store
+      (None if the agent has no documents), or None for both if provisioning failed.
+  """
+  tools = build_agent_tools(agent_data)
+  config_hash = compute_agent_config_hash(agent_data, tools)
+  pooled = get_agent_assistant(config_hash)
+  if pooled:
+    logging.info(f'Reusing pooled assistant {pooled["AssistantId"]} for agent {agent_data["Id"]}')
+    return pooled['AssistantId'], pooled['VectorStoreId']
+
+  vector_store_id = None
+  tool_resources = {}
+  if len(agent_data['Documents']) > 0:
+    vector_store_id, errors = sync_agent_vector_store(agent_data)
+    if errors:
+      logging.error(f'Some documents of agent {agent_data["Id"]} could not be provided to OpenAI: {errors}')
+    if not vector_store_id:
+      return None, None
+    tool_resources = {"file_search": {"vector_store_ids": [vector_store_id]}}
+
+  # Lets the orphan sweeper match assistants that never made it into the pool to the chats of their agent
+  metadata = {'agent_id': agent_data['Id']}
+  try:
+    if tools and tool_resources:
+      agent = client.beta.assistants.create(name=agent_data['Name'],
+                                          instructions=agent_data['Instructions'], 
+                                          model=agent_data['Model'], 
+                                          tools=tools,
+                                          tool_resources=tool_resources,
+                                          metadata=metadata)
+    elif tools:
+      agent = client.beta.assistants.create(name=agent_data['Name'],
+                                            instructions=agent_data['Instructions'],
+                                            model=agent_data['Model'],
+                                            tools=tools,
+                                            metadata=metadata)
+    else:
+      agent = client.beta.assistants.create(name=agent_data['Name'],
+                                            instructions=agent_data['Instructions'],
+                                            model=agent_data['Model'],
+                                            metadata=metadata
+                                          )
+  except Exception as e:
+    logging.error(f'Error creating agent {agent_data["Id"]} in OpenAI. {e}')
+    return None, None
+
+  # Files belong to the OpenAI file cache and the vector store to the agent, both outlive the pooled assistant.
+  pooled_id = register_agent_assistant(agent_data['Id'], config_hash, agent.id, vector_store_id)
+  if pooled_id is None:
+    # The assistant still works for this chat, it just won't be reused.
+    logging.warning(f'Assistant {agent.id} could not be added to the pool.')
+    return agent.id, vector_store_id
+  if pooled_id != agent.id:
+    # Another worker pooled an assistant for the same configuration first, drop ours.
+    logging.info(f'Assistant for config {config_hash} was pooled concurrently, discarding {agent.id}')
+    try:
+      client.beta.assistants.delete(assistant_id=agent.id)
+    except Exception as e:
+      logging.error(f'Failed to discard duplicate assistant {agent.id}. {e}')
+  return pooled_id, vector_store_id
+
+def is_assistant_pooled(oai_agent_id):
+  """
+  Checks whether an assistant, e.g. from an `agent_session` cookie, is still in the assistant pool. Assistants leave the pool
+  when their agent is updated or deleted and are deleted from OpenAI shortly after (see `invalidate_agent_assistants`).
+  If the pool can't be checked the assistant is assumed to be pooled.
+  """
+  if not oai_agent_id:
+    return False
+  pooled = get_pooled_assistant_ids([oai_agent_id])
+  return pooled is None or oai_agent_id in pooled
+
+def refresh_agent_session(agent_session):
+  """
+  Makes sure the assistant of an `agent_session` cookie is still pooled, resolving the agent's current pooled assistant
+  if it is not.
+
+  Parameters:
+      agent_session (dict): The agent session as read from the cookie.
+
+  Returns:
+      dict or None: The given session if its assistant is still pooled, an updated copy to set as the new cookie if the
+      assistant was replaced, or None if the agent could not be resolved.
+  """
+  if is_assistant_pooled(agent_session.get('oai_agent_id')) or not agent_session.get('agent_id'):
+    return agent_session
+  agent_data = get_agent_data(agent_session['agent_id'])
+  if not agent_data:
+    return None
+  oai_agent_id, vs_id = provision_agent(agent_data)
+  if not oai_agent_id:
+    return None
+  logging.info(f'Replaced stale assistant {agent_session["oai_agent_id"]} of agent {agent_data["Id"]} with {oai_agent_id}')
+  return {**agent_session, 'oai_agent_id': oai_agent_id, 'vector_store_id': vs_id or ''}
+
+def create_agent(agent_id):
+  """
+  Resolves the OpenAI assistant for a database-stored agent. The assistant from the current `agent_session` cookie
+  is used if it belongs to the same agent, otherwise the agent's pooled assistant is used (see `provision_agent`).
+  The agent's pointer agent, if any, starts provisioning in the background (see `prefetch_next_agent`).
+
+  Parameters:
+      agent_id (str): The unique identifier for the database-stored agent.
+
+  Returns:
+      [str, list, str] or None: The OpenAI ID of the assistant, the OpenAI IDs of files uploaded for this chat only and the
+      ID of the agent's persistent vector store. Pooled assistants use cached files, so the file list is empty for them.
+      None is returned if the agent could not be resolved.
 
   Example:
-      >>> agent_id = create_agent('1234')
-      >>> print(agent_id)
-      'unique-agent-id'
+      >>> oai_agent_id, file_ids, vs_id = create_agent('1234')
+      >>> print(oai_agent_id)
+      'asst_abc123'
   """
   start = time.time()
   agent_data = get_agent_data(agent_id)
-  file_ids = []
   if not agent_data or agent_data is None:
     return None
   
-  agent_session = get_agent_session()
-  chat_session = get_chat_session()
-  module_session = get_module_session()
-  tools = []
-  tool_resources = {}
-  vector_store_id = ''
+  # Outside of Flask requests (the ASGI chat path runs this in worker threads) there is no cookie to reuse.
+  agent_session = get_agent_session() if has_request_context() else None
 
-  if agent_session is not None and agent_session.get('agent_id') == agent_data['Id']:
+  if agent_session is not None and agent_session.get('agent_id') == agent_data['Id'] and is_assistant_pooled(agent_session.get('oai_agent_id')):
     oai_agent_id = str(agent_session['oai_agent_id'])
+    vs_id = agent_session.get('vector_store_id') or ''
     print("Loaded existing assistant ID")
-  # Check for existing agent in OpenAI (Introduce existing_agent_id to agent table?)
   else:
-    if len(agent_data['Documents']) > 0:
-      files = agent_data['Documents']
-      
-      file_ids = []
-      
-      for file in files:
-        file_bytes = serve_file(file['URL'])
-        if not file_bytes:
-          return None
-        file_object = (file['Name'], file_bytes)
-        upload_file = client.files.create(file=file_object, purpose='assistants')
-        file_ids.append(upload_file.id)
-        
-      if chat_session and 'vector_store_id' in chat_session:
-        vector_store_id = chat_session['vector_store_id']
-        try:
-          client.beta.vector_stores.file_batches.create(vector_store_id=vector_store_id, file_ids=file_ids)
-        except Exception as e:
-          logging.error(f"Error updating vector store {vector_store_id}: {e}")
-      else:
-        try:
-          vector_store = client.beta.vector_stores.create(name=f'temp_vs-{module_session['Name']}', file_ids=file_ids)
-          vector_store_id = vector_store.id
-        except Exception as e:
-          logging.error(f"Error creating vector store: {e}")
-      tools.append({"type": "file_search"})
-      tool_resources = {"file_search": {"vector_store_ids": [vector_store_id]}}
-
-      # try: 
-      #   agent = client.beta.assistants.create(name=agent_data['Name'],
-      #     instructions=agent_data['Instructions'],
-      #     model=agent_data['Model'],
-      #     tools=[{
-      #       "type": "file_search"
-      #     }],
-      #     tool_resources={"file_search": {"vector_stores": [{"file_ids": file_ids}]}},
-      #    )
-      # except BadRequestError as e:
-      #   print(f"Error: {e}")
-      #   return None
-    # else:
-    # agent = client.beta.assistants.create(name=agent_data['Name'],
-    #                                       instructions=agent_data['Instructions'],
-    #                                       model=agent_data['Model']
-    #                                      )
-    if 'AgentPointer' in agent_data and agent_data['AgentPointer'] is not None and agent_data['AgentPointer'] != 'None':
-      # agent = client.beta.assistants.update(assistant_id=agent.id, tools=[{
-      #   'type': 'function',
-      #   'function': {
-      #     'name': 'point_to_agent',
-      #     'description': 'Function for switching to another agent.'
-      #   }
-      #   }])
-      tools.append({
-        'type': 'function',
-        'function': {
-          'name': 'point_to_agent',
-          'description': 'Function for switching to another agent.'
-        }})
-      
-    try:
-      if tools and tool_resources:
-        agent = client.beta.assistants.create(name=agent_data['Name'],
-                                            instructions=agent_data['Instructions'], 
-                                            model=agent_data['Model'], 
-                                            tools=tools,
-                                            tool_resources=tool_resources)
-      else:
-        agent = client.beta.assistants.create(name=agent_data['Name'],
-                                              instructions=agent_data['Instructions'],
-                                              model=agent_data['Model']
-                                            )
-    except Exception as e:
-      logging.error(f'Error creating agent {agent_id} in OpenAI. {e}')
+    oai_agent_id, vs_id = provision_agent(agent_data)
+    if not oai_agent_id:
       return None
-    
-    oai_agent_id = agent.id
+  prefetch_next_agent(agent_data)
   end = time.time()
   logging.info(f'Agent creation took {end - start} seconds')
-  return oai_agent_id, file_ids, vector_store_id
\ No newline at end of file
+  return oai_agent_id, [], vs_id or ''
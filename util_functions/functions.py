@@ -1,3 +1,5 @@
+import base64
+import json
 import logging
 import string
 import unicodedata
@@ -7,13 +9,15 @@ from datetime import datetime, timedelta
 from flask.helpers import make_response
 import requests
 import pytz
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import threading
 from flask import Flask, request, jsonify, current_app, g, Response
 import hashlib
 
 from werkzeug.datastructures.file_storage import FileStorage
-from config import user_session_serializer, module_session_serializer, chat_session_serializer, agent_session_serializer
-from functools import wraps
+from config import AGENT_CACHE_SIZE, AGENT_CACHE_TTL, BCRYPT_QUEUE_LIMIT, BCRYPT_ROUNDS, BCRYPT_TIMEOUT, BCRYPT_WORKERS, PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX, user_session_serializer, module_session_serializer
+from functools import lru_cache, wraps
+from operator import attrgetter
 import bcrypt
 from sqlalchemy.inspection import inspect
 import os
@@ -90,9 +94,15 @@ def transform_transcript_names(vf_transcripts, sql_transcripts):
         
   return vf_transcripts
 
+@lru_cache(maxsize=None)
+def _model_fields(model_class):
+  mapper = inspect(model_class)
+  return [c.key for c in mapper.column_attrs], [(r.key, r.uselist) for r in mapper.relationships]
+
 def model_to_dict(model, include_relationships=False):
   """
   Converts an SQLAlchemy model instance into a dictionary, optionally including related objects.
+  The columns and relationships of each model class are inspected once and cached.
 
   Parameters:
       model (SQLAlchemy Model): The model instance to convert.
@@ -101,17 +111,17 @@ def model_to_dict(model, include_relationships=False):
   Returns:
       dict: A dictionary representation of the model instance.
   """
-  model_dict = {c.key: getattr(model, c.key)
-                for c in inspect(model).mapper.column_attrs}
+  column_keys, relationships = _model_fields(type(model))
+  model_dict = {key: getattr(model, key) for key in column_keys}
   
   if include_relationships:
-    for relationship in inspect(model).mapper.relationships:
-        related_objects = getattr(model, relationship.key)
+    for key, uselist in relationships:
+        related_objects = getattr(model, key)
         if related_objects is not None:
-          if relationship.uselist: 
-            model_dict[relationship.key] = [model_to_dict(obj, include_relationships=False) for obj in related_objects]
+          if uselist: 
+            model_dict[key] = [model_to_dict(obj, include_relationships=False) for obj in related_objects]
           else:  
-            model_dict[relationship.key] = model_to_dict(related_objects, include_relationships=False)
+            model_dict[key] = model_to_dict(related_objects, include_relationships=False)
 
   for key, value in model_dict.items():
       if isinstance(value, datetime):
@@ -119,6 +129,42 @@ def model_to_dict(model, include_relationships=False):
   
   return model_dict
 
+def format_timestamp(value: datetime):
+  """
+  Formats a timestamp like the API always has, e.g. `2024-05-01T12:30:45.123` (millisecond precision, no offset).
+  """
+  if value is None:
+    return None
+  if value.tzinfo is not None:
+    value = value.replace(tzinfo=None)
+  return value.isoformat(timespec='milliseconds')
+
+def str_or_none(value):
+  return str(value) if value is not None else None
+
+def compile_serializer(fields: dict):
+  """
+  Builds a serializer of rows into API dicts once, instead of spelling the conversion out on every call.
+  Works with ORM objects and column-only `Row`s alike, as long as the attribute names match.
+
+  Parameters:
+      fields (dict[str, str | tuple[str, Callable]]): Output key mapped to the attribute it is read from, or to a tuple of the
+      attribute and a converter applied to its value (e.g. `format_timestamp`, `str_or_none`).
+
+  Returns:
+      Callable: A function converting one row into a dict.
+
+  Example:
+      >>> serialize = compile_serializer({'Id': ('id', str), 'Name': 'name', 'Created': ('created', format_timestamp)})
+      >>> serialize(row)
+      {'Id': '...', 'Name': '...', 'Created': '2024-05-01T12:30:45.123'}
+  """
+  getters = [(key, attrgetter(attr), None) if isinstance(attr, str) else (key, attrgetter(attr[0]), attr[1]) for key, attr in fields.items()]
+
+  def serialize(row):
+    return {key: convert(getter(row)) if convert else getter(row) for key, getter, convert in getters}
+  return serialize
+
 def check_user_projects(projects, user_projects):
   """
   DEPRECATED
@@ -185,6 +231,30 @@ def check_is_current_user(user_id):
   if user_info:
     return user_id == user_info['Id']
 
+def load_session_cookie(name: str, serializer):
+  """
+  Verifies and deserializes a signed session cookie of the current request. The result is kept in `g` for the rest of the
+  request, so the signature is checked once per request however many helpers read the cookie.
+  Invalid cookies are not memoized, every read raises the serializer's error like before.
+
+  Parameters:
+      name (str): The name of the cookie, e.g. `user_session`.
+      serializer (URLSafeSerializer | SessionStore): The serializer the cookie was signed with, or the store of a server-side session.
+
+  Returns:
+      any: The deserialized cookie data or None if the cookie is not present.
+  """
+  value = request.cookies.get(name)
+  if not value:
+    return None
+  cookies = g.setdefault('session_cookies', {})
+  cached = cookies.get(name)
+  if cached is not None and cached[0] == value:
+    return cached[1]
+  data = serializer.loads(value)
+  cookies[name] = (value, data)
+  return data
+
 def get_chat_session():
   """
   Retrieves the chat session data from cookies.
@@ -192,9 +262,9 @@ def get_chat_session():
   Returns:
       any: The deserialized chat session data or None if no chat session is present in cookies.
   """
-  chat_session = request.cookies.get('chat_session')
-  if chat_session:
-    return chat_session_serializer.loads(chat_session)
+  # The cookie holds a handle of the session stored server-side (imported here, the store depends on this module)
+  from services.session_store import chat_sessions
+  return chat_sessions.load_request_session()
 
 def get_user_info():
   """
@@ -203,9 +273,7 @@ def get_user_info():
   Returns:
       dict: The deserialized user info data or None if no user session is present in cookies.
   """
-  user_session = request.cookies.get('user_session')
-  if user_session:
-    return user_session_serializer.loads(user_session)
+  return load_session_cookie('user_session', user_session_serializer)
 
 def get_module_session():
   """
@@ -214,9 +282,7 @@ def get_module_session():
   Returns:
       dict: The deserialized module session data or None if no module session is present in cookies.
   """
-  module_session = request.cookies.get('module_session')
-  if module_session:
-    return module_session_serializer.loads(module_session)
+  return load_session_cookie('module_session', module_session_serializer)
   
 def get_agent_session():
   """
@@ -225,9 +291,8 @@ def get_agent_session():
   Returns:
       dict: The deserialized agent session data or None if no module session is present in cookies.
   """
-  agent_session = request.cookies.get('agent_session')
-  if agent_session:
-    return agent_session_serializer.loads(agent_session)
+  from services.session_store import agent_sessions
+  return agent_sessions.load_request_session()
   
   
 def check_admin():
@@ -259,9 +324,8 @@ def roles_required(*required_roles):
         f
     )  # preserves name and docstring of the function => distinguishes particular calls of decorator
     def wrapper(*args, **kwargs):
-      user_session = request.cookies.get('user_session')
-      if user_session:
-        user_info = user_session_serializer.loads(user_session)
+      user_info = get_user_info()
+      if user_info:
         user_roles = user_info['Roles']
         if not user_roles:
           return jsonify({'message': 'Invalid session.'}), 401
@@ -278,22 +342,48 @@ def roles_required(*required_roles):
   return decorator
 
 
+class PasswordHashingBusy(Exception):
+  """Raised by `hash_password` and `check_password` when the bcrypt executor is saturated, answered with 503 by the routes."""
+  pass
+
+# bcrypt saturates a core for each hash. Hashing runs on its own few threads so a login burst can't starve the request workers,
+# requests beyond `BCRYPT_QUEUE_LIMIT` waiting ones are rejected right away instead of queueing up.
+bcrypt_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix='bcrypt')
+_bcrypt_slots = threading.BoundedSemaphore(BCRYPT_WORKERS + BCRYPT_QUEUE_LIMIT)
+
+def _run_bcrypt(func, *args):
+  if not _bcrypt_slots.acquire(blocking=False):
+    raise PasswordHashingBusy('Too many password operations in progress.')
+  try:
+    future = bcrypt_executor.submit(func, *args)
+  except Exception:
+    _bcrypt_slots.release()
+    raise
+  future.add_done_callback(lambda _: _bcrypt_slots.release())
+  try:
+    return future.result(timeout=BCRYPT_TIMEOUT)
+  except FutureTimeoutError:
+    raise PasswordHashingBusy(f'Password operation did not finish within {BCRYPT_TIMEOUT} seconds.')
+
 def hash_password(password):
   """
-  Hashes a password using bcrypt.
+  Hashes a password using bcrypt with `BCRYPT_ROUNDS` rounds, on the bcrypt executor.
 
   Parameters:
       password (str): The password to hash.
 
   Returns:
       str: The hashed password.
+
+  Raises:
+      PasswordHashingBusy: If the bcrypt executor is saturated.
   """
-  hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+  hashed = _run_bcrypt(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
   return hashed.decode('utf-8')
 
 def check_password(hashed, password):
   """
-  Checks a password against a hashed value using bcrypt.
+  Checks a password against a hashed value using bcrypt, on the bcrypt executor.
 
   Parameters:
       hashed (str): The hashed password.
@@ -301,8 +391,20 @@ def check_password(hashed, password):
 
   Returns:
       bool: True if the password matches the hash, False otherwise.
+
+  Raises:
+      PasswordHashingBusy: If the bcrypt executor is saturated.
   """
-  return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+  return _run_bcrypt(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+def password_needs_rehash(hashed: str):
+  """
+  Checks if a password hash was made with a cost factor other than `BCRYPT_ROUNDS`, e.g. `$2b$10$...` after raising it to 12.
+  """
+  try:
+    return int(hashed.split('$')[2]) != BCRYPT_ROUNDS
+  except (IndexError, ValueError):
+    return False
 
 def encrypt_token(key, token):
   """
@@ -416,7 +518,83 @@ def is_valid_uuid(test_uuid, version=4):
     return False
   return True
 
+def encode_cursor(created: datetime, row_id):
+  """
+  Encodes the position of a row in a list ordered by `created` and `id` into an opaque pagination cursor.
+  """
+  return base64.urlsafe_b64encode(json.dumps([created.isoformat(), str(row_id)]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str):
+  """
+  Decodes a pagination cursor created by `encode_cursor`.
+  
+  Returns:
+    tuple[datetime, UUID]: The `created` and `id` of the last row of the previous page.
+    
+  Raises:
+    ValueError: The cursor is malformed.
+  """
+  try:
+    created, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    if not isinstance(created, str) or not isinstance(row_id, str):
+      raise ValueError('Both fields have to be strings.')
+    return datetime.fromisoformat(created), uuid.UUID(row_id)
+  except (TypeError, ValueError, UnicodeError) as e:
+    raise ValueError(f'Invalid cursor. {e}')
+
+def get_int_arg(name: str, default: int=None, minimum: int=None, maximum: int=None):
+  """
+  Parses an integer argument from the query string. Unlike `request.args.get(name, type=int)`, which silently falls back to
+  the default, a malformed or out of range value is an error.
+
+  Returns:
+    int or None: The value, or `default` if the argument is not passed.
+
+  Raises:
+    ValueError: The value is not an integer or not within `minimum` and `maximum`.
+  """
+  value = request.args.get(name)
+  if not value:
+    return default
+  try:
+    value = int(value)
+  except ValueError:
+    raise ValueError(f"'{name}' has to be a whole number.")
+  if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+    raise ValueError(f"'{name}' has to be between {minimum} and {maximum}." if maximum is not None else f"'{name}' has to be at least {minimum}.")
+  return value
+
+def get_page_args(*filters: str):
+  """
+  Parses the pagination arguments of a list endpoint from the query string: `limit` (at most `PAGE_SIZE_MAX`), `cursor`
+  (the `next_cursor` of the previous page) and the `created_after` and `created_before` ISO dates, along with the endpoint's own `filters`.
+  
+  Returns:
+    dict or None: The arguments as keyword arguments of the page functions in `services.sql_service`, None if the request
+    passes none of them and the endpoint should return the whole list like before.
+    
+  Raises:
+    ValueError: An argument is invalid.
+  """
+  names = ('limit', 'cursor', 'created_after', 'created_before', *filters)
+  if not any(request.args.get(name) for name in names):
+    return None
+  limit = get_int_arg('limit', PAGE_SIZE_DEFAULT, minimum=1, maximum=PAGE_SIZE_MAX)
+  cursor = request.args.get('cursor')
+  args = {'limit': limit, 'cursor': decode_cursor(cursor) if cursor else None}
+  for name in ('created_after', 'created_before'):
+    value = request.args.get(name)
+    try:
+      args[name] = datetime.fromisoformat(value) if value else None
+    except ValueError:
+      raise ValueError(f'Invalid {name} date.')
+  for name in filters:
+    args[name] = request.args.get(name) or None
+  return args
+
 import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 
 class TimeoutException(Exception):
@@ -453,6 +631,72 @@ def timeout(seconds):
       return wrapper
   return decorator
 
+class TTLCache:
+  """
+  Thread-safe in-process cache holding at most `maxsize` entries, each for at most `ttl` seconds.
+  The least recently used entry is evicted when the cache is full. Hits and misses are counted for `stats`.
+  
+  Parameters:
+    maxsize (int): The maximum number of entries.
+    ttl (int): The number of seconds an entry is served for.
+  """
+  _MISSING = object()
+
+  def __init__(self, maxsize: int, ttl: int):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._entries.get(key, self._MISSING)
+      if entry is self._MISSING or entry[0] < time.monotonic():
+        if entry is not self._MISSING:
+          del self._entries[key]
+        self.misses += 1
+        return default
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[1]
+
+  def set(self, key, value):
+    with self._lock:
+      self._entries[key] = (time.monotonic() + self.ttl, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+
+  def invalidate(self, *keys):
+    with self._lock:
+      for key in keys:
+        if self._entries.pop(key, None) is not None:
+          self.invalidations += 1
+
+  def clear(self):
+    with self._lock:
+      self.invalidations += len(self._entries)
+      self._entries.clear()
+
+  def stats(self):
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+        'size': len(self._entries),
+        'maxsize': self.maxsize,
+        'ttl': self.ttl,
+        'hits': self.hits,
+        'misses': self.misses,
+        'invalidations': self.invalidations,
+        'hit_rate': self.hits / lookups if lookups else None
+      }
+
+# Agent definitions as returned by `get_agent_data`, keyed by agent ID. Written through by every function modifying agents.
+agent_cache = TTLCache(maxsize=AGENT_CACHE_SIZE, ttl=AGENT_CACHE_TTL)
+
 def normalize_file_name(file_name: str) -> str:
     """
     Normalizes a file name to make it usable and safe across various services.
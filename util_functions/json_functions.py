@@ -0,0 +1,60 @@
+import dataclasses
+import decimal
+import uuid
+from datetime import date
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
+
+try:
+  import orjson
+except ImportError: # optional, responses fall back to the standard library encoder
+  orjson = None
+
+
+def _default(o):
+  # Same conversions as Flask's default provider, dates are passed through by orjson to keep Flask's HTTP date format
+  if isinstance(o, date):
+    return http_date(o)
+  if isinstance(o, (decimal.Decimal, uuid.UUID)):
+    return str(o)
+  if dataclasses.is_dataclass(o):
+    return dataclasses.asdict(o)
+  if hasattr(o, '__html__'):
+    return str(o.__html__())
+  raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+  """
+  Flask JSON provider encoding and decoding with `orjson` when it is installed. The output matches the default provider
+  (sorted keys, HTTP dates, compact unless in debug mode), except that non-ASCII characters are written as UTF-8 instead of escaped.
+  Without `orjson` it behaves exactly like the default provider.
+
+  Usage:
+      app.json = FastJSONProvider(app)
+  """
+
+  def _options(self):
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    if self.sort_keys:
+      options |= orjson.OPT_SORT_KEYS
+    return options
+
+  def dumps(self, obj, **kwargs):
+    if orjson is None or kwargs:
+      return super().dumps(obj, **kwargs)
+    return orjson.dumps(obj, default=_default, option=self._options()).decode('utf-8')
+
+  def loads(self, s, **kwargs):
+    if orjson is None or kwargs:
+      return super().loads(s, **kwargs)
+    return orjson.loads(s)
+
+  def response(self, *args, **kwargs):
+    if orjson is None:
+      return super().response(*args, **kwargs)
+    obj = self._prepare_response_obj(args, kwargs)
+    options = self._options() | orjson.OPT_APPEND_NEWLINE
+    if (self.compact is None and self._app.debug) or self.compact is False:
+      options |= orjson.OPT_INDENT_2
+    return self._app.response_class(orjson.dumps(obj, default=_default, option=options), mimetype=self.mimetype)
@@ -1,16 +1,23 @@
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import override
 from flask import jsonify, request
 from openai.lib.streaming._assistants import AssistantEventHandler
 from openai.types.beta.threads.file_citation_annotation import FileCitationAnnotation
 from openai.types.beta.threads.text_content_block import TextContentBlock
 from openai.types.beta.threads.text_delta import TextDelta
+from openai import NotFoundError
 from config import OPENAI_CLIENT as client, chat_session_serializer, agent_session_serializer
 import re
 
-from services.sql_service import get_agent_data
+from services.sql_service import backfill_chat_messages, delete_chat_messages, get_agent_data, get_chat_messages, get_last_message_ids
+from services.usage_service import record_usage
 from util_functions.functions import get_agent_session, get_chat_session
 
+# Thread messages are deleted concurrently
+message_executor = ThreadPoolExecutor(max_workers=4)
+
 class Text:
     def __init__(self, value, annotations=[]):
         self.value = value
@@ -43,6 +50,43 @@ def convert_content(content_list):
 def convert_attachments(attachments):
     return [{'file_id': attachment.file_name, 'tools': [{'type': tool.type} for tool in attachment.tools]} for attachment in attachments]
 
+def serialize_message(message):
+    """
+    Serializes an OpenAI thread message for the `ChatMessage` mirror, with the content and attachments in the format served by the history endpoints.
+    """
+    return {
+        'MessageId': message.id,
+        'Role': message.role,
+        'Content': convert_content(message.content),
+        'Attachments': convert_attachments(message.attachments or []),
+        'CreatedAt': message.created_at
+    }
+
+def get_thread_messages(thread_id: str, limit: int=50, before: int=None):
+    """
+    Retrieves a page of the messages of a thread from the `ChatMessage` mirror (see `services.sql_service.get_chat_messages`).
+    Threads created before the mirror existed are backfilled from OpenAI on their first read.
+
+    Parameters:
+        thread_id (str): The ID of the thread.
+        limit (int): The maximum number of messages returned.
+        before (int): The cursor of the page, omit for the latest messages.
+
+    Returns:
+        dict or None: The page with `Messages` and `NextCursor` or None if the thread has no chat session or the operation failed.
+
+    Raises:
+        NotFoundError: If the thread has to be backfilled but no longer exists on OpenAI.
+    """
+    page = get_chat_messages(thread_id, limit=limit, before=before)
+    if page is None or page['Mirrored']:
+        return page
+    messages = [serialize_message(message) for message in client.beta.threads.messages.list(thread_id=thread_id, order='asc', limit=100)]
+    logging.info(f'Backfilling {len(messages)} messages of thread {thread_id}')
+    if backfill_chat_messages(thread_id, messages) is None:
+        return None
+    return get_chat_messages(thread_id, limit=limit, before=before)
+
 def convert_annotations(annotations):
     serialized_annotations = []
     for annotation in annotations:
@@ -180,10 +224,21 @@ def strip_message(modified_message: str, flag: str=None) -> str:
     modified_message = re.sub(r'【.*?†source】', '', modified_message)
     return modified_message.strip()
 
+def _delete_thread_message(thread_id: str, message_id: str):
+    try:
+        deleted = client.beta.threads.messages.delete(message_id=message_id, thread_id=thread_id).deleted
+    except NotFoundError:
+        deleted = True
+    if not deleted:
+        logging.warning(f'Failed to delete message {message_id} on thread {thread_id}')
+    return deleted
+
 def safely_delete_last_messages(thread_id: str, config: int=2):
     """
     Safely deletes the last messages from the thread. If the thread is not found, returns None and does nothing. 
     None is also returned if there are less messages than set in `config`.
+    The message IDs are taken from the `ChatMessage` ledger and deleted concurrently, the thread is only listed on OpenAI
+    if it is not mirrored yet.
     
     Parameters:
         thread_id (str): The ID of the thread the conversation is being held on.
@@ -193,17 +248,117 @@ def safely_delete_last_messages(thread_id: str, config: int=2):
         bool or None: A boolean value indicating whether the deletion was successful or None if it faied.
     """
     try:
-        messages = client.beta.threads.messages.list(thread_id=thread_id)
-        if not messages or len(messages.data) <= config:
+        message_ids = get_last_message_ids(thread_id, config + 1)
+        if message_ids is None:
+            messages = client.beta.threads.messages.list(thread_id=thread_id, limit=config + 1)
+            message_ids = [message.id for message in messages.data]
+        if len(message_ids) <= config:
             return None
-        for i in range(config):
-            deleted = client.beta.threads.messages.delete(message_id=messages.data[i].id, thread_id=thread_id).deleted
-            if not deleted:
-                logging.warning(f'Failed to delete message {messages.data[i].id} on thread {thread_id}')
-        return True
+        message_ids = message_ids[:config]
+        results = list(message_executor.map(lambda message_id: _delete_thread_message(thread_id, message_id), message_ids))
+        delete_chat_messages([message_id for message_id, deleted in zip(message_ids, results) if deleted])
+        return all(results)
     except Exception as e:
         logging.error(f'Unexpected error occured when attempting to remove messages from thread. {e}')
         
+# Runs that finish on their own feed the average completion size used to estimate the tokens a cancellation saved.
+_run_stats_lock = threading.Lock()
+run_stats = {'completed': 0, 'completion_tokens': 0, 'cancelled': 0, 'cancel_failed': 0, 'tokens_saved': 0}
+
+# Rough number of characters per token, used to estimate the tokens a run generated before it was cancelled.
+CHARS_PER_TOKEN = 4
+
+class RunGuard:
+    """
+    Tracks a streamed OpenAI run so it can be cancelled when the client goes away mid-stream. Feed it every streamed
+    event, then call `cancel` when the stream is abandoned (`GeneratorExit` on the sync path, `CancelledError` on the async one).
+
+    The token usage reported by the run once it ends is recorded through `services.usage_service.record_usage`.
+
+    Parameters:
+        thread_id (str): The ID of the thread the run is executed on.
+        usage_context (dict): The `chat_session_id` and `agent_id` the token usage is attributed to.
+
+    Usage:
+    >>> guard = RunGuard(thread_id)
+    >>> try:
+    ...     for event in stream:
+    ...         guard.observe(event)
+    ...         yield ...
+    ... except GeneratorExit:
+    ...     guard.cancel()
+    ...     raise
+    """
+    TERMINAL_EVENTS = ('thread.run.completed', 'thread.run.failed', 'thread.run.cancelled', 'thread.run.expired', 'thread.run.incomplete')
+
+    def __init__(self, thread_id: str, usage_context: dict=None):
+        self.thread_id = thread_id
+        self.usage_context = usage_context or {}
+        self.run_id = None
+        self.finished = False
+        self.streamed_chars = 0
+
+    def observe(self, event):
+        """
+        Records the run ID, whether the run reached a terminal state and the length of the generated text.
+        Completed runs are added to `run_stats` and the usage of ended runs is recorded.
+        """
+        name = getattr(event, 'event', '') or ''
+        if name == 'thread.message.delta':
+            for block in event.data.delta.content or []:
+                if getattr(block, 'text', None) and block.text.value:
+                    self.streamed_chars += len(block.text.value)
+            return
+        if not name.startswith('thread.run.') or name.startswith('thread.run.step.'):
+            return
+        self.run_id = event.data.id
+        if name in self.TERMINAL_EVENTS:
+            self.finished = True
+            if event.data.usage is not None:
+                record_usage({'run_id': event.data.id, 'model': event.data.model, 'prompt_tokens': event.data.usage.prompt_tokens,
+                              'completion_tokens': event.data.usage.completion_tokens},
+                             chat_session_id=self.usage_context.get('chat_session_id'), agent_id=self.usage_context.get('agent_id'))
+        if name == 'thread.run.completed' and event.data.usage is not None:
+            with _run_stats_lock:
+                run_stats['completed'] += 1
+                run_stats['completion_tokens'] += event.data.usage.completion_tokens
+
+    def cancel(self):
+        """
+        Cancels the run if it is still in progress and records the estimated number of tokens saved, i.e. the average
+        completion size of finished runs minus the tokens generated so far.
+
+        Returns:
+            bool: True if the run was cancelled, False otherwise.
+        """
+        if not self.run_id or self.finished:
+            return False
+        try:
+            client.beta.threads.runs.cancel(run_id=self.run_id, thread_id=self.thread_id)
+        except Exception as e:
+            logging.error(f'Failed to cancel run {self.run_id} on thread {self.thread_id}. {e}')
+            with _run_stats_lock:
+                run_stats['cancel_failed'] += 1
+            return False
+        self.finished = True
+        with _run_stats_lock:
+            average = run_stats['completion_tokens'] / run_stats['completed'] if run_stats['completed'] else 0
+            saved = max(0, int(average - self.streamed_chars / CHARS_PER_TOKEN))
+            run_stats['cancelled'] += 1
+            run_stats['tokens_saved'] += saved
+        logging.info(f'Client disconnected, cancelled run {self.run_id} on thread {self.thread_id} (~{saved} tokens saved)')
+        return True
+
+def get_run_stats():
+    """
+    Returns how many runs were cancelled because the client disconnected, how many cancellations failed and the estimated
+    number of completion tokens saved, along with the average completion size the estimate is based on.
+    """
+    with _run_stats_lock:
+        stats = dict(run_stats)
+    stats['average_completion_tokens'] = stats['completion_tokens'] / stats['completed'] if stats['completed'] else None
+    return stats
+        
 # class OAIEventHandler(AssistantEventHandler):
 #     @override
 #     def on_event(self, event):
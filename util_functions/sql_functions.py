@@ -1,8 +1,10 @@
 import logging
 
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm.session import Session
 from database.database import session_scope
-from database.models import Agent, Module, User, Role, Document
+from database.models import Agent, AgentAssistant, CleanupTask, Module, OpenAIFile, User, Role, Document, VectorStore
+from util_functions.functions import current_time_prague
 import uuid
 import hashlib
 
@@ -209,3 +211,76 @@ def get_user_name(user_id: uuid.UUID, session) -> str:
     query = session.query(User).filter(User.id == user_id).first()
     return query.username if query.username else query.email
 
+def queue_cleanup(session: Session, resource_type: str, resource_ids):
+    """
+    Queues OpenAI resources for deletion in the cleanup outbox as part of the session's transaction, so they are only
+    deleted once the transaction commits (see `services.cleanup_service.drain_cleanup_tasks`).
+
+    Parameters:
+        session (Session): A database session object.
+        resource_type (str): 'assistant', 'file', 'vector_store' or 'thread'.
+        resource_ids (iterable[str]): The OpenAI IDs of the resources.
+    """
+    resource_ids = {resource_id for resource_id in resource_ids if resource_id}
+    if not resource_ids:
+        return
+    now = current_time_prague()
+    session.execute(pg_insert(CleanupTask).values([{
+        'resource_type': resource_type,
+        'resource_id': resource_id,
+        'attempts': 0,
+        'next_attempt_at': now,
+        'created': now,
+        'last_modified': now
+    } for resource_id in resource_ids]).on_conflict_do_nothing(index_elements=['resource_type', 'resource_id']))
+
+def invalidate_agent_assistants(agent_id: uuid.UUID, session: Session):
+    """
+    Removes the pooled OpenAI assistants registered for an agent and queues them for deletion from OpenAI along with
+    the vector stores and files they own. Files held by the OpenAI file cache and the agent's persistent vector store are kept.
+    Nothing is deleted from OpenAI before the session commits, a rolled back change leaves the pool intact. Intended to be
+    called whenever the agent's configuration changes or the agent is deleted, since that is the only time a pooled assistant becomes stale.
+    
+    Parameters:
+        agent_id (UUID): The ID of the database-stored agent.
+        session (Session): A database session object.
+    
+    Returns:
+        list[str]: The OpenAI IDs of the invalidated assistants.
+    """
+    pooled = session.query(AgentAssistant).filter(AgentAssistant.agent_id == agent_id).all()
+    if not pooled:
+        return []
+    persistent_vs_ids = {row.vector_store_id for row in session.query(VectorStore.vector_store_id).filter(VectorStore.agent_id == agent_id).all()}
+    owned_file_ids = [file_id for assistant in pooled for file_id in assistant.file_ids or []]
+    cached_file_ids = set()
+    if owned_file_ids:
+        cached_file_ids = {row.file_id for row in session.query(OpenAIFile.file_id).filter(OpenAIFile.file_id.in_(owned_file_ids)).all()}
+    invalidated = [assistant.oai_assistant_id for assistant in pooled]
+    session.query(AgentAssistant).filter(AgentAssistant.agent_id == agent_id).delete(synchronize_session=False)
+    queue_cleanup(session, 'assistant', invalidated)
+    queue_cleanup(session, 'vector_store', [assistant.vector_store_id for assistant in pooled if assistant.vector_store_id not in persistent_vs_ids])
+    queue_cleanup(session, 'file', [file_id for file_id in owned_file_ids if file_id not in cached_file_ids])
+    logging.info(f'Invalidated pooled assistants {invalidated} of agent {agent_id}')
+    return invalidated
+
+def delete_agent_vector_store(agent_id: uuid.UUID, session: Session):
+    """
+    Deletes the persistent vector store of an agent from the database and queues it for deletion from OpenAI once the
+    session commits. The files in the store belong to the OpenAI file cache and are kept.
+    
+    Parameters:
+        agent_id (UUID): The ID of the database-stored agent.
+        session (Session): A database session object.
+    
+    Returns:
+        str or None: The OpenAI ID of the deleted vector store or None if the agent had none.
+    """
+    store = session.query(VectorStore).filter(VectorStore.agent_id == agent_id).first()
+    if not store:
+        return None
+    vector_store_id = store.vector_store_id
+    session.delete(store)
+    queue_cleanup(session, 'vector_store', [vector_store_id])
+    logging.info(f'Deleted vector store {vector_store_id} of agent {agent_id}')
+    return vector_store_id
@@ -0,0 +1,100 @@
+import json
+import time
+
+
+class DeltaCoalescer:
+  """
+  Buffers streamed text deltas and releases them in larger chunks. A chunk is released once the buffered text reaches
+  `flush_bytes` or the oldest buffered delta has waited `flush_interval` seconds, whichever comes first. The first delta
+  is released right away so coalescing never delays the first token.
+
+  There is no timer: buffered text is only flushed when the next delta arrives (`push`) or the stream ends (`flush`).
+  If the upstream stalls, the text already received (less than `flush_bytes`) is held back until it resumes.
+
+  Parameters:
+    flush_bytes (int): The buffered size in bytes at which a chunk is released. 0 releases every delta immediately.
+    flush_interval (float): The seconds after which buffered text is released regardless of its size.
+
+  Usage:
+  >>> coalescer = DeltaCoalescer(flush_bytes=64, flush_interval=0.05)
+  >>> for delta in deltas:
+  ...   chunk = coalescer.push(delta)
+  ...   if chunk:
+  ...     yield chunk
+  >>> chunk = coalescer.flush()
+  """
+  def __init__(self, flush_bytes: int=64, flush_interval: float=0.05):
+    self.flush_bytes = flush_bytes
+    self.flush_interval = flush_interval
+    self._parts = []
+    self._size = 0
+    self._first_at = None
+    self._started = False
+
+  def push(self, text: str):
+    """
+    Buffers a delta.
+
+    Returns:
+      str or None: The buffered text if a chunk is due, None otherwise.
+    """
+    if not text:
+      return None
+    if self._first_at is None:
+      self._first_at = time.monotonic()
+    self._parts.append(text)
+    self._size += len(text.encode('utf-8'))
+    if not self._started or self._size >= self.flush_bytes or time.monotonic() - self._first_at >= self.flush_interval:
+      self._started = True
+      return self.flush()
+    return None
+
+  def flush(self):
+    """
+    Releases all buffered text. Call before emitting anything that must not overtake buffered text and when the stream ends.
+
+    Returns:
+      str or None: The buffered text or None if nothing is buffered.
+    """
+    if not self._parts:
+      return None
+    chunk = ''.join(self._parts)
+    self._parts = []
+    self._size = 0
+    self._first_at = None
+    return chunk
+
+
+def format_sse(event: str, data, event_id: int=None):
+  """
+  Frames a single Server-Sent Event. `data` is serialized as JSON, so every event is one `data:` line.
+
+  Parameters:
+    event (str): The event type.
+    data (Any): The JSON serializable event data.
+    event_id (int): The ID of the event within the stream. Clients resend the last received ID in `Last-Event-ID` when reconnecting.
+
+  Returns:
+    str: The framed event.
+  """
+  frame = ''
+  if event_id is not None:
+    frame += f'id: {event_id}\n'
+  frame += f'event: {event}\ndata: {json.dumps(data)}\n\n'
+  return frame
+
+
+def sse_stream(events):
+  """
+  Frames `(event, data)` tuples as Server-Sent Events, numbering them from 1. Closing the stream closes `events` too.
+
+  Parameters:
+    events (Iterable[tuple[str, Any]]): The events to frame.
+  """
+  try:
+    for event_id, (event, data) in enumerate(events, start=1):
+      yield format_sse(event, data, event_id)
+  finally:
+    close = getattr(events, 'close', None)
+    if close:
+      close()
@@ -0,0 +1,16 @@
+import logging
+from dotenv import load_dotenv
+from database.database import scheduler
+
+load_dotenv()
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO, handlers=[logging.StreamHandler()])
+
+# Runs the scheduled jobs (see database.database.scheduler). Any number of workers may run, each job is executed by one
+# of them at a time and once per interval (see database.database.run_exclusive). Usage: python worker.py
+if __name__ == '__main__':
+  logging.info(f'Starting job worker with jobs {[job.id for job in scheduler.get_jobs()]}')
+  try:
+    scheduler.start()
+  except (KeyboardInterrupt, SystemExit):
+    logging.info('Job worker stopped.')